@@ -5,13 +5,13 @@ import sys
 import warnings
 from pathlib import Path
 
-import requests
 from pydantic import ValidationError
 
-from lib.asset import AssetWorker
+from lib.asset import NOT_MEASURED_FILE, AssetWorker, dynamic_filter_names
 from lib.get_token import MPXAuthenticator
 from lib.kb_checker import KB_Checker
 from lib.policies_checker import EventPolicies
+from lib.run_stats import run_stats
 from lib.settings_checker import Settings, check_group_id
 
 old_python = False
@@ -23,6 +23,7 @@ else:
     import asyncio
 
     from lib.events import EventsWorker
+    from lib.events_matrix import EventsMatrix
 
 warnings.filterwarnings("ignore")
 
@@ -45,6 +46,7 @@ class MaxPatrolEventsMonitor:
         self.logger.info(
             f"Settings checked. Accepted script mode: {self.settings.mode}"
         )
+        run_stats.set_deadline(self.settings.max_run_seconds)
         self.policies = EventPolicies(
             self.settings.event_policies_file, logger=self.logger
         )
@@ -54,7 +56,7 @@ class MaxPatrolEventsMonitor:
 
     def all_events_worker(self):
         temp_dir = self.settings.out_folder / "ALL_events"
-        temp_dir.mkdir()
+        temp_dir.mkdir(exist_ok=self.settings.resume)
         ev = EventsWorker(
             self.settings,
             self.logger,
@@ -85,7 +87,7 @@ class MaxPatrolEventsMonitor:
             if not checker:
                 exit(1)
         temp_dir = self.settings.out_folder / "Asset_IDs"
-        temp_dir.mkdir()
+        temp_dir.mkdir(exist_ok=self.settings.resume)
         ev = EventsWorker(
             self.settings,
             self.logger,
@@ -106,7 +108,7 @@ class MaxPatrolEventsMonitor:
             "group": self.settings.mpx_group,
         }
         temp_dir = self.settings.out_folder / "All_Assets"
-        temp_dir.mkdir()
+        temp_dir.mkdir(exist_ok=self.settings.resume)
         aw = AssetWorker(
             self.settings,
             self.auth,
@@ -129,11 +131,11 @@ class MaxPatrolEventsMonitor:
                     groups.append(line)
         for group in groups.copy():
             url = f"https://{self.settings.mpx_host}:443/api/assets_temporal_readmodel/v2/groups/{group}"
-            response_temp = requests.session().get(
-                url=url,
-                headers=self.auth.headers,
-                verify=False,
-                cookies=self.auth.cookies,
+            response_temp = self.auth.retry.send(
+                "assets_grid",
+                lambda: self.auth.transport.get(
+                    url, headers=self.auth.headers, cookies=self.auth.cookies
+                ),
             )
             if response_temp.status_code == 200:
                 response = response_temp.json()
@@ -156,7 +158,7 @@ class MaxPatrolEventsMonitor:
         ) as groups_file:
             json.dump(full_info_group, groups_file, indent=4, ensure_ascii=False)
         temp_dir = self.settings.out_folder / "Dyn_groups"
-        temp_dir.mkdir()
+        temp_dir.mkdir(exist_ok=self.settings.resume)
         if mem.settings.mode == "Dynamic_Groups_assets":
             default_asset_filter = {
                 "PDQL": self.settings.default_PDQL_assets,
@@ -191,16 +193,29 @@ class MaxPatrolEventsMonitor:
             "r", encoding="utf-8"
         ) as assets_filters_file:
             assets_filters = json.load(assets_filters_file)
+        matrix_filters = []
+        parallel_filters = []
+        # фильтры, на активы которых ссылаются <dynamic!{...}dynamic!> других фильтров
+        dynamic_sources = set()
+        for filter_settings in assets_filters.values():
+            if type(filter_settings) is not dict:
+                continue
+            if type(filter_settings.get("PDQL")) in [str, list]:
+                dynamic_sources.update(
+                    dynamic_filter_names("".join(filter_settings["PDQL"]))
+                )
         for assets_filter in assets_filters:
             self.logger.info(f"start {assets_filter}")
             if assets_filter == "comments":
                 continue
             folder_name = re.sub("[^a-zA-Zа-яА-я_ 0-9-]", "_", assets_filter)
             out_folder = self.settings.out_folder / folder_name
-            if out_folder.exists():
+            if out_folder.exists() and not (
+                self.settings.resume and not self.filter_has_report(folder_name)
+            ):
                 self.logger.info(f"Out folder: {out_folder} exists. Skip filter")
                 continue
-            out_folder.mkdir()
+            out_folder.mkdir(exist_ok=self.settings.resume)
             if "group" not in assets_filters[assets_filter]:
                 assets_filters[assets_filter]["group"] = "-1"
             else:
@@ -248,7 +263,115 @@ class MaxPatrolEventsMonitor:
                 assets_filter,
                 assets_filters[assets_filter],
             )
-            aw.assets_take_info(out_folder, True, all_search_values)
+            if run_stats.expired():
+                aw.not_measured_take_info(out_folder, True)
+                continue
+            if (out_folder / NOT_MEASURED_FILE).exists():
+                (out_folder / NOT_MEASURED_FILE).unlink()
+            aw.keep_records = folder_name in dynamic_sources
+            aw.expect_grid()
+            if self.settings.events_matrix:
+                matrix_filters.append((aw, out_folder))
+            elif self.settings.parallel_filters > 1:
+                parallel_filters.append((assets_filter, aw, out_folder))
+            else:
+                aw.assets_take_info(out_folder, True, all_search_values)
+        if matrix_filters:
+            self.asset_filters_by_matrix(matrix_filters)
+        if parallel_filters:
+            asyncio.run(self.asset_filters_parallel(parallel_filters))
+
+    def filter_has_report(self, folder_name):
+        """
+        Есть ли уже отчет фильтра, при resume фильтры без отчета дособираются. Отчет без
+        активов фильтра, не начатого до max_run_seconds, не в счет
+        """
+        if (self.settings.out_folder / folder_name / NOT_MEASURED_FILE).exists():
+            return False
+        for _ in self.settings.out_folder.glob(f"*-{folder_name}-*.xlsx"):
+            return True
+        return False
+
+    async def asset_filters_parallel(self, filters):
+        """
+        Режим parallel_filters: фильтры работают одновременно в одном event loop, не больше
+        parallel_filters сразу, запросы к SIEM всех фильтров идут через общий ограничитель.
+        Фильтр с <dynamic!{... "filter_name": ...}dynamic!> ждет, пока сохранятся активы фильтра,
+        на который ссылается, фильтр с такими же PDQL и группами, как у фильтра выше, ждет его
+        сетку активов из grid_cache. Как и при последовательной работе, учитываются только ссылки
+        на фильтры выше по файлу, поэтому циклов в зависимостях нет
+        """
+        slots = asyncio.Semaphore(self.settings.parallel_filters)
+        assets_taken = {}
+        grid_taken = {}
+        tasks = []
+        for assets_filter, aw, out_folder in filters:
+            depends = [
+                assets_taken[filter_name]
+                for filter_name in dynamic_filter_names(aw.pdql)
+                if filter_name in assets_taken
+            ]
+            assets_taken[out_folder.name] = asyncio.Event()
+            if aw.grid_key in grid_taken:
+                depends.append(grid_taken[aw.grid_key])
+            else:
+                grid_taken[aw.grid_key] = assets_taken[out_folder.name]
+            tasks.append(
+                self.parallel_filter(
+                    assets_filter,
+                    aw,
+                    out_folder,
+                    depends,
+                    assets_taken[out_folder.name],
+                    slots,
+                )
+            )
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for (assets_filter, _, _), result in zip(filters, results):
+            if isinstance(result, Exception):
+                self.logger.error(
+                    f"Filter {assets_filter} failed, no report: {result!r}",
+                    exc_info=result,
+                )
+
+    async def parallel_filter(
+        self, assets_filter, aw, out_folder, depends, assets_taken, slots
+    ):
+        try:
+            for dependency in depends:
+                await dependency.wait()
+            async with slots:
+                if run_stats.expired():
+                    aw.not_measured_take_info(out_folder, True)
+                    return
+                self.logger.info(f"take {assets_filter}")
+                await aw.assets_take_info_async(out_folder, True, assets_taken)
+                self.logger.info(f"{assets_filter} done")
+        finally:
+            # зависимые фильтры не ждут вечно упавший или пропущенный фильтр
+            assets_taken.set()
+
+    def asset_filters_by_matrix(self, matrix_filters):
+        """
+        Режим events_matrix: сначала активы всех фильтров, затем один проход по уникальным запросам
+        для объединения активов, затем отчеты фильтров из среза матрицы
+        """
+        matrix = EventsMatrix(self.settings, self.logger, self.policies, self.auth)
+        filters_assets = []
+        for aw, out_folder in matrix_filters:
+            self.logger.info(f"take assets for {aw.filter_name}")
+            asset_dict, asset_fields, no_assets = aw.work(out_folder)
+            if asset_dict:
+                matrix.add_filter(aw.events_worker().policies, asset_dict.keys())
+            filters_assets.append((asset_dict, asset_fields, no_assets))
+        matrix_folder = self.settings.out_folder / "!events_matrix"
+        matrix.collect(self.settings.mpx_group, matrix_folder)
+        for (aw, out_folder), (asset_dict, asset_fields, no_assets) in zip(
+            matrix_filters, filters_assets
+        ):
+            self.logger.info(f"make report for {aw.filter_name} from events matrix")
+            aw.events_matrix = matrix
+            aw.events_take_info(out_folder, True, asset_dict, asset_fields, no_assets)
 
 
 if __name__ == "__main__":
@@ -266,5 +389,6 @@ if __name__ == "__main__":
         mem.dynamic_modes()
     elif mem.settings.mode == "Assets_filters":
         mem.asset_filters()
+    run_stats.log_summary(mem.logger, mem.settings.out_folder)
     # elif mem.settings.mode == "Only_KB":
     #     mem.kb_check()
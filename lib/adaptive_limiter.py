@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .run_stats import run_stats
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель параллельных запросов к API MaxPatrol, замена asyncio.Semaphore.
+    При adaptive_threads работает по AIMD: пока p95 времени ответа и доля ошибок в норме, лимит растет
+    на 1 за каждый "раунд" из limit успешных запросов, на 5xx, errors в ответе и таймаутах лимит
+    делится пополам. Без adaptive_threads это обычный семафор на max_threads_for_siem_api.
+    Не привязан к event loop, поэтому переживает несколько asyncio.run подряд.
+    """
+
+    window = 100
+    max_error_rate = 0.05
+    decrease_cooldown = 5
+
+    def __init__(
+        self,
+        name,
+        start_limit,
+        logger: logging.Logger,
+        adaptive=False,
+        max_limit=None,
+        latency_target=0,
+    ):
+        self.name = name
+        self.logger = logger
+        self.adaptive = adaptive
+        self.limit = start_limit
+        self.min_limit = 1
+        self.max_limit = max(max_limit or start_limit, start_limit)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.min_limit_seen = start_limit
+        self.max_limit_seen = start_limit
+        self._waiters = deque()
+        self._started = {}
+        self._failed = set()
+        self._latencies = deque(maxlen=self.window)
+        self._outcomes = deque(maxlen=self.window)
+        self._successes_since_change = 0
+        self._last_decrease = 0.0
+
+    async def __aenter__(self):
+        if self._waiters or self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                # слот занимает _wake до пробуждения, поэтому повторной проверки нет
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif not waiter.cancelled():
+                    # слот уже был отдан этой задаче, передаем его следующей
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+        else:
+            self.in_flight += 1
+        self._started[asyncio.current_task()] = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        task = asyncio.current_task()
+        self.in_flight -= 1
+        started = self._started.pop(task, None)
+        if task in self._failed:
+            self._failed.discard(task)
+        elif exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.overload(f"{exc_type.__name__}")
+            self._failed.discard(task)
+        elif started is not None and exc_type is None:
+            self._success(time.monotonic() - started)
+        self._wake()
+        return False
+
+    def overload(self, reason=""):
+        """Сигнал перегрузки ядра: 5xx, errors в теле ответа или таймаут"""
+        task = asyncio.current_task()
+        if task in self._started:
+            self._failed.add(task)
+        self.requests += 1
+        self.errors += 1
+        self._outcomes.append(False)
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        # несколько одновременно упавших запросов - это одна перегрузка, а не несколько
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        self._set_limit(max(self.min_limit, self.limit // 2), f"overload {reason}")
+
+    def p95(self):
+        if not self._latencies:
+            return 0.0
+        latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def summary(self):
+        return {
+            "adaptive": self.adaptive,
+            "limit": self.limit,
+            "min_limit_seen": self.min_limit_seen,
+            "max_limit_seen": self.max_limit_seen,
+            "requests": self.requests,
+            "errors": self.errors,
+            "p95_seconds": round(self.p95(), 2),
+        }
+
+    def _success(self, latency):
+        self.requests += 1
+        self._latencies.append(latency)
+        self._outcomes.append(True)
+        if not self.adaptive or self.limit >= self.max_limit:
+            return
+        self._successes_since_change += 1
+        if self._successes_since_change < self.limit:
+            return
+        p95 = self.p95()
+        if (
+            not self.latency_target or p95 <= self.latency_target
+        ) and self.error_rate() <= self.max_error_rate:
+            self._set_limit(self.limit + 1, f"p95 {p95:.1f}s")
+        else:
+            self._successes_since_change = 0
+
+    def _set_limit(self, new_limit, reason):
+        self._successes_since_change = 0
+        if new_limit == self.limit:
+            return
+        self.logger.info(
+            f"API limiter {self.name}: concurrency {self.limit} -> {new_limit} ({reason})"
+        )
+        self.limit = new_limit
+        self.min_limit_seen = min(self.min_limit_seen, new_limit)
+        self.max_limit_seen = max(self.max_limit_seen, new_limit)
+        self._wake()
+
+    def _wake(self):
+        """
+        Свободные слоты (limit - in_flight) по очереди отдаются ожидающим. Слот занимается
+        сразу, поэтому несколько _wake до запуска разбуженных задач не будят лишних
+        """
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+
+def get_limiter(settings, logger: logging.Logger, name):
+    """Общий на весь запуск ограничитель для группы API (events, incidents, kb)"""
+    if name not in run_stats.limiters:
+        run_stats.limiters[name] = AdaptiveLimiter(
+            name,
+            settings.max_threads_for_siem_api,
+            logger,
+            settings.adaptive_threads,
+            settings.adaptive_max_threads,
+            settings.adaptive_latency_p95,
+        )
+    return run_stats.limiters[name]
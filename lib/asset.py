@@ -2,8 +2,9 @@ import json
 import logging
 import re
 import sys
-import time
-from copy import deepcopy
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 from pathlib import Path
 from typing import Any, Union
 from uuid import UUID
@@ -13,7 +14,13 @@ import requests
 from lib.policies_checker import EventPolicies
 from lib.settings_checker import Settings
 
+from .asset_store import AssetStore, json_default
 from .get_token import MPXAuthenticator
+from .grid_cache import GridCache, get_grid_cache, group_ids, normalize_pdql
+from .query_cache import get_query_cache
+from .retry_policy import RetryPolicy, get_retry_policy
+from .run_stats import run_stats
+from .xlsx_out import NOT_MEASURED
 
 old_python = False
 if sys.version.find("3.7.") == 0:
@@ -23,9 +30,21 @@ if sys.version.find("3.7.") == 0:
 else:
     import asyncio
 
+    from aiohttp import client_exceptions
+
     from .events import EventsWorker
 EventsWorker = EventsWorker
 
+# отметка в папке фильтра, не начатого до max_run_seconds: при resume он дособирается
+NOT_MEASURED_FILE = "!not_measured.json"
+
+# {папка фильтра: записи сетки активов} фильтров, на которые ссылаются dynamic-фильтры этого запуска
+_kept_records = {}
+
+# IPv4-адрес без проверки диапазона чисел: значения all_search_values (_search_key)
+# и адреса dynamic-фильтров (_classify_host)
+_IPV4 = re.compile("^\\d{1,3}(\\.\\d{1,3}){3}$")
+
 
 class AssetWorker:
     settings: Settings
@@ -33,6 +52,7 @@ class AssetWorker:
     logger: logging.Logger
     policies: EventPolicies
     filter_name: str
+    retry: RetryPolicy
     if not old_python:
         pdql: Union[str, list[str]]
         default_politics_whitelist: Union[str, list[str], None]
@@ -92,6 +112,7 @@ class AssetWorker:
             EventsWorker = EventsWorkerDL
         self.auth = auth
         self.logger = logger
+        self.retry = get_retry_policy(self.settings, self.logger)
         self.policies = policies
         self.filter_name = filter_name
         self.pdql = filter_settings["PDQL"]
@@ -117,9 +138,22 @@ class AssetWorker:
                     f"self.mandatory_policies {self.mandatory_policies} is not string or list. Skip."
                 )
         self.comment = filter_settings.get("comment")
+        if self.comment and type(self.comment) is str:
+            self.comment = [self.comment]
         self.group = filter_settings["group"]
         self.specific_politics = filter_settings.get("specific_politics")
         self.all_search_values = filter_settings.get("all_search_values")
+        self.events_matrix = None
+        self.query_cache = get_query_cache(self.settings, self.logger)
+        self.grid_cache = get_grid_cache(self.logger)
+        self.grid_key = GridCache.key(self.pdql, self.group)
+        # фильтр учтен в grid_cache.expect и еще не взял сетку и не положил свою
+        self.grid_expected = False
+        self.assets_cache_key = None
+        self.pdql_response = None
+        self.cached_records = None
+        # записи сетки нужны dynamic-фильтрам, см. work_with_dynamic
+        self.keep_records = False
         if (self.default_politics_whitelist or self.default_politics_blacklist) is None:
             self.logger.warning(
                 f"In asset filter {filter_name} no default_politics_whitelist or "
@@ -129,143 +163,338 @@ class AssetWorker:
             self.default_politics_blacklist = self.settings.event_policies
 
     def assets_take_info(self, out_folder, need_up_file, all_search_values):
-        if self.comment:
-            if type(self.comment) is str:
-                self.comment = [self.comment]
+        if self.settings.asset_pipeline and not old_python:
+            self.pipeline_take_info(out_folder, need_up_file)
+            return
         asset_dict, asset_fields, no_assets = self.work(out_folder)
-        num_assets = len(asset_dict.keys())
-        self.logger.info(f"find {num_assets} assets")
-        if no_assets:
-            self.logger.info(f"and {len(no_assets)} lines with asset_id null")
-        counter = self.settings.max_uuids_in_siem_query
-        if num_assets > 0:
-            ev = EventsWorker(
-                self.settings,
-                self.logger,
-                self.policies,
-                self.auth,
-                self.default_politics_blacklist,
-                self.default_politics_whitelist,
-                self.specific_politics,
-                self.mandatory_policies,
-                not self.settings.dl_mode,
-            )
-            self.logger.info("Now take events by policies")
-            if num_assets < counter:
-                if not old_python:
-                    asyncio.run(
-                        ev.work(
-                            self.settings.mpx_group, list(asset_dict.keys()), out_folder
-                        )
-                    )
-                else:
-                    ev.work(
-                        self.settings.mpx_group, list(asset_dict.keys()), out_folder
-                    )
-                ev.make_readable_out(
-                    out_folder,
-                    asset_fields,
-                    asset_dict,
-                    no_assets,
-                    need_up_file,
-                    self.comment,
-                )
+        self.events_take_info(
+            out_folder, need_up_file, asset_dict, asset_fields, no_assets
+        )
+
+    async def assets_take_info_async(self, out_folder, need_up_file, assets_taken=None):
+        """
+        assets_take_info в event loop вызывающего (parallel_filters): фильтры одного loop
+        делят пул соединений и ограничитель запросов к SIEM.
+        assets_taken (asyncio.Event) выставляется, когда активы фильтра сохранены в out_folder
+        и фильтры с dynamic-ссылкой на него могут начинать работу
+        """
+        ev = None
+        events_taken = False
+        try:
+            if self.settings.asset_pipeline:
+                ev = self.events_worker()
+                work_result, events_taken = await self._pipeline(ev, out_folder)
+                asset_dict, asset_fields, no_assets = work_result
             else:
-                count = (
-                    num_assets // counter + 1
-                    if num_assets % counter > 0
-                    else num_assets // counter
+                asset_dict, asset_fields, no_assets = await self._with_session(
+                    self.work_async, out_folder
                 )
-                temp_list = list(asset_dict.keys())
-                for stack in range(count):
-                    if stack + 1 < count:
-                        out_dir = out_folder / (
-                            str(stack * counter) + "-" + str((stack + 1) * counter)
-                        )
-                    else:
-                        out_dir = out_folder / (
-                            str(stack * counter) + "-" + str(num_assets)
-                        )
-                    out_dir.mkdir()
-                    if not old_python:
-                        asyncio.run(
-                            ev.work(
-                                self.settings.mpx_group,
-                                temp_list[stack * counter : (stack + 1) * counter],
-                                out_dir,
-                            )
-                        )
-                    else:
-                        ev.work(
-                            self.settings.mpx_group,
-                            temp_list[stack * counter : (stack + 1) * counter],
-                            out_dir,
-                        )
-                    if stack + 1 < count:
-                        self.logger.info(
-                            f"{stack * counter}-{(stack + 1) * counter} done"
-                        )
-                    else:
-                        self.logger.info(f"{stack * counter}-{num_assets} done")
-                    if not old_python:
-                        ev.semaphore = asyncio.Semaphore(
-                            self.settings.max_threads_for_siem_api
-                        )
-                self.logger.info(f"make readable out in {out_folder}")
-                ev.make_readable_out(
+        finally:
+            if assets_taken is not None:
+                assets_taken.set()
+        if events_taken and asset_dict:
+            self._log_found(asset_dict, no_assets)
+        else:
+            ev, batches = self._events_batches(out_folder, asset_dict, no_assets)
+            if batches:
+                await ev.work_batches(self.settings.mpx_group, batches)
+        if ev is not None:
+            # отчет пишется в потоке, чтобы запросы других фильтров не стояли
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                partial(
+                    self._readable_out,
+                    ev,
                     out_folder,
                     asset_fields,
                     asset_dict,
                     no_assets,
                     need_up_file,
-                    self.comment,
+                ),
+            )
+
+    def pipeline_take_info(self, out_folder, need_up_file):
+        """
+        asset_pipeline: пачки активов уходят в запросы событий по мере скачивания страниц
+        сетки активов, отчет строится, когда закончены оба этапа
+        """
+        ev = self.events_worker()
+        (asset_dict, fields, no_assets), events_taken = asyncio.run(
+            self._pipeline(ev, out_folder)
+        )
+        if not events_taken or not asset_dict:
+            # без скачивания страниц перекрывать нечего, события запрашиваются как обычно
+            self.events_take_info(
+                out_folder, need_up_file, asset_dict, fields, no_assets
+            )
+            return
+        self._log_found(asset_dict, no_assets)
+        self._readable_out(ev, out_folder, fields, asset_dict, no_assets, need_up_file)
+
+    async def _pipeline(self, ev, out_folder):
+        """
+        Токен и страницы сетки активов запрашиваются в том же event loop, что и события:
+        новые asset_id копятся до размера пачки, и пачка сразу уходит в EventsWorker.work_stream.
+        Пачки и папки те же, что у events_take_info.
+        Возвращает результат work и признак, что события уже запрошены
+        """
+        session = self.auth.transport.open_session(self.auth.headers, self.auth.cookies)
+        try:
+            token_info = await self.create_pdql_token_async(session, out_folder)
+            response, _, asset_id_field, _ = token_info
+            if not response or self.cached_records is not None:
+                return self._work_result(out_folder, token_info, None), False
+            self.logger.info(
+                "try to get assets, events are taken by batches as they arrive"
+            )
+            pages = asyncio.Queue()
+            download = asyncio.ensure_future(
+                self.take_asset_pages_async(
+                    session, response["token"], out_folder, on_page=pages.put_nowait
                 )
-        elif no_assets:
-            ev = EventsWorker(
-                self.settings,
-                self.logger,
-                self.policies,
-                self.auth,
-                self.default_politics_blacklist,
-                self.default_politics_whitelist,
-                self.specific_politics,
-                self.mandatory_policies,
-                not self.settings.dl_mode,
             )
+            download.add_done_callback(lambda _: pages.put_nowait(None))
+            counter = self.batch_size()
+
+            async def batches():
+                known_ids = set()
+                pending = []
+                start = 0
+                while True:
+                    records = await pages.get()
+                    if records is None:
+                        break
+                    for asset in records:
+                        asset_id = _record_asset_id(asset, asset_id_field)
+                        if asset_id and asset_id not in known_ids:
+                            known_ids.add(asset_id)
+                            pending.append(asset_id)
+                    while len(pending) >= counter:
+                        out_dir = out_folder / (str(start) + "-" + str(start + counter))
+                        out_dir.mkdir(exist_ok=self.settings.resume)
+                        self.logger.info(
+                            f"assets {out_dir.name} sent to events queries"
+                        )
+                        yield pending[:counter], out_dir
+                        pending = pending[counter:]
+                        start += counter
+                if (
+                    download.cancelled()
+                    or download.exception() is not None
+                    or download.result() is None
+                ):
+                    return
+                if pending and start == 0:
+                    yield pending, out_folder
+                elif pending:
+                    out_dir = out_folder / (
+                        str(start) + "-" + str(start + len(pending))
+                    )
+                    out_dir.mkdir(exist_ok=self.settings.resume)
+                    yield pending, out_dir
+
+            try:
+                await ev.work_stream(self.settings.mpx_group, batches())
+            except BaseException:
+                download.cancel()
+                raise
+            asset_info = await download
+            if asset_info is None:
+                self.logger.warning(f"{self.pdql} assets not taken, no report")
+            return self._work_result(out_folder, token_info, asset_info), True
+        finally:
+            self._release_grid()
+            await self.auth.transport.close_session(session)
+
+    def batch_size(self):
+        """Размер пачки активов в запросах событий"""
+        if self.settings.adaptive_uuids:
+            # части пачки подбираются по фильтрам, пачка - их верхняя граница
+            return self.settings.adaptive_uuids_max
+        return self.settings.max_uuids_in_siem_query
+
+    def events_worker(self):
+        return EventsWorker(
+            self.settings,
+            self.logger,
+            self.policies,
+            self.auth,
+            self.default_politics_blacklist,
+            self.default_politics_whitelist,
+            self.specific_politics,
+            self.mandatory_policies,
+            not self.settings.dl_mode,
+        )
+
+    def events_take_info(
+        self, out_folder, need_up_file, asset_dict, asset_fields, no_assets
+    ):
+        ev, batches = self._events_batches(out_folder, asset_dict, no_assets)
+        if batches:
+            if not old_python:
+                # все пачки в одном event loop и одном пуле соединений
+                asyncio.run(ev.work_batches(self.settings.mpx_group, batches))
+            else:
+                for batch_ids, out_dir in batches:
+                    ev.work(self.settings.mpx_group, batch_ids, out_dir)
+                    if len(batches) > 1:
+                        self.logger.info(f"{out_dir.name} done")
+        if ev is not None:
+            self._readable_out(
+                ev, out_folder, asset_fields, asset_dict, no_assets, need_up_file
+            )
+
+    def _log_found(self, asset_dict, no_assets):
+        self.logger.info(f"find {len(asset_dict)} assets")
+        if no_assets:
+            self.logger.info(f"and {len(no_assets)} lines with asset_id null")
+
+    def _events_batches(self, out_folder, asset_dict, no_assets):
+        """
+        EventsWorker фильтра и пачки активов [(asset_ids, out_folder), ...] для запросов событий.
+        Без активов, но со строками без asset_id - EventsWorker без политик только для отчета,
+        без строк вовсе - (None, [])
+        """
+        self._log_found(asset_dict, no_assets)
+        num_assets = len(asset_dict.keys())
+        counter = self.batch_size()
+        if num_assets > 0:
+            ev = self.events_worker()
+            self.logger.info("Now take events by policies")
+            if self.events_matrix is not None:
+                # все запросы уже выполнены в общей матрице, пачки не нужны
+                ev.events_matrix = self.events_matrix
+                return ev, [(list(asset_dict.keys()), out_folder)]
+            if num_assets < counter:
+                return ev, [(list(asset_dict.keys()), out_folder)]
+            count = (
+                num_assets // counter + 1
+                if num_assets % counter > 0
+                else num_assets // counter
+            )
+            temp_list = list(asset_dict.keys())
+            batches = []
+            for stack in range(count):
+                if stack + 1 < count:
+                    out_dir = out_folder / (
+                        str(stack * counter) + "-" + str((stack + 1) * counter)
+                    )
+                else:
+                    out_dir = out_folder / (
+                        str(stack * counter) + "-" + str(num_assets)
+                    )
+                out_dir.mkdir(exist_ok=self.settings.resume)
+                batches.append(
+                    (temp_list[stack * counter : (stack + 1) * counter], out_dir)
+                )
+            return ev, batches
+        if no_assets:
+            ev = self.events_worker()
             ev.policies.rebuilt_policies = []
             ev.policies.small_policies = {}
-            ev.make_readable_out(
-                out_folder,
-                asset_fields,
-                asset_dict,
-                no_assets,
-                need_up_file,
-                self.comment,
-            )
+            return ev, []
+        return None, []
 
-    def work(self, out_folder):
-        response, fields, asset_id_field, all_search_values = self.create_pdql_token(
-            out_folder
+    def _readable_out(
+        self, ev, out_folder, asset_fields, asset_dict, no_assets, need_up_file
+    ):
+        self.logger.info(f"make readable out in {out_folder}")
+        ev.make_readable_out(
+            out_folder,
+            asset_fields,
+            asset_dict,
+            no_assets,
+            need_up_file,
+            self.comment,
         )
+
+    def not_measured_take_info(self, out_folder, need_up_file):
+        """
+        Фильтр не начат до max_run_seconds: отчет без активов с пометкой NOT_MEASURED в
+        комментарии и запись в итоговой сводке, чтобы фильтр не пропал из отчетов запуска
+        """
+        self._release_grid()
+        run_stats.not_measured_filters.append(self.filter_name)
+        self.logger.warning(
+            f"Run deadline reached. Filter {self.filter_name} is not measured"
+        )
+        with (out_folder / NOT_MEASURED_FILE).open("w", encoding="utf-8") as out_file:
+            json.dump({"filter": self.filter_name}, out_file, ensure_ascii=False)
+        ev = self.events_worker()
+        # копии политик: view() делит словари политик с другими фильтрами
+        ev.policies.rebuilt_policies = [
+            dict(policy, host_ids={}, not_measured=["*"])
+            for policy in ev.policies.rebuilt_policies
+        ]
+        comment = [f"{NOT_MEASURED}: run deadline max_run_seconds reached"]
+        ev.make_readable_out(
+            out_folder, [], {}, [], need_up_file, comment + (self.comment or [])
+        )
+
+    def work(self, out_folder):
+        if not old_python:
+            return asyncio.run(self._with_session(self.work_async, out_folder))
+        try:
+            token_info = self.create_pdql_token(out_folder)
+            asset_info = None
+            if token_info[0] and self.cached_records is None:
+                asset_info = self.take_asset_pages(token_info[0]["token"], out_folder)
+            return self._work_result(out_folder, token_info, asset_info)
+        finally:
+            self._release_grid()
+
+    async def work_async(self, session, out_folder):
+        """work в event loop вызывающего, session - из transport.open_session"""
+        try:
+            token_info = await self.create_pdql_token_async(session, out_folder)
+            asset_info = None
+            if token_info[0] and self.cached_records is None:
+                asset_info = await self.take_asset_pages_async(
+                    session, token_info[0]["token"], out_folder
+                )
+            return self._work_result(out_folder, token_info, asset_info)
+        finally:
+            self._release_grid()
+
+    def _work_result(self, out_folder, token_info, asset_info):
+        """Словарь активов из ответа create_pdql_token и скачанных записей сетки"""
+        response, fields, asset_id_field, all_search_values = token_info
         if self.all_search_values:
             all_search_values = self.all_search_values
-        if response:
-            temp_token = str(response["token"])
-            self.logger.info(f"get PDQL token: {temp_token}")
-            asset_dict, no_assets = self.take_assets(
-                response["token"], out_folder, asset_id_field, all_search_values, fields
-            )
-            return asset_dict, fields, no_assets
-        else:
+        if not response:
             self.logger.warning("no PDQL token, return {}, [], []")
             return {}, [], []
+        if asset_info is None and self.cached_records is None:
+            return {}, fields, []
+        asset_dict, no_assets = self.take_assets(
+            response["token"],
+            out_folder,
+            asset_id_field,
+            all_search_values,
+            fields,
+            asset_info,
+        )
+        return asset_dict, fields, no_assets
 
-    def create_pdql_token(self, out_folder: Path):
-        url = "https://{}:443/api/assets_temporal_readmodel/v1/assets_grid".format(
-            self.settings.mpx_host
+    async def _with_session(self, method, *args, **kwargs):
+        """Вызов асинхронного метода клиента сетки активов в отдельной сессии транспорта"""
+        session = self.auth.transport.open_session(self.auth.headers, self.auth.cookies)
+        try:
+            return await method(session, *args, **kwargs)
+        finally:
+            await self.auth.transport.close_session(session)
+
+    def _grid_url(self, path=""):
+        return "https://{}:443/api/assets_temporal_readmodel/v1/assets_grid{}".format(
+            self.settings.mpx_host, path
         )
-        old_pdql = self.pdql
 
+    def _pdql_request(self, out_folder: Path):
+        """
+        Подстановка dynamic-фильтров и групп в запрос assets_grid.
+        Возвращает тело запроса, all_search_values и результат из grid_cache, query_cache или None
+        """
+        old_pdql = self.pdql
         all_search_values = {}
         while self.pdql.find("<dynamic!{") != -1:
             dyn_filter = self.pdql[
@@ -291,84 +520,118 @@ class AssetWorker:
                 )
         if old_pdql != self.pdql:
             self.logger.info(f"new self.pdql:{self.pdql}")
-        if type(self.group) is str:
-            if self.group == "-1":
-                self.group = ["00000000-0000-0000-0000-000000000002"]
-            else:
-                self.group = [self.group]
+        self.group = group_ids(self.group)
         data = {
             "pdql": self.pdql,
             "selectedGroupIds": self.group,
             "includeNestedGroups": True,
             "utcOffset": "+03:00",
         }
+        cached = self.grid_cache.get(self.grid_key)
+        if cached is not None:
+            self.logger.info("PDQL token and assets from filter with the same PDQL")
+            self.grid_expected = False
+            return (
+                data,
+                all_search_values,
+                self._cached_grid(cached, out_folder, all_search_values),
+            )
+        if self.query_cache is not None:
+            # время жизни сетки в кэше задает query_cache_ttl
+            self.assets_cache_key = self.query_cache.key(
+                "assets_grid", normalize_pdql(self.pdql), sorted(self.group)
+            )
+            cached = self.query_cache.get(self.assets_cache_key)
+            if cached is not None:
+                self.logger.info("PDQL token and assets from query cache")
+                result = self._cached_grid(cached, out_folder, all_search_values)
+                self._put_grid(cached["token"], self.cached_records)
+                return data, all_search_values, result
+        return data, all_search_values, None
+
+    def _cached_grid(self, cached, out_folder, all_search_values):
+        self.cached_records = cached["records"]
+        if not isinstance(self.cached_records, AssetStore):
+            # записи из query_cache
+            self.cached_records = AssetStore(self.cached_records)
+        self._dump_cached_grid(out_folder, cached["token"])
+        try:
+            return self._pdql_token_fields(cached["token"], all_search_values)
+        except ValueError:
+            return {}, [], "", {}
+
+    def expect_grid(self):
+        """Фильтр возьмет сетку из grid_cache, если ее раньше получит фильтр с тем же PDQL"""
+        self.grid_cache.expect(self.grid_key)
+        self.grid_expected = True
+
+    def _put_grid(self, token, records):
+        self.grid_cache.put(self.grid_key, token, records)
+        self.grid_expected = False
+
+    def _release_grid(self):
+        """Сетка не получена (ошибка запроса): фильтр больше не ждет ее в grid_cache"""
+        if self.grid_expected:
+            self.grid_cache.release(self.grid_key)
+            self.grid_expected = False
+
+    def _dump_cached_grid(self, out_folder, response, limit=10000):
+        """
+        Ответ create_pdql_token и страницы take_assets_*.json для сетки из кэша в том же виде,
+        что при скачивании: из страниц берут записи dynamic-фильтры следующих запусков
+        """
+        with (out_folder / "create_pdql_token_0.json").open(
+            "w", encoding="utf-8"
+        ) as token_file:
+            json.dump(response, token_file, ensure_ascii=False, indent=4)
+        records = list(self.cached_records)
+        for offset in range(0, max(len(records), 1), limit):
+            self._dump_assets_page(
+                {"records": records[offset : offset + limit]},
+                200,
+                offset,
+                limit,
+                out_folder,
+            )
+
+    def _pdql_token_response(self, response, retry_num, out_folder, all_search_values):
+        """Успешный ответ assets_grid: сохранение в out_folder и разбор полей"""
+        file_name = "create_pdql_token_" + str(retry_num) + ".json"
+        with (out_folder / file_name).open("w", encoding="utf-8") as token_file:
+            json.dump(response, token_file, ensure_ascii=False, indent=4)
+        self.pdql_response = response
+        self.logger.info(f"get PDQL token: {response['token']}")
+        return self._pdql_token_fields(response, all_search_values)
+
+    def create_pdql_token(self, out_folder: Path):
+        if not old_python:
+            return asyncio.run(
+                self._with_session(self.create_pdql_token_async, out_folder)
+            )
+        data, all_search_values, cached = self._pdql_request(out_folder)
+        if cached is not None:
+            return cached
         retry_num = 0
         while True:
+            retry_status = None
+            retry_after = None
             try:
                 self.logger.info("try to make self.pdql token")
                 retry_num += 1
-                if self.settings.reconnect_times < retry_num:
-                    self.logger.error(
-                        f"{retry_num - 1} attempt was unsuccessful while create_pdql_token: {self.pdql}. Exiting."
-                    )
-                    return {}, [], "", {}
-                response_temp = self.auth.session.post(
-                    url=url,
+                self.retry.wait_sync()
+                response_temp = self.auth.transport.post(
+                    self._grid_url(),
                     json=data,
                     headers=self.auth.headers,
-                    verify=False,
                     cookies=self.auth.cookies,
                 )
+                retry_status = response_temp.status_code
+                retry_after = self.retry.retry_after(response_temp.headers)
                 if response_temp.status_code == 200:
-                    file_name = "create_pdql_token_" + str(retry_num) + ".json"
-                    with (out_folder / file_name).open(
-                        "w", encoding="utf-8"
-                    ) as token_file:
-                        json.dump(
-                            response_temp.json(),
-                            token_file,
-                            ensure_ascii=False,
-                            indent=4,
-                        )
-                    response = response_temp.json()
-                    fields = []
-                    asset_exist = False
-                    asset_id_field = ""
-                    for field in response["fields"]:
-                        fields.append(field["name"])
-                        if field["name"] == "asset_id" and field["type"] == "uuid":
-                            asset_exist = True
-                            asset_id_field = "asset_id"
-                        elif field["name"] == "asset_id":
-                            self.logger.error(
-                                'Error in self.pdql, field "asset_id" is not uuid'
-                            )
-                            raise ValueError
-                    if not asset_exist:
-                        for field in response["fields"]:
-                            if field["type"] == "assetInfo":
-                                if asset_exist:
-                                    asset_id_field = ""
-                                    asset_exist = False
-                                else:
-                                    asset_exist = True
-                                    asset_id_field = field["name"]
-                    if not asset_exist:
-                        self.logger.error(
-                            'Error in self.pdql, no field "asset_id" please add this field for correct work in next'
-                            " step:\n",
-                            self.pdql,
-                            '\noften you need to add "host.@id as asset_id" to self.pdql',
-                        )
-                        raise ValueError
-                    for all_search_value in all_search_values.keys():
-                        if all_search_value not in fields:
-                            self.logger.warning(
-                                "all_search_value not in fields. Clear."
-                            )
-                            all_search_values = {}
-                            break
-                    return response, fields, asset_id_field, all_search_values
+                    self.retry.ok("assets_grid")
+                    return self._pdql_token_response(
+                        response_temp.json(), retry_num, out_folder, all_search_values
+                    )
                 elif response_temp.status_code == 400:
                     self.logger.error(
                         f"Error in self.pdql: {self.pdql}. Check self.pdql and rerun"
@@ -384,122 +647,356 @@ class AssetWorker:
                     exit(1)
             except requests.exceptions.HTTPError as Err:
                 self.logger.warning(
-                    f"{retry_num - 1} attempt was unsuccessful while create_pdql_token: {self.pdql} Err: {Err}"
+                    f"{retry_num} attempt was unsuccessful while create_pdql_token: {self.pdql} Err: {Err}"
                 )
             except requests.exceptions.RequestException as Err:
                 self.logger.warning(
-                    f"{retry_num - 1} attempt was unsuccessful while create_pdql_token: {self.pdql} Err: {Err}"
+                    f"{retry_num} attempt was unsuccessful while create_pdql_token: {self.pdql} Err: {Err}"
+                )
+            except ValueError:
+                return {}, [], "", {}
+            if not self.retry.sleep_sync(
+                "assets_grid", retry_num, "create_pdql_token", retry_status, retry_after
+            ):
+                self.logger.error(
+                    f"{retry_num} attempt was unsuccessful while create_pdql_token: {self.pdql}. Exiting."
+                )
+                return {}, [], "", {}
+
+    async def create_pdql_token_async(self, session, out_folder: Path):
+        """create_pdql_token в event loop вызывающего, session - из transport.open_session"""
+        data, all_search_values, cached = self._pdql_request(out_folder)
+        if cached is not None:
+            return cached
+        retry_num = 0
+        while True:
+            retry_status = None
+            retry_after = None
+            try:
+                self.logger.info("try to make self.pdql token")
+                retry_num += 1
+                await self.retry.wait()
+                async with session.post(self._grid_url(), json=data) as response_temp:
+                    retry_status = response_temp.status
+                    retry_after = self.retry.retry_after(response_temp.headers)
+                    if response_temp.status == 200:
+                        self.retry.ok("assets_grid")
+                        return self._pdql_token_response(
+                            await response_temp.json(content_type=None),
+                            retry_num,
+                            out_folder,
+                            all_search_values,
+                        )
+                    elif response_temp.status == 400:
+                        self.logger.error(
+                            f"Error in self.pdql: {self.pdql}. Check self.pdql and rerun"
+                        )
+                        self.logger.info(
+                            json.dumps(
+                                await response_temp.json(content_type=None),
+                                indent=4,
+                                ensure_ascii=False,
+                            )
+                        )
+                        raise ValueError
+                    elif response_temp.status == 503:
+                        self.logger.warning("503 Service Unavailable")
+                    elif response_temp.status == 401:
+                        self.logger.error("Error with AuthHeader, stop script")
+                        exit(1)
+            except (client_exceptions.ClientError, asyncio.TimeoutError) as Err:
+                self.logger.warning(
+                    f"{retry_num} attempt was unsuccessful while create_pdql_token: {self.pdql} Err: {Err}"
+                )
+            except json.JSONDecodeError as Err:
+                self.logger.warning(
+                    f"{retry_num} attempt was unsuccessful while create_pdql_token: {self.pdql} Err: {Err}"
                 )
             except ValueError:
                 return {}, [], "", {}
-            time.sleep(5)
+            if not await self.retry.sleep(
+                "assets_grid", retry_num, "create_pdql_token", retry_status, retry_after
+            ):
+                self.logger.error(
+                    f"{retry_num} attempt was unsuccessful while create_pdql_token: {self.pdql}. Exiting."
+                )
+                return {}, [], "", {}
+
+    def _pdql_token_fields(self, response, all_search_values):
+        """Разбор ответа assets_grid: поля, поле с ID актива и проверка all_search_values"""
+        fields = []
+        asset_exist = False
+        asset_id_field = ""
+        for field in response["fields"]:
+            fields.append(field["name"])
+            if field["name"] == "asset_id" and field["type"] == "uuid":
+                asset_exist = True
+                asset_id_field = "asset_id"
+            elif field["name"] == "asset_id":
+                self.logger.error('Error in self.pdql, field "asset_id" is not uuid')
+                raise ValueError
+        if not asset_exist:
+            for field in response["fields"]:
+                if field["type"] == "assetInfo":
+                    if asset_exist:
+                        asset_id_field = ""
+                        asset_exist = False
+                    else:
+                        asset_exist = True
+                        asset_id_field = field["name"]
+        if not asset_exist:
+            self.logger.error(
+                'Error in self.pdql, no field "asset_id" please add this field for correct work in next'
+                " step:\n",
+                self.pdql,
+                '\noften you need to add "host.@id as asset_id" to self.pdql',
+            )
+            raise ValueError
+        for all_search_value in all_search_values.keys():
+            if all_search_value not in fields:
+                self.logger.warning("all_search_value not in fields. Clear.")
+                all_search_values = {}
+                break
+        return response, fields, asset_id_field, all_search_values
 
-    def take_assets(self, token, out_folder, asset_id_field, all_search_values, fields):
-        url = "https://{}:443/api/assets_temporal_readmodel/v1/assets_grid/data".format(
-            self.settings.mpx_host
+    def take_asset_pages(self, token, out_folder, limit=10000, on_page=None):
+        """
+        Все записи сетки активов по токену. После первой полной страницы следующие смещения
+        запрашиваются параллельно (до asset_page_threads страниц сразу), пока не придет
+        короткая страница. Страницы собираются по порядку смещений в AssetStore.
+        None - страница не получена.
+        on_page(records) вызывается для каждой страницы по порядку смещений, как только она
+        и все предыдущие получены
+        """
+        if not old_python:
+            return asyncio.run(
+                self._with_session(
+                    self.take_asset_pages_async, token, out_folder, limit, on_page
+                )
+            )
+        first_page = self._take_assets_page(token, 0, limit, out_folder)
+        if first_page is None:
+            return None
+        self.logger.info(f"take: {len(first_page)} asset lines. limit: {limit}")
+        pages = _AssetPages(first_page, limit, on_page)
+        if pages.done():
+            return pages.records()
+        threads = self.settings.asset_page_threads
+        futures = {}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                while pages.need_more(len(futures), threads):
+                    page = pages.take_next()
+                    future = executor.submit(
+                        self._take_assets_page, token, page * limit, limit, out_folder
+                    )
+                    futures[future] = page
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = futures.pop(future)
+                    records = future.result()
+                    if records is not None:
+                        self.logger.info(
+                            f"take: {len(records)} asset lines at offset {page * limit}"
+                        )
+                    pages.add(page, records)
+        return pages.records()
+
+    async def take_asset_pages_async(
+        self, session, token, out_folder, limit=10000, on_page=None
+    ):
+        """take_asset_pages в event loop вызывающего, session - из transport.open_session"""
+        first_page = await self._take_assets_page_async(
+            session, token, 0, limit, out_folder
         )
-        offset = 0
-        limit = 10000
+        if first_page is None:
+            return None
+        self.logger.info(f"take: {len(first_page)} asset lines. limit: {limit}")
+        pages = _AssetPages(first_page, limit, on_page)
+        if pages.done():
+            return pages.records()
+        threads = self.settings.asset_page_threads
+        tasks = {}
+        try:
+            while True:
+                while pages.need_more(len(tasks), threads):
+                    page = pages.take_next()
+                    task = asyncio.ensure_future(
+                        self._take_assets_page_async(
+                            session, token, page * limit, limit, out_folder
+                        )
+                    )
+                    tasks[task] = page
+                if not tasks:
+                    break
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    page = tasks.pop(task)
+                    records = task.result()
+                    if records is not None:
+                        self.logger.info(
+                            f"take: {len(records)} asset lines at offset {page * limit}"
+                        )
+                    pages.add(page, records)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return pages.records()
+
+    def _dump_assets_page(self, response, status, offset, limit, out_folder):
+        file_name = "take_assets_" + str(offset // limit) + ".json"
+        with (out_folder / file_name).open("w", encoding="utf-8") as token_file:
+            json.dump(
+                response, token_file, ensure_ascii=False, indent=4, default=json_default
+            )
+        self.logger.info(f"Create {file_name} code: {status}")
+
+    def _take_assets_page(self, token, offset, limit, out_folder):
+        """Одна страница сетки активов с повторами: список записей или None"""
         param = {
             "pdqlToken": token,
             "offset": offset,
             "limit": limit,
         }
         retry_num = 0
-        try_num = 0
-        asset_info = []
-        unsuccessful = False
-
-        self.logger.info("try to get assets")
         while True:
+            if run_stats.expired():
+                self.logger.error(
+                    f"Run deadline reached while take_assets: {self.pdql}. Skip filter"
+                )
+                return None
+            retry_status = None
+            retry_after = None
             try:
-                if unsuccessful:
-                    retry_num += 1
-                    unsuccessful = False
-                    time.sleep(5)
-                    self.logger.info(f"try number: {retry_num}")
-                if self.settings.reconnect_times < retry_num:
-                    self.logger.error(
-                        f"{retry_num - 1} attempt was unsuccessful while take_assets: {self.pdql}. Exiting."
-                    )
-                    return {}, []
-                response_temp = self.auth.session.get(
-                    url=url,
+                self.retry.wait_sync()
+                response_temp = self.auth.transport.get(
+                    self._grid_url("/data"),
                     params=param,
                     headers=self.auth.headers,
-                    verify=False,
                     cookies=self.auth.cookies,
                 )
-                file_name = "take_assets_" + str(try_num) + ".json"
-                try_num += 1
-                with (out_folder / file_name).open("w", encoding="utf-8") as token_file:
-                    json.dump(
-                        response_temp.json(), token_file, ensure_ascii=False, indent=4
-                    )
-                self.logger.info(
-                    f"Create {file_name} code: {response_temp.status_code}"
+                self._dump_assets_page(
+                    response_temp.json(),
+                    response_temp.status_code,
+                    offset,
+                    limit,
+                    out_folder,
                 )
                 if response_temp.status_code == 200:
-                    response = response_temp.json()
-                    if not response.get("records"):
-                        break
-                    else:
-                        asset_info.extend(response["records"])
-                        len_resp_rec = len(response["records"])
-                        if len(response["records"]) < limit:
-                            self.logger.info(f"take: {len_resp_rec} asset lines")
-                            break
-                        else:
-                            self.logger.info(
-                                f"take: {len_resp_rec} asset lines. limit: {limit}"
-                            )
-                            param["offset"] += limit
+                    self.retry.ok("assets_grid")
+                    return response_temp.json().get("records") or []
                 elif response_temp.status_code in [400, 403, 404]:
                     self.logger.error(
                         f"problem take_assets {response_temp.status_code}"
                     )
                     exit(1)
-            except requests.exceptions.HTTPError as Err:
+                else:
+                    retry_status = response_temp.status_code
+                    retry_after = self.retry.retry_after(response_temp.headers)
+            except requests.exceptions.RequestException as Err:
                 self.logger.warning(
                     f"{retry_num} attempt was unsuccessful while take_assets: {token}. pdql: {self.pdql}. Err: {Err}"
                 )
-                unsuccessful = True
-            except requests.exceptions.RequestException as Err:
+            retry_num += 1
+            if not self.retry.sleep_sync(
+                "assets_grid", retry_num, "take_assets", retry_status, retry_after
+            ):
+                self.logger.error(
+                    f"{retry_num} attempt was unsuccessful while take_assets: {self.pdql}. Exiting."
+                )
+                return None
+            self.logger.info(f"try number: {retry_num + 1}")
+
+    async def _take_assets_page_async(self, session, token, offset, limit, out_folder):
+        """_take_assets_page в event loop вызывающего"""
+        param = {
+            "pdqlToken": token,
+            "offset": offset,
+            "limit": limit,
+        }
+        retry_num = 0
+        while True:
+            if run_stats.expired():
+                self.logger.error(
+                    f"Run deadline reached while take_assets: {self.pdql}. Skip filter"
+                )
+                return None
+            retry_status = None
+            retry_after = None
+            try:
+                await self.retry.wait()
+                async with session.get(
+                    self._grid_url("/data"), params=param
+                ) as response_temp:
+                    response = await response_temp.json(content_type=None)
+                    self._dump_assets_page(
+                        response, response_temp.status, offset, limit, out_folder
+                    )
+                    if response_temp.status == 200:
+                        self.retry.ok("assets_grid")
+                        return response.get("records") or []
+                    elif response_temp.status in [400, 403, 404]:
+                        self.logger.error(f"problem take_assets {response_temp.status}")
+                        exit(1)
+                    else:
+                        retry_status = response_temp.status
+                        retry_after = self.retry.retry_after(response_temp.headers)
+            except (
+                client_exceptions.ClientError,
+                asyncio.TimeoutError,
+                json.JSONDecodeError,
+            ) as Err:
                 self.logger.warning(
                     f"{retry_num} attempt was unsuccessful while take_assets: {token}. pdql: {self.pdql}. Err: {Err}"
                 )
-                unsuccessful = True
+            retry_num += 1
+            if not await self.retry.sleep(
+                "assets_grid", retry_num, "take_assets", retry_status, retry_after
+            ):
+                self.logger.error(
+                    f"{retry_num} attempt was unsuccessful while take_assets: {self.pdql}. Exiting."
+                )
+                return None
+            self.logger.info(f"try number: {retry_num + 1}")
+
+    def take_assets(
+        self,
+        token,
+        out_folder,
+        asset_id_field,
+        all_search_values,
+        fields,
+        asset_info=None,
+    ):
+        """asset_info - уже скачанные записи сетки (asset_pipeline)"""
+        self.logger.info("try to get assets")
+        if self.cached_records is not None:
+            asset_info = self.cached_records
+        elif asset_info is None:
+            asset_info = self.take_asset_pages(token, out_folder)
+            if asset_info is None:
+                return {}, []
+        if self.pdql_response is not None and self.cached_records is None:
+            self._put_grid(self.pdql_response, asset_info)
+            if self.query_cache is not None:
+                self.query_cache.put(
+                    self.assets_cache_key,
+                    "assets_grid",
+                    {"token": self.pdql_response, "records": asset_info},
+                )
         if asset_info:
+            if self.keep_records:
+                _kept_records[out_folder] = asset_info
             asset_dict = {}
             no_assets = []
+            search = _SearchIndex(all_search_values) if all_search_values else None
             for asset in asset_info:
-                if all_search_values:
-                    for all_search_attr in list(all_search_values.keys()).copy():
-                        if asset[all_search_attr] in all_search_values[all_search_attr]:
-                            all_search_values[all_search_attr].remove(
-                                asset[all_search_attr]
-                            )
-                            if all_search_attr[-5:] == ".fqdn":
-                                dom_field = all_search_attr[: all_search_attr.find(".")]
-                                if dom_field + ".hostname" in all_search_values.keys():
-                                    hostname = asset[all_search_attr][
-                                        : asset[all_search_attr].find(".")
-                                    ]
-                                    if (
-                                        hostname
-                                        in all_search_values[dom_field + ".hostname"]
-                                    ):
-                                        all_search_values[
-                                            dom_field + ".hostname"
-                                        ].remove(hostname)
-                        if not all_search_values[all_search_attr]:
-                            all_search_values.pop(all_search_attr)
-                asset_id = None
-                if asset_id_field == "asset_id" and asset["asset_id"]:
-                    asset_id = asset["asset_id"]
-                elif asset_id_field != "asset_id" and asset[asset_id_field]["id"]:
-                    asset_id = asset[asset_id_field]["id"]
-                else:
+                if search:
+                    search.match(asset)
+                asset_id = _record_asset_id(asset, asset_id_field)
+                if not asset_id:
                     no_assets.append(asset)
                 if asset_id:
                     if asset_id not in asset_dict.keys():
@@ -509,18 +1006,27 @@ class AssetWorker:
                             "asset_info_is_answer_again"
                             not in asset_dict[asset_id]["asset_info"].keys()
                         ):
-                            asset_dict[asset_id]["asset_info"].update(
-                                {"asset_info_is_answer_again": [asset]}
-                            )
+                            # записи AssetStore общие с другими фильтрами (grid_cache)
+                            asset_dict[asset_id]["asset_info"] = asset_dict[asset_id][
+                                "asset_info"
+                            ].answered_again(asset)
                         else:
                             asset_dict[asset_id]["asset_info"][
                                 "asset_info_is_answer_again"
                             ].append(asset)
             file_name = "!take_assets.json"
             with (out_folder / file_name).open("w", encoding="utf-8") as token_file:
-                json.dump(asset_dict, token_file, ensure_ascii=False, indent=4)
+                json.dump(
+                    asset_dict,
+                    token_file,
+                    ensure_ascii=False,
+                    indent=4,
+                    default=json_default,
+                )
             file_name = "!take_no_asset_ids.json"
-            if all_search_values:
+            if search is not None:
+                all_search_values = search.not_found()
+            if any(all_search_values.values()):
                 self.logger.warning("not found by all_search_values:")
                 self.logger.warning(
                     json.dumps(all_search_values, indent=4, ensure_ascii=False)
@@ -530,7 +1036,13 @@ class AssetWorker:
                     all_search_values, prep_dict, no_assets
                 )
             with (out_folder / file_name).open("w", encoding="utf-8") as token_file:
-                json.dump(no_assets, token_file, ensure_ascii=False, indent=4)
+                json.dump(
+                    no_assets,
+                    token_file,
+                    ensure_ascii=False,
+                    indent=4,
+                    default=json_default,
+                )
             return asset_dict, no_assets
         else:
             if not all_search_values:
@@ -543,6 +1055,162 @@ class AssetWorker:
                 return {}, all_search_to_no_asset(all_search_values, prep_dict, [])
 
 
+class _AssetPages:
+    """
+    Страницы сетки активов, запрашиваемые параллельно: конец данных (первая короткая страница),
+    отдача страниц в on_page по порядку смещений и сборка записей в AssetStore. Страница
+    переносится в хранилище, как только получены все предыдущие, и дальше не хранится
+    """
+
+    def __init__(self, first_page, limit, on_page=None):
+        self.limit = limit
+        self.on_page = on_page
+        self.store = AssetStore()
+        self.pages = {}
+        # номер первой страницы за концом данных
+        self.end_page = None
+        self.failed = False
+        self.next_page = 1
+        self.next_emit = 0
+        self.add(0, first_page)
+
+    def need_more(self, running, threads):
+        return (
+            not self.failed
+            and running < threads
+            and (self.end_page is None or self.next_page < self.end_page)
+        )
+
+    def take_next(self):
+        page = self.next_page
+        self.next_page += 1
+        return page
+
+    def add(self, page, records):
+        """records None - страница не получена, запрос остальных прекращается"""
+        if records is None:
+            self.failed = True
+            return
+        if self.end_page is None or page < self.end_page:
+            if len(records) < self.limit:
+                self.end_page = page + 1
+        if page < self.next_emit:
+            return
+        if self.end_page is not None and page >= self.end_page:
+            return
+        self.pages[page] = records
+        while (
+            not self.failed
+            and self.next_emit in self.pages
+            and (self.end_page is None or self.next_emit < self.end_page)
+        ):
+            records = self.pages.pop(self.next_emit)
+            if self.on_page is not None:
+                self.on_page(records)
+            self.store.extend(records)
+            self.next_emit += 1
+
+    def done(self):
+        """Все страницы до конца данных получены"""
+        return self.end_page is not None and self.next_emit >= self.end_page
+
+    def records(self):
+        if self.failed:
+            return None
+        return self.store
+
+
+class _SearchIndex:
+    """
+    Хеш-индекс all_search_values фильтра: поле -> нормализованное значение (_search_key) ->
+    позиции ожидаемых значений в списке поля. Запись сетки проверяется поиском по словарю для
+    каждого поля, а не перебором всех ожидаемых значений. Как и list.remove раньше, совпадение
+    снимает одно ожидаемое значение (первое из одинаковых), а найденный FQDN - одно ожидаемое
+    короткое имя в поле .hostname того же домена
+    """
+
+    def __init__(self, all_search_values: dict):
+        self.values = {}
+        self.index = {}
+        for attr, values in all_search_values.items():
+            self.values[attr] = list(values)
+            by_key = self.index.setdefault(attr, {})
+            for position, value in enumerate(values):
+                by_key.setdefault(_search_key(attr, value), deque()).append(position)
+        # позиции найденных значений по полям
+        self.found = {attr: set() for attr in self.values}
+
+    def __bool__(self):
+        return bool(self.index)
+
+    def match(self, asset):
+        for attr in list(self.index):
+            value = asset.get(attr)
+            if self._drop(attr, _search_key(attr, value)) and attr[-5:] == ".fqdn":
+                hostname_attr = attr[: attr.find(".")] + ".hostname"
+                self._drop(hostname_attr, _search_key(hostname_attr, value))
+
+    def _drop(self, attr, key):
+        by_key = self.index.get(attr)
+        if by_key is None or key is None:
+            return False
+        try:
+            positions = by_key.get(key)
+        except TypeError:
+            # нехешируемое значение поля (список, словарь) ожидаемым не бывает
+            return False
+        if not positions:
+            return False
+        self.found[attr].add(positions.popleft())
+        if not positions:
+            by_key.pop(key)
+            if not by_key:
+                self.index.pop(attr)
+        return True
+
+    def not_found(self):
+        """Ненайденные значения: те же поля, что в all_search_values, значения в исходном порядке"""
+        return {
+            attr: [
+                value
+                for position, value in enumerate(values)
+                if position not in self.found.get(attr, ())
+            ]
+            for attr, values in self.values.items()
+        }
+
+
+def _search_key(attr, value):
+    """
+    Ключ значения all_search_values: строка без регистра и точки в конце FQDN, для полей
+    .hostname - короткое имя (первая часть FQDN). IP-адреса не сокращаются
+    """
+    if not isinstance(value, str):
+        return value
+    key = value.strip().rstrip(".").lower()
+    if attr[-9:] == ".hostname" and "." in key and not _IPV4.match(key):
+        key = key[: key.find(".")]
+    return key
+
+
+def _record_asset_id(asset, asset_id_field):
+    """ID актива из записи сетки или None для строк без актива"""
+    if asset_id_field == "asset_id":
+        return asset["asset_id"] or None
+    return asset[asset_id_field]["id"] or None
+
+
+def dynamic_filter_names(pdql):
+    """Имена фильтров (папок), на активы которых ссылаются <dynamic!{...}dynamic!> в PDQL"""
+    filter_names = []
+    for dyn_filter in re.findall("<dynamic!({.*?})dynamic!>", pdql, flags=re.S):
+        try:
+            filter_names.append(json.loads(dyn_filter)["filter_name"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return filter_names
+
+
 def switch_and_clear_filter(
     static_filter, key_field, main_field, dm_fields, dyn_filter, main_values
 ):
@@ -586,22 +1254,9 @@ def work_with_dynamic(dyn_filter: dict, out_folder: Path, logger: logging.Logger
     dm_fields = {}
     out_folder = out_folder.parent
     out_folder = out_folder / dyn_filter["filter_name"]
-    if not out_folder.is_dir() or not (out_folder / "!take_assets.json").is_file():
-        logger.info(
-            f"no folder {dyn_filter['filter_name']} in {out_folder} or no file with assets"
-        )
+    assets = _read_taken_records(out_folder, dyn_filter["filter_name"], logger)
+    if assets is None:
         return "", {}
-    assets = []
-    # TODO а почему мы не берем !take_assets.json?
-    for assets_file_path in out_folder.glob("take_assets_*.json"):
-        with assets_file_path.open("r", encoding="utf-8") as assets_file:
-            records = json.load(assets_file)
-            if (
-                "records" in records.keys()
-                and type(records["records"]) is list
-                and len(records["records"]) > 0
-            ):
-                assets.extend(records["records"])
     if not assets:
         logger.info(f"no assets in {dyn_filter['filter_name']}")
         return "", {}
@@ -615,42 +1270,36 @@ def work_with_dynamic(dyn_filter: dict, out_folder: Path, logger: logging.Logger
         main_field = dyn_filter["filter"][
             dyn_filter["filter"].find("<") + 1 : dyn_filter["filter"].find(">")
         ]
+    # выражение prefix компилируется один раз, а не eval на каждую запись
+    transform = None
+    if pref_com and pref_com != "main_value":
+        transform = eval("lambda main_value: " + pref_com)
 
     main_values_dict = False
     if "need_dict" in dyn_filter.keys() and dyn_filter["need_dict"]:
         main_values_dict = True
-        main_values = {dict_key: [] for dict_key in dyn_filter["dict_keys"]}
+        # dict как упорядоченное множество: порядок первого появления, проверка за O(1)
+        found = {dict_key: {} for dict_key in dyn_filter["dict_keys"]}
     else:
         main_values = []
 
+    seen = set()
     for asset in assets:
         main_value = asset[main_field]
-        if pref_com:
-            main_value = eval(pref_com)
-        if main_values_dict and dyn_filter["dict_keys"] == [
-            "hostnames",
-            "FQDNs",
-            "IPs",
-        ]:
-            if re.search("^\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}$", main_value):
-                if main_value not in main_values["IPs"] and main_value != "127.0.0.1":
-                    main_values["IPs"].append(main_value)
-            elif main_value.find(".") != -1:
-                if main_value not in main_values["FQDNs"]:
-                    main_values["FQDNs"].append(main_value)
-                if main_value.split(".")[0] not in main_values["hostnames"]:
-                    main_values["hostnames"].append(main_value.split(".")[0])
-            else:
-                if (
-                    main_value not in main_values["hostnames"]
-                    and main_value != "localhost"
-                ):
-                    main_values["hostnames"].append(main_value)
-        elif main_values_dict and dyn_filter["dict_keys"] == ["asset_ids"]:
-            if main_value not in main_values["asset_ids"]:
-                main_values["asset_ids"].append(main_value)
-        else:
+        if transform is not None:
+            main_value = transform(main_value)
+        if not main_values_dict:
             main_values.append(main_value)
+            continue
+        if main_value in seen:
+            continue
+        seen.add(main_value)
+        if dyn_filter["dict_keys"] == ["hostnames", "FQDNs", "IPs"]:
+            _classify_host(main_value, found)
+        elif dyn_filter["dict_keys"] == ["asset_ids"]:
+            found["asset_ids"][main_value] = None
+    if main_values_dict:
+        main_values = {dict_key: list(values) for dict_key, values in found.items()}
     if main_values_dict and dyn_filter["dict_keys"] == ["hostnames", "FQDNs", "IPs"]:
         static_filter = dyn_filter["filter"]
         for key_field in dyn_filter["dict_keys"]:
@@ -669,17 +1318,80 @@ def work_with_dynamic(dyn_filter: dict, out_folder: Path, logger: logging.Logger
     return static_filter, main_values
 
 
+def _classify_host(main_value, found):
+    """Адрес из dynamic-фильтра в IPs, FQDNs (и hostnames из первой части FQDN) или hostnames"""
+    if _IPV4.match(main_value):
+        if main_value != "127.0.0.1":
+            found["IPs"][main_value] = None
+    elif main_value.find(".") != -1:
+        found["FQDNs"][main_value] = None
+        found["hostnames"][main_value.split(".")[0]] = None
+    elif main_value != "localhost":
+        found["hostnames"][main_value] = None
+
+
+def _read_taken_records(out_folder: Path, filter_name, logger: logging.Logger):
+    """
+    Записи сетки активов фильтра: этого запуска - из памяти (_kept_records), предыдущего -
+    из страниц take_assets_*.json его папки. None - папки или активов фильтра нет
+    """
+    records = _kept_records.get(out_folder)
+    if records is not None:
+        return records
+    if not out_folder.is_dir() or not (out_folder / "!take_assets.json").is_file():
+        logger.info(f"no folder {filter_name} in {out_folder} or no file with assets")
+        return None
+    assets = []
+    for assets_file_path in sorted(
+        out_folder.glob("take_assets_*.json"),
+        key=lambda path: int(path.stem[len("take_assets_") :]),
+    ):
+        with assets_file_path.open("r", encoding="utf-8") as assets_file:
+            records = json.load(assets_file)
+            if (
+                "records" in records.keys()
+                and type(records["records"]) is list
+                and len(records["records"]) > 0
+            ):
+                assets.extend(records["records"])
+    return assets
+
+
 def all_search_to_no_asset(all_search_values: dict, prep_dict: dict, no_assets: list):
-    for all_search_attr in list(all_search_values.keys()).copy():
-        for value in all_search_values[all_search_attr]:
-            app_dict = deepcopy(prep_dict)
+    """
+    Строки без актива для ненайденных all_search_values. Короткое имя ненайденного FQDN
+    пишется и в строку FQDN, одно на FQDN. Как и раньше, строкой своего поля .hostname
+    выводятся значения, не взятые в строки FQDN до того, как до поля дошла очередь
+    """
+    # поле .hostname -> _search_key -> значения, которые еще можно взять в строку FQDN
+    pending = {}
+    for attr, values in all_search_values.items():
+        if attr[-9:] == ".hostname":
+            by_key = pending[attr] = {}
+            for value in values:
+                by_key.setdefault(_search_key(attr, value), deque()).append(value)
+    # поле .hostname -> сколько раз значение уже взято в строки FQDN
+    taken = {attr: Counter() for attr in pending}
+    for all_search_attr, values in all_search_values.items():
+        hostname_attr = None
+        if all_search_attr[-5:] == ".fqdn":
+            hostname_attr = all_search_attr[: all_search_attr.find(".")] + ".hostname"
+        skip = Counter(taken.get(all_search_attr, {}))
+        for value in values:
+            if skip[value] > 0:
+                # взятое значение снималось из списка первым из одинаковых
+                skip[value] -= 1
+                continue
+            app_dict = dict(prep_dict)
             app_dict[all_search_attr] = value
-            if all_search_attr[-5:] == ".fqdn":
-                dom_field = all_search_attr[: all_search_attr.find(".")]
-                if dom_field + ".hostname" in all_search_values.keys():
-                    hostname = value[: value.find(".")]
-                    if hostname in all_search_values[dom_field + ".hostname"]:
-                        all_search_values[dom_field + ".hostname"].remove(hostname)
-                        app_dict[dom_field + ".hostname"] = hostname
+            hostnames = None
+            if hostname_attr in pending:
+                hostnames = pending[hostname_attr].get(
+                    _search_key(hostname_attr, value)
+                )
+            if hostnames:
+                hostname = hostnames.popleft()
+                taken[hostname_attr][hostname] += 1
+                app_dict[hostname_attr] = hostname
             no_assets.append(app_dict)
     return no_assets
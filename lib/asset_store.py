@@ -0,0 +1,132 @@
+import json
+from array import array
+from collections.abc import Mapping
+
+# ключ повторов актива в asset_info, см. AssetWorker.take_assets и xlsx_out._asset_info_to_list
+ANSWER_AGAIN = "asset_info_is_answer_again"
+
+
+class AssetStore:
+    """
+    Записи сетки активов в компактном виде. Каждое уникальное значение поля хранится один раз
+    (интернирование), строка - array индексов значений по колонкам, 0 - поля в записи нет.
+    Итерация отдает AssetRow, которые читаются как dict, значения берутся из хранилища по полю
+    при обращении, поэтому отчету, которому нужно одно поле, не нужна вся запись
+    """
+
+    __slots__ = ("columns", "column_index", "values", "value_index", "rows")
+
+    def __init__(self, records=None):
+        # имена полей в порядке первого появления
+        self.columns = []
+        self.column_index = {}
+        self.values = [None]
+        self.value_index = {}
+        self.rows = []
+        if records:
+            self.extend(records)
+
+    def extend(self, records):
+        """Добавление записей сетки (dict), сами записи после этого можно не хранить"""
+        for record in records:
+            row = array("I", [0]) * len(self.columns)
+            for name, value in record.items():
+                column = self.column_index.get(name)
+                if column is None:
+                    column = len(self.columns)
+                    self.column_index[name] = column
+                    self.columns.append(name)
+                    row.append(0)
+                row[column] = self._intern(value)
+            self.rows.append(row)
+
+    def _intern(self, value):
+        if type(value) is str:
+            # строки - самые частые значения, ключом служат сами
+            key = value
+        elif isinstance(value, (dict, list)):
+            key = (dict, json.dumps(value, sort_keys=True, ensure_ascii=False))
+        else:
+            key = (type(value), value)
+        index = self.value_index.get(key)
+        if index is None:
+            index = len(self.values)
+            self.value_index[key] = index
+            self.values.append(value)
+        return index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for index in range(len(self.rows)):
+            yield AssetRow(self, index)
+
+    def __getitem__(self, index):
+        return AssetRow(self, range(len(self.rows))[index])
+
+    def summary(self):
+        return {
+            "rows": len(self.rows),
+            "columns": len(self.columns),
+            "unique_values": len(self.values) - 1,
+        }
+
+
+class AssetRow(Mapping):
+    """
+    Запись AssetStore только для чтения с интерфейсом dict. again - повторы того же актива
+    в ответе сетки (asset_info_is_answer_again)
+    """
+
+    __slots__ = ("store", "index", "again")
+
+    def __init__(self, store: AssetStore, index, again=None):
+        self.store = store
+        self.index = index
+        self.again = again
+
+    def __getitem__(self, name):
+        if name == ANSWER_AGAIN and self.again is not None:
+            return self.again
+        column = self.store.column_index.get(name)
+        row = self.store.rows[self.index]
+        if column is None or column >= len(row) or not row[column]:
+            raise KeyError(name)
+        return self.store.values[row[column]]
+
+    def keys(self):
+        row = self.store.rows[self.index]
+        keys = [
+            column_name
+            for column_name, value_index in zip(self.store.columns, row)
+            if value_index
+        ]
+        if self.again is not None:
+            keys.append(ANSWER_AGAIN)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def answered_again(self, asset):
+        """Копия записи с первым повтором актива, сама запись общая и не меняется"""
+        return AssetRow(self.store, self.index, [asset])
+
+    def to_dict(self):
+        return {name: self[name] for name in self.keys()}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+def json_default(value):
+    """default для json.dump выводов с записями AssetStore"""
+    if isinstance(value, AssetRow):
+        return value.to_dict()
+    if isinstance(value, AssetStore):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
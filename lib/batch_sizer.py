@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+
+from .events import ROWS_LIMIT
+from .run_stats import run_stats
+from .settings_checker import Settings
+
+
+class BatchSizer:
+    """
+    Размер пачки активов (event_src.asset in [...]) для каждого фильтра при adaptive_uuids.
+    После каждого ответа размер делится пополам при ошибке, ответе больше половины limit(100000)
+    или дольше adaptive_uuids_latency, и удваивается после легкого ответа на полную пачку.
+    Размеры хранятся в state_folder/asset_batch_sizes.json и служат стартом следующего запуска.
+    """
+
+    settings: Settings
+    logger: logging.Logger
+    path: Path
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.settings.state_folder.mkdir(parents=True, exist_ok=True)
+        self.path = self.settings.state_folder / "asset_batch_sizes.json"
+        self.min_size = self.settings.adaptive_uuids_min
+        self.max_size = self.settings.adaptive_uuids_max
+        self.sizes = {}
+        self.changes = 0
+        if self.path.is_file():
+            try:
+                with self.path.open("r", encoding="utf-8") as sizes_file:
+                    self.sizes = json.load(sizes_file)
+            except (OSError, ValueError) as Err:
+                self.logger.warning(f"Broken asset batch sizes {self.path}: {Err}")
+
+    @staticmethod
+    def key(full_filter):
+        return hashlib.sha1(" ".join(full_filter.split()).encode("utf-8")).hexdigest()
+
+    def size(self, key):
+        size = self.sizes.get(key, {}).get(
+            "size", self.settings.max_uuids_in_siem_query
+        )
+        return min(max(size, self.min_size), self.max_size)
+
+    def feedback(self, key, policy, batch_size, ok, rows, seconds):
+        """Подстройка размера по ответу на пачку из batch_size активов"""
+        size = self.size(key)
+        latency_target = self.settings.adaptive_uuids_latency
+        if (
+            not ok
+            or rows >= ROWS_LIMIT // 2
+            or (latency_target and seconds > latency_target)
+        ):
+            new_size = max(self.min_size, min(size, batch_size) // 2)
+        elif (
+            batch_size >= size
+            and rows < ROWS_LIMIT // 8
+            and (not latency_target or seconds < latency_target / 4)
+        ):
+            new_size = min(self.max_size, size * 2)
+        else:
+            new_size = size
+        if new_size != size:
+            self.changes += 1
+            self.logger.debug(
+                f"Asset batch size for {policy['name']} #{policy['number']}: {size} -> {new_size} "
+                f"({rows} rows, {seconds:.1f}s)"
+            )
+        self.sizes[key] = {
+            "name": f"{policy['name']} #{policy['number']}",
+            "size": new_size,
+            "updated": int(time.time()),
+        }
+
+    def save(self):
+        with self.path.open("w", encoding="utf-8") as sizes_file:
+            json.dump(self.sizes, sizes_file, ensure_ascii=False, indent=4)
+
+    def summary(self):
+        sizes = [self.size(key) for key in self.sizes.keys()]
+        return {
+            "filters": len(sizes),
+            "changes": self.changes,
+            "min_size": min(sizes, default=0),
+            "max_size": max(sizes, default=0),
+        }
+
+
+_sizer = None
+
+
+def get_batch_sizer(settings, logger: logging.Logger):
+    """Общие на весь запуск размеры пачек или None, если adaptive_uuids выключен"""
+    global _sizer
+    if not settings.adaptive_uuids:
+        return None
+    if _sizer is None:
+        _sizer = BatchSizer(settings, logger)
+        run_stats.sections["asset_batch_sizes"] = _sizer
+    return _sizer
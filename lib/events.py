@@ -6,30 +6,62 @@ import time
 import warnings
 from copy import deepcopy
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 from venv import logger
 
 import requests
 import xlsxwriter
-from aiohttp import ClientSession, client_exceptions
+from aiohttp import ClientSession, ClientTimeout, client_exceptions
 from tqdm.asyncio import tqdm
 
+from .adaptive_limiter import AdaptiveLimiter, get_limiter
+from .asset_store import json_default
 from .get_token import MPXAuthenticator
 from .policies_checker import EventPolicies
+from .query_cache import QueryCache, get_query_cache
+from .query_history import QueryHistory, QueryTimer, get_query_history
+from .query_planner import FanInQuery, fan_in_key, plan_fan_in
+from .retry_policy import RetryPolicy, get_retry_policy
+from .run_stats import run_stats
 from .settings_checker import Settings
 from .xlsx_out import MonitorXlsxWriter
 
+if TYPE_CHECKING:
+    from .batch_sizer import BatchSizer
+    from .events_matrix import EventsMatrix
+    from .incremental import IncrementalState
+    from .run_manifest import RunManifest
+
 warnings.filterwarnings("ignore")
+# limit(...) в конце full_filter из EventPolicies.filter_policies
+ROWS_LIMIT = 100000
+
+
+class ResultTruncated(Exception):
+    """Ответ агрегации уперся в limit, часть групп (актив, хост) потеряна"""
+
+    def __init__(self, rows):
+        super().__init__(f"{len(rows)} rows")
+        self.rows_count = len(rows)
+        self.host_ids = _rows_to_host_ids(rows)
 
 
 class EventsWorker:
     """Класс запроса событий из SIEM"""
 
-    semaphore: asyncio.Semaphore
+    semaphore: AdaptiveLimiter
     settings: Settings
     logger: logging.Logger
     policies: EventPolicies
     auth: MPXAuthenticator
     async_session: ClientSession
+    events_matrix: Optional["EventsMatrix"]
+    incremental: Optional["IncrementalState"]
+    batch_sizer: Optional["BatchSizer"]
+    run_manifest: "RunManifest"
+    query_cache: Optional[QueryCache]
+    query_history: Optional[QueryHistory]
+    retry: RetryPolicy
 
     def __init__(
         self,
@@ -45,9 +77,9 @@ class EventsWorker:
     ):
         self.settings = settings
         self.logger = logger
-        self.policies = policies
-        self.semaphore = asyncio.Semaphore(self.settings.max_threads_for_siem_api)
+        self.policies = policies.view()
         self.auth = auth
+        self._init_shared()
         self.policies.filter_policies(pol_blacklist, pol_whitelist, pol_spec, mand_pols)
         if assets:
             audit_pol = {
@@ -64,80 +96,505 @@ class EventsWorker:
                 {audit_pol["name"]: {audit_pol["filter"]: {}}}
             )
 
+    def _init_shared(self):
+        """
+        Общие на запуск лимитер, политика повторов, кэши, история, манифест и подбор
+        пачек. Вызывается и из EventsMatrix, чтобы атрибуты наследника не расходились
+        """
+        self.semaphore = get_limiter(self.settings, self.logger, "events")
+        self.retry = get_retry_policy(self.settings, self.logger)
+        self.events_matrix = None
+        self.query_cache = get_query_cache(self.settings, self.logger)
+        self.query_history = get_query_history(self.settings, self.logger)
+        self.query_seconds = {}
+        self.limit_splits = {}
+        self.incremental = None
+        if self.settings.incremental:
+            from .incremental import get_incremental_state
+
+            self.incremental = get_incremental_state(self.settings, self.logger)
+        from .batch_sizer import get_batch_sizer
+        from .run_manifest import get_run_manifest
+
+        self.batch_sizer = get_batch_sizer(self.settings, self.logger)
+        self.run_manifest = get_run_manifest(self.settings, self.logger)
+
     async def work(self, group_id, asset_ids, out_folder):
+        return await self.work_batches(group_id, [(asset_ids, out_folder)])
+
+    async def work_batches(self, group_id, batches):
+        """
+        Запрос событий по пачкам активов [(asset_ids, out_folder), ...] в одном event loop.
+        Запросы всех пачек ставятся в очередь сразу и идут через одну сессию с общим пулом соединений,
+        поэтому запросы пачки N+1 начинаются, как только освобождаются потоки пачки N.
+        Результаты пачек применяются по порядку, как при последовательном запуске.
+        """
+
+        async def batches_source():
+            for batch in batches:
+                yield batch
+
+        return await self.work_stream(group_id, batches_source())
+
+    async def work_stream(self, group_id, batches):
+        """
+        То же, что work_batches, но пачки приходят из асинхронного итератора (asset_pipeline):
+        запросы пачки ставятся в очередь, как только она собрана, пока следующие пачки еще собираются
+        """
         if self.policies.rebuilt_policies:
-            self.async_session = ClientSession(
-                cookies=self.auth.cookies, headers=self.auth.headers
-            )
-            time_from_value = (
-                int(time.time()) - self.settings.time_delta_hours * 60 * 60
+            self.async_session = self.auth.transport.open_session(
+                self.auth.headers, self.auth.cookies
             )
-            group_tasks = []
-            for index, policy in enumerate(self.policies.rebuilt_policies):
-                filter_new = policy["full_filter"]
-                if asset_ids:
-                    if policy["name"] != "Audit Events Hack":
-                        filter_new = create_new_filter(
-                            asset_ids, filter_new, "event_src"
+            try:
+                scheduled = []
+                probed = not self.settings.existence_probe
+                async for asset_ids, out_folder in batches:
+                    if not probed and asset_ids:
+                        await self._probe_existence(group_id)
+                        probed = True
+                    scheduled.append(
+                        (
+                            asset_ids,
+                            out_folder,
+                            self._schedule_batch(group_id, asset_ids, out_folder),
                         )
-                        temp_time_from = time_from_value
-                    else:
-                        filter_new = create_new_filter(asset_ids, filter_new, "dst")
-                        temp_time_from = int(time.time()) - 700 * 60 * 60
-                else:
+                    )
+                for asset_ids, out_folder, (group_tasks, query_indexes) in scheduled:
+                    unique_results = await self._gather_until_deadline(group_tasks)
+                    self._apply_batch_results(
+                        unique_results, query_indexes, asset_ids, out_folder
+                    )
+                    if len(scheduled) > 1:
+                        self.logger.info(f"{out_folder.name} done")
+                    self.logger.info(
+                        f"SIEM API concurrency limit: {self.semaphore.limit}"
+                    )
+            finally:
+                await self.auth.transport.close_session(self.async_session)
+                if self.incremental is not None:
+                    self.incremental.save()
+                if self.query_history is not None:
+                    self.query_history.save()
+                if self.batch_sizer is not None:
+                    self.batch_sizer.save()
+            return self.policies
+        else:
+            return [], {}
+
+    def _time_window(self):
+        # окно общее на весь запуск, чтобы при resume совпали ключи выполненных запросов
+        now = self.run_manifest.time_to
+        if self.incremental is not None:
+            now = self.incremental.time_to
+        elif self.query_cache is not None:
+            now = QueryCache.align(now)
+        return now, now - self.settings.time_delta_hours * 60 * 60
+
+    async def _probe_existence(self, group_id):
+        """
+        Предварительный проход existence_probe: каждый фильтр запрашивается один раз без ограничения
+        по активам с limit(1). Фильтры без событий во всем окне не запрашиваются по пачкам активов,
+        результат проверки общий на весь запуск
+        """
+        _, time_from = self._time_window()
+        probes = {}
+        for policy in self.policies.rebuilt_policies:
+            if policy["name"] == "Audit Events Hack" or (
+                self.events_matrix is not None
+                and policy["full_filter"] in self.events_matrix.matrix
+            ):
+                continue
+            probe_key = _existence_key(policy["full_filter"], group_id, time_from)
+            if probe_key not in run_stats.existence:
+                probes[probe_key] = policy
+        if not probes:
+            return
+        self.logger.info(f"Existence probe for {len(probes)} filters")
+        param = _group_param(group_id)
+        time_to = int(time.time())
+        probe_paths = [
+            Path(f"probe_{policy['name']}_{policy['number']}")
+            for policy in probes.values()
+        ]
+        probe_results = await self._gather_until_deadline(
+            [
+                asyncio.create_task(
+                    self._take_window(
+                        param,
+                        re.sub(r"limit\(\d+\)\s*$", "limit(1)", policy["full_filter"]),
+                        time_from,
+                        time_to,
+                        probe_path,
+                        True,
+                    )
+                )
+                for policy, probe_path in zip(probes.values(), probe_paths)
+            ]
+        )
+        for probe_key, probe_path, probe_result in zip(
+            probes.keys(), probe_paths, probe_results
+        ):
+            self.query_seconds.pop(probe_path, None)
+            # ошибка или отмена проверки - фильтр запрашивается как обычно
+            run_stats.existence[probe_key] = (
+                probe_result is None or not probe_result[0] or bool(probe_result[1])
+            )
+        empty = [key for key in probes if not run_stats.existence[key]]
+        self.logger.info(
+            f"Existence probe: {len(empty)} of {len(probes)} filters have no events, "
+            f"skipped in asset batches"
+        )
+
+    def _schedule_batch(self, group_id, asset_ids, out_folder):
+        now, time_from_value = self._time_window()
+        task_queries = []
+        task_policies = []
+        # одинаковые фильтры из разных политик запрашиваются один раз, результат раздается всем
+        unique_queries = {}
+        query_indexes = []
+        for index, policy in enumerate(self.policies.rebuilt_policies):
+            filter_new = policy["full_filter"]
+            if asset_ids:
+                if policy["name"] != "Audit Events Hack":
+                    asset_field = "event_src"
                     temp_time_from = time_from_value
+                else:
+                    asset_field = "dst"
+                    temp_time_from = now - 700 * 60 * 60
+                filter_new = create_new_filter(asset_ids, filter_new, asset_field)
+            else:
+                asset_field = "event_src"
+                temp_time_from = time_from_value
+            from_matrix = (
+                self.events_matrix is not None
+                and policy["full_filter"] in self.events_matrix.matrix
+            )
+            query_key = (
+                from_matrix,
+                normalize_filter(filter_new),
+                temp_time_from,
+                str(group_id),
+            )
+            if query_key in unique_queries:
+                self.logger.debug(
+                    f"{policy['name']} filter {policy['number']} reuses the same query"
+                )
+                query_indexes.append(unique_queries[query_key])
+                continue
+            unique_queries[query_key] = len(task_queries)
+            query_indexes.append(len(task_queries))
+            task_policies.append(policy)
+            source = "matrix" if from_matrix else None
+            if (
+                asset_ids
+                and not from_matrix
+                and policy["name"] != "Audit Events Hack"
+                and run_stats.existence.get(
+                    _existence_key(policy["full_filter"], group_id, temp_time_from)
+                )
+                is False
+            ):
+                source = "empty"
+            task_queries.append((filter_new, temp_time_from, asset_field, source))
+        self.logger.info(
+            f"Queries dedup: {len(task_queries)} unique of {len(query_indexes)} total"
+        )
+        fan_in_parts = {}
+        if self.settings.query_fan_in:
+            fan_in_parts = self._plan_fan_in(task_policies, task_queries)
+        group_tasks = []
+        for task_index, (
+            filter_new,
+            temp_time_from,
+            asset_field,
+            source,
+        ) in enumerate(task_queries):
+            policy = task_policies[task_index]
+            if source == "empty":
+                # existence_probe не нашел событий фильтра во всем окне
+                group_tasks.append(self._no_events())
+            elif source == "matrix":
+                # запрос уже выполнен для всего запуска, берем срез матрицы по активам пачки
                 group_tasks.append(
-                    asyncio.create_task(
-                        self.take_events(
-                            group_id, temp_time_from, filter_new, out_folder, policy
-                        )
+                    self.events_matrix.take_events_from_matrix(
+                        policy["full_filter"], asset_ids
                     )
                 )
-            results = await tqdm.gather(*group_tasks)
-            for index, policy in enumerate(self.policies.rebuilt_policies):
-                if "host_ids" not in self.policies.rebuilt_policies[index].keys():
-                    self.policies.rebuilt_policies[index].update(
-                        {"host_ids": results[index]}
+            elif task_index in fan_in_parts:
+                group_tasks.append(self._fan_in_part(*fan_in_parts[task_index]))
+            else:
+                group_tasks.append(
+                    self.take_events(
+                        group_id,
+                        temp_time_from,
+                        filter_new,
+                        out_folder,
+                        policy,
+                        asset_ids,
+                        asset_field,
                     )
-                else:
-                    for host in results[index]:
-                        self.policies.rebuilt_policies[index]["host_ids"].update(
-                            {host: results[index][host]}
-                        )
-                # break
-            with (out_folder / "!out_all.json").open("w", encoding="utf-8") as out_file:
-                json.dump(
-                    self.policies.rebuilt_policies,
-                    out_file,
-                    ensure_ascii=False,
-                    indent=4,
                 )
-            with (out_folder / "!small_policies.json").open(
-                "w", encoding="utf-8"
-            ) as out_file:
-                json.dump(
-                    self.policies.small_policies, out_file, ensure_ascii=False, indent=4
+        # задачи встают в очередь ограничителя в порядке создания
+        for task_index in self._query_order(task_policies):
+            if task_index in fan_in_parts:
+                fan_in = fan_in_parts[task_index][0]
+                if fan_in.task is None:
+                    fan_in.task = asyncio.create_task(
+                        self.take_fan_in(
+                            group_id, time_from_value, fan_in, out_folder, asset_ids
+                        )
+                    )
+            group_tasks[task_index] = asyncio.create_task(group_tasks[task_index])
+        return group_tasks, query_indexes
+
+    def _plan_fan_in(self, task_policies, task_queries):
+        """Группы фильтров для общих запросов (query_fan_in): {индекс задачи: (группа, позиция)}"""
+        if self.incremental is not None:
+            return {}
+        fan_ins = plan_fan_in(
+            [
+                (task_index, policy)
+                for task_index, policy in enumerate(task_policies)
+                if task_queries[task_index][3] is None
+                and policy["name"] != "Audit Events Hack"
+            ]
+        )
+        fan_in_parts = {}
+        for fan_in in fan_ins:
+            for position, (task_index, _, _) in enumerate(fan_in.members):
+                fan_in_parts[task_index] = (fan_in, position)
+        if fan_ins:
+            self.logger.info(
+                f"Query fan-in: {len(fan_in_parts)} filters merged into {len(fan_ins)} queries, "
+                f"{len(task_queries) - len(fan_in_parts) + len(fan_ins)} queries left"
+            )
+        return fan_in_parts
+
+    def _query_order(self, task_policies):
+        """
+        Порядок запуска запросов: сначала mandatory_policies и specific_politics,
+        затем по истории длительности от самых долгих к быстрым
+        """
+
+        def priority(task_index):
+            policy = task_policies[task_index]
+            expected = 0.0
+            if self.query_history is not None:
+                expected = self.query_history.expected(policy)
+            return policy["name"] not in self.policies.mandatory_policies, -expected
+
+        return sorted(range(len(task_policies)), key=priority)
+
+    async def _gather_until_deadline(self, group_tasks):
+        """
+        Ожидание запросов пачки до границы max_run_seconds. Невыполненные к границе запросы
+        отменяются, вместо их результата возвращается None
+        """
+        remaining = run_stats.remaining()
+        if remaining is None:
+            return await tqdm.gather(*group_tasks)
+        try:
+            return await asyncio.wait_for(tqdm.gather(*group_tasks), remaining)
+        except asyncio.TimeoutError:
+            # tqdm.gather не отменяет переданные задачи сам
+            for task in group_tasks:
+                task.cancel()
+            await asyncio.gather(*group_tasks, return_exceptions=True)
+        run_stats.deadline_reached = True
+        cancelled = [task for task in group_tasks if task.cancelled()]
+        if cancelled:
+            self.logger.warning(
+                f"Run deadline reached: {len(cancelled)} of {len(group_tasks)} queries cancelled, "
+                f"their filters are marked as not measured"
+            )
+        return [None if task.cancelled() else task.result() for task in group_tasks]
+
+    def _apply_batch_results(
+        self, unique_results, query_indexes, asset_ids, out_folder
+    ):
+        results = []
+        used_results = set()
+        for index, query_index in enumerate(query_indexes):
+            if unique_results[query_index] is None:
+                # запрос отменен по max_run_seconds: активы пачки не измерены, а не без событий
+                self.policies.rebuilt_policies[index].setdefault(
+                    "not_measured", []
+                ).extend(asset_ids or ["*"])
+                results.append({})
+                continue
+            # host_ids дальше дополняются по месту, поэтому повторам отдаем копию
+            if query_index in used_results:
+                results.append(deepcopy(unique_results[query_index]))
+            else:
+                used_results.add(query_index)
+                results.append(unique_results[query_index])
+        for index, policy in enumerate(self.policies.rebuilt_policies):
+            if "host_ids" not in self.policies.rebuilt_policies[index].keys():
+                self.policies.rebuilt_policies[index].update(
+                    {"host_ids": results[index]}
                 )
-            await self.async_session.close()
-            return self.policies
+            else:
+                for host in results[index]:
+                    self.policies.rebuilt_policies[index]["host_ids"].update(
+                        {host: results[index][host]}
+                    )
+            # break
+        with (out_folder / "!out_all.json").open("w", encoding="utf-8") as out_file:
+            json.dump(
+                self.policies.rebuilt_policies,
+                out_file,
+                ensure_ascii=False,
+                indent=4,
+            )
+        with (out_folder / "!small_policies.json").open(
+            "w", encoding="utf-8"
+        ) as out_file:
+            json.dump(
+                self.policies.small_policies, out_file, ensure_ascii=False, indent=4
+            )
+
+    async def take_events(
+        self,
+        group_id,
+        time_from,
+        event_filter,
+        out_dir,
+        all_policy,
+        asset_ids=None,
+        asset_field="event_src",
+    ):
+        file_name = self._result_file_name(out_dir, all_policy)
+        filter_file_name = file_name[:-5] + ".txt"
+        file_path = out_dir / filter_file_name
+        data = {"filter": event_filter, "timeFrom": time_from}
+        param = _group_param(group_id)
+        resume_key = self.run_manifest.key(event_filter, param, time_from)
+        host_ids = self.run_manifest.take(resume_key)
+        if host_ids is not None:
+            self.logger.debug(f"{file_name} already done, resume from it")
+            return host_ids
+        with file_path.open("w", encoding="utf-8") as out_file:
+            temp_data_with_params = {"data": data, "params": param}
+            json.dump(temp_data_with_params, out_file, ensure_ascii=False, indent=4)
+            del temp_data_with_params
+        if self.incremental is not None:
+            all_ok, host_ids = await self._take_incremental(
+                param, all_policy, asset_ids, asset_field, time_from, file_path
+            )
         else:
-            return [], {}
+            all_ok, host_ids = await self._take_cached(
+                param,
+                event_filter,
+                time_from,
+                file_path,
+                all_policy,
+                asset_ids,
+                asset_field,
+            )
+        query_seconds = self.query_seconds.pop(file_path, None)
+        if self.query_history is not None and query_seconds is not None:
+            self.query_history.record(all_policy, query_seconds, all_ok)
+        if all_ok:
+            self._save_result(out_dir / file_name, all_policy, host_ids, resume_key)
+            # TODO возможно лучше прям тут заполнять все политики
+            return host_ids
+        elif self.incremental is not None:
+            # отчет по прошлому состоянию, но запрос не отмечается выполненным для resume
+            return host_ids
+        else:
+            return {}
 
-    async def take_events(self, group_id, time_from, event_filter, out_dir, all_policy):
-        url = "https://{}:443/api/events/v3/events/aggregation".format(
-            self.settings.mpx_host
+    async def take_fan_in(
+        self, group_id, time_from, fan_in: FanInQuery, out_dir, asset_ids
+    ):
+        """
+        Общий запрос группы фильтров (query_fan_in). Результат раздается по фильтрам группы
+        и сохраняется в их файлы так же, как от отдельных запросов
+        """
+        param = _group_param(group_id)
+        member_filters = [
+            (
+                create_new_filter(asset_ids, policy["full_filter"], "event_src")
+                if asset_ids
+                else policy["full_filter"]
+            )
+            for _, policy, _ in fan_in.members
+        ]
+        resume_keys = [
+            self.run_manifest.key(event_filter, param, time_from)
+            for event_filter in member_filters
+        ]
+        resumed = [self.run_manifest.take(resume_key) for resume_key in resume_keys]
+        if all(host_ids is not None for host_ids in resumed):
+            self.logger.debug(
+                f"Fan-in query {fan_in.number} already done, resume from it"
+            )
+            return resumed
+        fan_in_policy = {
+            "name": "fan_in",
+            "number": fan_in.number,
+            "filter": fan_in.filter(),
+            "full_filter": fan_in.full_filter(),
+            # деления по лимиту учитываются у фильтров группы: листа fan_in в отчете нет
+            "members": [policy for _, policy, _ in fan_in.members],
+        }
+        event_filter = fan_in_policy["full_filter"]
+        if asset_ids:
+            event_filter = create_new_filter(asset_ids, event_filter, "event_src")
+        file_path = out_dir / (
+            self._result_file_name(out_dir, fan_in_policy)[:-5] + ".txt"
         )
-        file_name = all_policy["name"].replace(" ", "_")
-        temp_policy = deepcopy(all_policy)
-        temp_policy["host_ids"] = {}
-        if "list_value" in temp_policy.keys():
-            file_name += "_" + temp_policy["list_value"]
+        with file_path.open("w", encoding="utf-8") as out_file:
+            json.dump(
+                {
+                    "data": {"filter": event_filter, "timeFrom": time_from},
+                    "params": param,
+                },
+                out_file,
+                ensure_ascii=False,
+                indent=4,
+            )
+        all_ok, host_ids = await self._take_cached(
+            param,
+            event_filter,
+            time_from,
+            file_path,
+            fan_in_policy,
+            asset_ids,
+            "event_src",
+        )
+        query_seconds = self.query_seconds.pop(file_path, None)
+        if self.query_history is not None and query_seconds is not None:
+            # время общего запроса делится поровну между фильтрами группы
+            share = query_seconds / len(fan_in.members)
+            for _, policy, _ in fan_in.members:
+                self.query_history.record(policy, share, all_ok)
+        if not all_ok:
+            return [{} for _ in fan_in.members]
+        parts = fan_in.split(host_ids)
+        for (_, policy, _), part, resume_key in zip(fan_in.members, parts, resume_keys):
+            file_name = self._result_file_name(out_dir, policy)
+            self._save_result(out_dir / file_name, policy, part, resume_key)
+        return parts
+
+    async def _no_events(self):
+        return {}
+
+    async def _fan_in_part(self, fan_in: FanInQuery, position):
+        """Доля фильтра в результате общего запроса"""
+        return (await fan_in.task)[position]
+
+    def _result_file_name(self, out_dir, policy):
+        """Свободное имя файла результата фильтра в out_dir"""
+        file_name = policy["name"].replace(" ", "_")
+        if "list_value" in policy.keys():
+            file_name += "_" + policy["list_value"]
         file_name = re.sub("[^a-zA-Zа-яА-я_ 0-9-]", "_", file_name)
         if len(file_name) > 35:
             file_name = file_name[:35]
         index = 0
         here = False
-        file_name += "_" + str(temp_policy["number"])
+        file_name += "_" + str(policy["number"])
         while True:
             file_name += ".json"
             if (out_dir / file_name).is_file():
@@ -150,40 +607,312 @@ class EventsWorker:
             else:
                 break
             index += 1
-        filter_file_name = file_name[:-5] + ".txt"
-        file_path = out_dir / filter_file_name
-        modified_delta = 0
+        return file_name
+
+    def _save_result(self, result_path: Path, policy, host_ids, resume_key):
+        temp_policy = deepcopy(policy)
+        temp_policy["host_ids"] = host_ids
+        with result_path.open("w", encoding="utf-8") as out_file:
+            json.dump(temp_policy, out_file, ensure_ascii=False, indent=4)
+        self.run_manifest.add(resume_key, result_path)
+
+    async def _take_cached(
+        self, param, event_filter, time_from, file_path, policy, asset_ids, asset_field
+    ):
+        """Запрос окна до текущего момента через query_cache, если он включен"""
+        cache_key = None
+        if self.query_cache is not None:
+            cache_key = self.query_cache.key(
+                "events", normalize_filter(event_filter), param, time_from
+            )
+            host_ids = self.query_cache.get(cache_key)
+            if host_ids is not None:
+                self.logger.debug(f"Query cache hit for {file_path.name}")
+                return True, host_ids
+        time_to = int(time.time())
+        if self.batch_sizer is not None and asset_ids:
+            all_ok, host_ids = await self._take_sized(
+                param, time_from, time_to, file_path, policy, asset_ids, asset_field
+            )
+        else:
+            all_ok, host_ids = await self._take_complete(
+                param,
+                event_filter,
+                time_from,
+                time_to,
+                file_path,
+                policy,
+                asset_ids,
+                asset_field,
+            )
+        if all_ok and cache_key is not None:
+            self.query_cache.put(cache_key, "events", host_ids)
+        return all_ok, host_ids
+
+    async def _take_sized(
+        self, param, time_from, time_to, file_path, policy, asset_ids, asset_field
+    ):
+        """
+        Запрос пачки активов частями по размеру пачки фильтра (adaptive_uuids),
+        размер подстраивается после ответа на каждую часть
+        """
+        key = self.batch_sizer.key(policy["full_filter"])
+        host_ids = {}
+        all_ok = True
+        start = 0
+        while start < len(asset_ids):
+            batch_size = self.batch_sizer.size(key)
+            part_assets = asset_ids[start : start + batch_size]
+            start += len(part_assets)
+            spent = self.query_seconds.get(file_path, 0.0)
+            part_ok, part_host_ids = await self._take_complete(
+                param,
+                create_new_filter(part_assets, policy["full_filter"], asset_field),
+                time_from,
+                time_to,
+                file_path,
+                policy,
+                part_assets,
+                asset_field,
+            )
+            self.batch_sizer.feedback(
+                key,
+                policy,
+                len(part_assets),
+                part_ok,
+                sum(
+                    len(asset_info["event_src.host"])
+                    for asset_info in part_host_ids.values()
+                ),
+                self.query_seconds.get(file_path, 0.0) - spent,
+            )
+            all_ok = all_ok and part_ok
+            _merge_host_ids(host_ids, part_host_ids)
+        return all_ok, host_ids
+
+    async def _take_incremental(
+        self, param, policy, asset_ids, asset_field, time_from, file_path
+    ):
+        """
+        Инкрементальный запрос: по каждому активу запрашивается только интервал от его отметки
+        до конца запуска частями по корзинам, результат собирается из корзин всего окна.
+        """
+        state = self.incremental
+        key = state.key(policy["full_filter"], param, asset_field)
+        all_ok = True
+        for query_from, group_assets in state.plan(key, asset_ids, time_from).items():
+            if asset_ids:
+                event_filter = create_new_filter(
+                    group_assets, policy["full_filter"], asset_field
+                )
+            else:
+                event_filter = policy["full_filter"]
+            pieces = state.pieces(query_from, state.time_to)
+            self.logger.debug(
+                f"Incremental query {file_path.name} for {len(group_assets)} assets: "
+                f"{(state.time_to - query_from) // 3600}h in {len(pieces)} pieces"
+            )
+            piece_results = await asyncio.gather(
+                *[
+                    self._take_complete(
+                        param,
+                        event_filter,
+                        piece_from,
+                        piece_to,
+                        file_path,
+                        policy,
+                        group_assets if asset_ids else None,
+                        asset_field,
+                        True,
+                    )
+                    for piece_from, piece_to in pieces
+                ]
+            )
+            if all(piece_ok for piece_ok, _ in piece_results):
+                for (piece_from, _), (_, piece_host_ids) in zip(pieces, piece_results):
+                    state.add(key, piece_from, piece_host_ids)
+                state.commit(key, group_assets)
+            else:
+                # отметку не двигаем, недостающий интервал будет запрошен в следующий раз
+                self.logger.warning(
+                    f"Incremental query {file_path.name} failed for {len(group_assets)} assets, "
+                    f"the report uses the previous state for them"
+                )
+                all_ok = False
+        # при ошибке host_ids - прошлое состояние, решение о нем принимает take_events
+        return all_ok, state.host_ids(key, asset_ids, time_from)
+
+    async def _take_complete(
+        self,
+        param,
+        event_filter,
+        time_from,
+        time_to,
+        file_path,
+        policy,
+        asset_ids,
+        asset_field,
+        shard=False,
+    ):
+        """
+        Запрос окна с дроблением ответов, уперевшихся в limit(100000): сначала пачка активов делится
+        пополам, для одного актива (или запроса без активов) пополам делится окно, пока каждая часть
+        не окажется меньше лимита. Части складываются обратно.
+        """
+        try:
+            return await self._take_window(
+                param, event_filter, time_from, time_to, file_path, shard
+            )
+        except ResultTruncated as Truncated:
+            truncated = Truncated
+        if asset_ids and len(asset_ids) > 1:
+            half = len(asset_ids) // 2
+            parts = [
+                (asset_ids[:half], time_from, time_to, shard),
+                (asset_ids[half:], time_from, time_to, shard),
+            ]
+            split_by = f"assets {half} + {len(asset_ids) - half}"
+        elif time_to - time_from > 60 * 60:
+            time_middle = time_from + (time_to - time_from) // 2
+            parts = [
+                (asset_ids, time_from, time_middle, True),
+                (asset_ids, time_middle, time_to, True),
+            ]
+            split_by = f"time {(time_to - time_from) // 3600}h in halves"
+        else:
+            self.logger.error(
+                f"{file_path.name}: {truncated.rows_count} rows hit limit({ROWS_LIMIT}) and can't be split "
+                f"further, result is truncated"
+            )
+            self._count_split(policy, truncated=True)
+            return True, truncated.host_ids
+        self.logger.warning(
+            f"{file_path.name}: {truncated.rows_count} rows hit limit({ROWS_LIMIT}), split by {split_by}"
+        )
+        self._count_split(policy)
+        part_results = await asyncio.gather(
+            *[
+                self._take_complete(
+                    param,
+                    (
+                        create_new_filter(
+                            part_assets, policy["full_filter"], asset_field
+                        )
+                        if part_assets
+                        else event_filter
+                    ),
+                    part_from,
+                    part_to,
+                    file_path,
+                    policy,
+                    part_assets,
+                    asset_field,
+                    part_shard,
+                )
+                for part_assets, part_from, part_to, part_shard in parts
+            ]
+        )
+        host_ids = {}
+        all_ok = True
+        for part_ok, part_host_ids in part_results:
+            all_ok = all_ok and part_ok
+            _merge_host_ids(host_ids, part_host_ids)
+        return all_ok, host_ids
+
+    def _count_split(self, policy, truncated=False):
+        """
+        Учет делений по лимиту для отчета фильтра и итоговой сводки запуска. Деления общего
+        запроса query_fan_in учитываются у каждого фильтра группы
+        """
+        for member in policy.get("members", [policy]):
+            split_key = (member["name"], str(member["number"]))
+            run_key = f"{member['name']} #{member['number']}"
+            splits = self.limit_splits.setdefault(
+                split_key, {"splits": 0, "truncated": False}
+            )
+            if truncated:
+                splits["truncated"] = True
+                run_stats.truncation["truncated"][run_key] = True
+            else:
+                splits["splits"] += 1
+                run_stats.truncation["splits"][run_key] = (
+                    run_stats.truncation["splits"].get(run_key, 0) + 1
+                )
+
+    async def _take_window(
+        self, param, event_filter, time_from, time_to, file_path, shard=False
+    ):
+        """
+        Запрос одного окна [time_from, time_to].
+        Без time_shards окно при ошибках урезается вдвое (старое поведение), с time_shards окно,
+        превысившее бюджет по длине или времени ответа, режется на части, которые запрашиваются
+        параллельно и складываются обратно, так что отчет покрывает весь запрошенный период.
+        """
+        url = "https://{}:443/api/events/v3/events/aggregation".format(
+            self.settings.mpx_host
+        )
+        sharding = self.settings.time_shards > 1
+        if sharding and not shard:
+            shards_num = _shards_for_window(
+                time_from, time_to, self.settings.time_shard_max_hours
+            )
+            if shards_num > 1:
+                return await self._take_shards(
+                    param, event_filter, time_from, time_to, file_path, shards_num
+                )
+        # части окна (шарды, корзины инкрементального режима, деление по лимиту) урезать нельзя
+        bounded = sharding or shard or self.incremental is not None
         data = {"filter": event_filter, "timeFrom": time_from}
-        if type(group_id) is str:
-            param = {"groupId": group_id}
+        if bounded:
+            data["timeTo"] = time_to
+        if sharding and self.settings.time_shard_timeout:
+            timeout = ClientTimeout(
+                total=self.settings.time_shard_timeout,
+                sock_connect=self.settings.http_connect_timeout,
+            )
         else:
-            param = {"groupIds": group_id}
-        with file_path.open("w", encoding="utf-8") as out_file:
-            temp_data_with_params = {"data": data, "params": param}
-            json.dump(temp_data_with_params, out_file, ensure_ascii=False, indent=4)
-            del temp_data_with_params
+            timeout = ClientTimeout(
+                total=10000000, sock_connect=self.settings.http_connect_timeout
+            )
+        modified_delta = 0
         try_number = 0
-        all_ok = False
         response = {}
-        async with self.semaphore:
-            while try_number < self.settings.reconnect_times:
-                try:
-                    try_number += 1
+        need_split = False
+        truncated_rows = None
+        while try_number < self.settings.reconnect_times:
+            retry_status = None
+            retry_after = None
+            try:
+                try_number += 1
+                await self.retry.wait()
+                async with self.semaphore, QueryTimer(self.query_seconds, file_path):
                     async with self.async_session.post(
                         url=url,
                         json=data,
                         params=param,
-                        ssl=False,
-                        timeout=10000000,
+                        timeout=timeout,
                     ) as response_temp:
+                        retry_status = response_temp.status
+                        retry_after = self.retry.retry_after(response_temp.headers)
                         if response_temp.status == 200:
                             response = await response_temp.json()
                             self.logger.debug(
                                 f"take_events response for {data}: {response}"
                             )
                             if not response["errors"]:
-                                all_ok = True
+                                self.retry.ok("events")
+                                if len(response["rows"]) < ROWS_LIMIT:
+                                    return True, _rows_to_host_ids(response["rows"])
+                                # выходим из ограничителя без исключения, это не перегрузка
+                                truncated_rows = response["rows"]
                                 break
+                            self.semaphore.overload("errors in response")
+                            if bounded:
+                                self.logger.warning(
+                                    f"Errors in take_events response for {file_path} in try number {try_number}: "
+                                    f"{response}."
+                                )
+                                need_split = True
                             else:
                                 if not modified_delta:
                                     modified_delta = self.settings.time_delta_hours // 2
@@ -195,10 +924,16 @@ class EventsWorker:
                                 self.logger.warning(
                                     f"Errors in take_events response for {file_path} in try number {try_number}: "
                                     f"{response}. The delta time for this query has been halved to {modified_delta}"
-                                    f". Next try after 5 seconds"
                                 )
-                                await asyncio.sleep(5)
+                        elif response_temp.status >= 500 and bounded:
+                            self.semaphore.overload(f"code {response_temp.status}")
+                            self.logger.warning(
+                                f"Response code: {response_temp.status} for {file_path}. Try number: {try_number} "
+                                f"of {self.settings.reconnect_times}"
+                            )
+                            need_split = True
                         elif response_temp.status >= 500:
+                            self.semaphore.overload(f"code {response_temp.status}")
                             if not modified_delta:
                                 modified_delta = self.settings.time_delta_hours // 2
                             else:
@@ -209,10 +944,16 @@ class EventsWorker:
                             self.logger.warning(
                                 f"Response code: {response_temp.status} for {file_path}. Try number: {try_number} "
                                 f"of {self.settings.reconnect_times} The delta time for this query has been halved "
-                                f"to {modified_delta}. Next try after 5 seconds"
+                                f"to {modified_delta}"
+                            )
+                        elif response_temp.status == 429:
+                            self.semaphore.overload("code 429")
+                            self.logger.warning(
+                                f"Response code: 429 for {file_path}, Retry-After: {retry_after}. "
+                                f"Try number: {try_number} of {self.settings.reconnect_times}"
                             )
-                            await asyncio.sleep(5)
                         elif response_temp.status == 400:
+                            self.retry.ok("events")
                             response = await response_temp.json()
                             self.logger.error(
                                 f"Response code: {response_temp.status}. Response message: {response['message']}."
@@ -223,7 +964,7 @@ class EventsWorker:
                             self.logger.error(
                                 f"Full response: {json.dumps(response, indent=4)}"
                             )
-                            break
+                            return False, {}
                         else:
                             response = await response_temp.json()
                             self.logger.error(
@@ -232,40 +973,76 @@ class EventsWorker:
                             self.logger.error(
                                 f"Full response: {json.dumps(response, indent=4)}"
                             )
-                            break
-                except requests.exceptions.RequestException as Err:
-                    self.logger.warning(
-                        f"Connection error, something went horribly wrong, let's try again. Error: {Err}"
-                    )
-                except client_exceptions.ContentTypeError as Err:
-                    self.logger.warning(
-                        f"Connection error, something went horribly wrong, let's try again. Error: {Err}"
+                            return False, {}
+            except asyncio.TimeoutError:
+                self.logger.warning(
+                    f"Timeout {timeout.total} seconds for {file_path}. Try number: {try_number}"
+                )
+                need_split = bounded
+            except requests.exceptions.RequestException as Err:
+                self.logger.warning(
+                    f"Connection error, something went horribly wrong, let's try again. Error: {Err}"
+                )
+            except client_exceptions.ClientError as Err:
+                self.logger.warning(
+                    f"Connection error, something went horribly wrong, let's try again. Error: {Err}"
+                )
+            if need_split:
+                shards_num = min(
+                    self.settings.time_shards, (time_to - time_from) // 3600
+                )
+                if shards_num > 1:
+                    return await self._take_shards(
+                        param, event_filter, time_from, time_to, file_path, shards_num
                     )
-        if all_ok:
-            if response["rows"]:
-                for row in response["rows"]:
-                    if row["groups"][0] not in temp_policy["host_ids"].keys():
-                        temp_policy["host_ids"].update(
-                            {
-                                row["groups"][0]: {
-                                    "count": row["values"][0],
-                                    "event_src.host": [row["groups"][1]],
-                                }
-                            }
-                        )
-                    else:
-                        temp_policy["host_ids"][row["groups"][0]]["count"] += row[
-                            "values"
-                        ][0]
-                        temp_policy["host_ids"][row["groups"][0]][
-                            "event_src.host"
-                        ].append(row["groups"][1])
-            with (out_dir / file_name).open("w", encoding="utf-8") as out_file:
-                json.dump(temp_policy, out_file, ensure_ascii=False, indent=4)
-            # TODO возможно лучше прям тут заполнять все политики
-            return temp_policy["host_ids"]
-        else:
-            return {}
+                need_split = False
+            if not await self.retry.sleep(
+                "events",
+                try_number,
+                file_path.name,
+                retry_status,
+                retry_after,
+            ):
+                break
+        if truncated_rows is not None:
+            raise ResultTruncated(truncated_rows)
+        return False, {}
+
+    async def _take_shards(
+        self, param, event_filter, time_from, time_to, file_path, shards_num
+    ):
+        """Параллельный запрос частей окна и сложение результатов"""
+        shards = _split_window(time_from, time_to, shards_num)
+        self.logger.info(
+            f"Split {file_path.name} window {(time_to - time_from) // 3600}h into {len(shards)} shards"
+        )
+        shard_results = await asyncio.gather(
+            *[
+                self._take_window(
+                    param, event_filter, shard_from, shard_to, file_path, True
+                )
+                for shard_from, shard_to in shards
+            ],
+            return_exceptions=True,
+        )
+        for shard_result in shard_results:
+            # упор в лимит любого шарда дробит все окно в _take_complete
+            if isinstance(shard_result, BaseException):
+                raise shard_result
+        host_ids = {}
+        all_ok = False
+        for (shard_from, shard_to), (shard_ok, shard_host_ids) in zip(
+            shards, shard_results
+        ):
+            if shard_ok:
+                all_ok = True
+                _merge_host_ids(host_ids, shard_host_ids)
+            else:
+                self.logger.error(
+                    f"Shard {shard_from}-{shard_to} of {file_path.name} not taken, "
+                    f"result does not cover the full window"
+                )
+        return all_ok, host_ids
 
     def make_readable_out(
         self,
@@ -285,28 +1062,20 @@ class EventsWorker:
             self.settings.time_delta_hours,
             need_up_file,
             self.logger,
+            self.settings.xlsx_streaming,
         )
-        excel_file.add_start_info(
-            self.policies.small_policies, asset_attrs, asset_filter_comment
-        )
-        for policy in self.policies.small_policies.keys():
-            if policy != "Audit Events Hack":
-                excel_file.prepare_pol_sheets(
-                    policy, self.policies.small_policies[policy], out_path
-                )
-        if self.policies.rebuilt_policies:
-            asset_dict = excel_file.create_asset_dict(
-                self.policies.rebuilt_policies, self.policies.small_policies, asset_dict
+        try:
+            self._fill_report(
+                excel_file,
+                out_path,
+                asset_attrs,
+                asset_dict,
+                no_assets,
+                asset_filter_comment,
             )
-        with (out_path / "!asset_dict.json").open("w", encoding="utf-8") as out_assets:
-            json.dump(asset_dict, out_assets, indent=4, ensure_ascii=False)
-        excel_file.work_with_asset_dict(
-            self.policies.small_policies,
-            asset_dict,
-            no_assets,
-            out_path,
-            self.policies.mandatory_policies,
-        )
+        finally:
+            # буфер xlsx_streaming не остается во временной папке, если отчет не построен
+            excel_file.drop_spool()
         closed = False
         for try_number in range(self.settings.reconnect_times):
             try:
@@ -329,6 +1098,56 @@ class EventsWorker:
             except Exception as Err:
                 pass
 
+    def _fill_report(
+        self,
+        excel_file: MonitorXlsxWriter,
+        out_path,
+        asset_attrs,
+        asset_dict,
+        no_assets,
+        asset_filter_comment,
+    ):
+        """Листы отчета make_readable_out до закрытия книги"""
+        excel_file.add_start_info(
+            self.policies.small_policies, asset_attrs, asset_filter_comment
+        )
+        for policy in self.policies.small_policies.keys():
+            if policy != "Audit Events Hack":
+                excel_file.prepare_pol_sheets(
+                    policy, self.policies.small_policies[policy], out_path
+                )
+        for (policy, number), splits in self.limit_splits.items():
+            if policy in excel_file.worksheets:
+                excel_file.mark_limit_splits(
+                    policy, int(number), splits["splits"], splits["truncated"]
+                )
+        not_measured = {}
+        for policy in self.policies.rebuilt_policies:
+            if policy.get("not_measured"):
+                numbers = not_measured.setdefault(policy["name"], {})
+                numbers[str(policy["number"])] = set(policy["not_measured"])
+        if self.policies.rebuilt_policies:
+            asset_dict = excel_file.create_asset_dict(
+                self.policies.rebuilt_policies, self.policies.small_policies, asset_dict
+            )
+        with (out_path / "!asset_dict.json").open("w", encoding="utf-8") as out_assets:
+            json.dump(
+                asset_dict,
+                out_assets,
+                indent=4,
+                ensure_ascii=False,
+                default=json_default,
+            )
+        excel_file.work_with_asset_dict(
+            self.policies.small_policies,
+            asset_dict,
+            no_assets,
+            out_path,
+            self.policies.mandatory_policies,
+            not_measured,
+        )
+        excel_file.finish()
+
 
 def create_new_filter(asset_ids, filter_new, field):
     filter_pref = "filter({}.asset in [".format(field)
@@ -343,3 +1162,74 @@ def create_new_filter(asset_ids, filter_new, field):
     else:
         filter_new = filter_pref + ") | " + filter_new
     return filter_new
+
+
+def _existence_key(full_filter, group_id, time_from):
+    return normalize_filter(full_filter), str(group_id), time_from
+
+
+def _group_param(group_id):
+    if type(group_id) is str:
+        return {"groupId": group_id}
+    return {"groupIds": group_id}
+
+
+def normalize_filter(event_filter):
+    """Нормализация текста фильтра для поиска одинаковых запросов"""
+    return " ".join(event_filter.split())
+
+
+def _rows_to_host_ids(rows):
+    host_ids = {}
+    for row in rows:
+        asset = row["groups"][0]
+        if len(row["groups"]) > 2:
+            # общий запрос query_fan_in: третий ключ группировки - значение поля фильтра
+            asset = fan_in_key(asset, row["groups"][2])
+        if asset not in host_ids.keys():
+            host_ids.update(
+                {
+                    asset: {
+                        "count": row["values"][0],
+                        "event_src.host": [row["groups"][1]],
+                    }
+                }
+            )
+        else:
+            host_ids[asset]["count"] += row["values"][0]
+            host_ids[asset]["event_src.host"].append(row["groups"][1])
+    return host_ids
+
+
+def _merge_host_ids(host_ids, other_host_ids):
+    """Сложение результатов частей окна: count суммируется, event_src.host объединяется"""
+    for asset, asset_info in other_host_ids.items():
+        if asset not in host_ids:
+            host_ids[asset] = {
+                "count": asset_info["count"],
+                "event_src.host": list(asset_info["event_src.host"]),
+            }
+        else:
+            host_ids[asset]["count"] += asset_info["count"]
+            for host in asset_info["event_src.host"]:
+                if host not in host_ids[asset]["event_src.host"]:
+                    host_ids[asset]["event_src.host"].append(host)
+    return host_ids
+
+
+def _split_window(time_from, time_to, shards_num):
+    """Деление окна на shards_num смежных частей [timeFrom, timeTo]"""
+    step = (time_to - time_from) // shards_num
+    shards = []
+    for shard_index in range(shards_num):
+        shard_from = time_from + shard_index * step
+        shard_to = time_to if shard_index == shards_num - 1 else shard_from + step
+        shards.append((shard_from, shard_to))
+    return shards
+
+
+def _shards_for_window(time_from, time_to, max_hours):
+    if not max_hours:
+        return 1
+    window = time_to - time_from
+    return -(-window // (max_hours * 60 * 60))
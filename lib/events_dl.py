@@ -1,6 +1,5 @@
 import asyncio
 import json
-import logging
 import re
 import sys
 import time
@@ -11,7 +10,6 @@ from datetime import UTC, datetime, timedelta
 from pathlib import Path
 from typing import Any, Optional  # type: ignore[attr-defined]
 
-import backoff
 import pandas as pd
 from datalake_client import DatalakeClient, DatalakeSettings
 from loguru import logger as guru_logger
@@ -22,26 +20,10 @@ from tqdm.asyncio import tqdm
 from .events import EventsWorker
 
 warnings.filterwarnings("ignore")
-global_reconnect_times = 5
 pd.set_option("display.max_columns", 10)
 pd.set_option("display.width", 1500)
 
 
-def get_backoff_decorator(
-    exceptions: tuple | type[Exception] | None = Exception,
-) -> Any:
-    """Обертка над on_exception, чтобы прибить параметры и не перечислять каждый раз"""
-    global global_reconnect_times
-    return backoff.on_exception(
-        backoff.expo,
-        exceptions,
-        max_tries=global_reconnect_times,
-        logger="IMCommon:backoff_custom",
-        backoff_log_level=logging.WARNING,
-        raise_on_giveup=False,
-    )
-
-
 class SQLFilter(BaseModel):
     select: str = 'select event_src__asset, event_src__host, COUNT(*) AS cnt from datalake."data".{table_name} '
     event_filter: str = (
@@ -100,9 +82,12 @@ class EventsWorkerDL(EventsWorker):
         # не применим и таких событий никогда не будет
         if not self.policies.rebuilt_policies:
             return [], {}
-        time_from_value = (
-            datetime.now(UTC) - timedelta(hours=self.settings.time_delta_hours)
-        ).strftime("%Y-%m-%d %H:%M:%S")
+        time_from_value = datetime.now(UTC) - timedelta(
+            hours=self.settings.time_delta_hours
+        )
+        if self.query_cache is not None:
+            time_from_value = time_from_value.replace(minute=0, second=0, microsecond=0)
+        time_from_value = time_from_value.strftime("%Y-%m-%d %H:%M:%S")
         for index, policy in enumerate(self.policies.rebuilt_policies):
             file_name, file_path = _file_dumper(policy, out_folder)
             policy["file_name"] = file_name
@@ -201,10 +186,22 @@ class EventsWorkerDL(EventsWorker):
         policy: dict[str, str | dict[str, dict[str, float | list[str]]]],
         out_dir: Path,
     ):
+        cache_key = None
+        if self.query_cache is not None:
+            cache_key = self.query_cache.key("datalake", policy["sql"])
+            host_ids = self.query_cache.get(cache_key)
+            if host_ids is not None:
+                self.logger.debug(f"Query cache hit for {policy['file_name']}")
+                policy["host_ids"] = host_ids
+                with (out_dir / policy["file_name"]).open(
+                    "w", encoding="utf-8"
+                ) as out_file:
+                    json.dump(policy, out_file, ensure_ascii=False, indent=4)
+                return policy["host_ids"]
         start_time = time.time()
         data_by_sql = self.get_data_by_sql(policy["sql"])
         if type(data_by_sql) is not pd.DataFrame:
-            self.logger.error("get_data_by_sql Backoff final")
+            self.logger.error("get_data_by_sql failed")
             return {}
         lead_time = time.time() - start_time
         self.logger.debug(
@@ -230,30 +227,38 @@ class EventsWorkerDL(EventsWorker):
                 )
         with (out_dir / policy["file_name"]).open("w", encoding="utf-8") as out_file:
             json.dump(policy, out_file, ensure_ascii=False, indent=4)
+        if cache_key is not None:
+            self.query_cache.put(cache_key, "datalake", policy["host_ids"])
         return policy["host_ids"]
 
-    @get_backoff_decorator()
-    @backoff.on_exception(
-        backoff.expo,
-        DBAPIError,
-        max_tries=1,
-        logger="IMCommon:get_data_by_sql",
-        backoff_log_level=logging.WARNING,
-        raise_on_giveup=False,
-    )
-    def get_data_by_sql(self, sql_query: str) -> pd.DataFrame:
+    def get_data_by_sql(self, sql_query: str) -> Optional[pd.DataFrame]:
         """
-        Функция для получения данных согласно SQL.
+        Функция для получения данных согласно SQL. Обрывы связи с озером повторяются через
+        общую политику повторов (группа datalake), ошибка самого SQL (DBAPIError) - нет.
 
         Args:
             sql_query: SQL запрос для получения данных
 
-        Returns: Данные в формате pd.DataFrame
+        Returns: Данные в формате pd.DataFrame или None, если запрос не выполнен
 
         """
         self.logger.debug(sql_query)
-        df = pd.DataFrame(self.dl_client.run_query(sql_query))
-        return df
+        attempt = 0
+        while True:
+            attempt += 1
+            self.retry.wait_sync()
+            try:
+                df = pd.DataFrame(self.dl_client.run_query(sql_query))
+            except DBAPIError as Err:
+                self.logger.warning(f"get_data_by_sql: {Err}")
+                return None
+            except Exception as Err:
+                if not self.retry.sleep_sync("datalake", attempt, str(Err)):
+                    self.logger.warning(f"get_data_by_sql: {Err}")
+                    return None
+                continue
+            self.retry.ok("datalake")
+            return df
 
 
 def _file_dumper(all_policy: dict[Any], out_dir: Path):
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import shutil
+from copy import copy, deepcopy
+from pathlib import Path
+
+from .events import EventsWorker
+from .get_token import MPXAuthenticator
+from .policies_checker import EventPolicies
+from .settings_checker import Settings
+
+
+class EventsMatrix(EventsWorker):
+    """
+    Матрица актив × фильтр событий, общая для всего запуска в режиме Assets_filters.
+    Каждый уникальный full_filter запрашивается один раз по объединению активов всех фильтров,
+    а отчеты отдельных фильтров собираются срезом матрицы по своим активам.
+    """
+
+    settings: Settings
+    logger: logging.Logger
+    policies: EventPolicies
+    auth: MPXAuthenticator
+    asset_ids: dict[str, None]
+    matrix: dict[str, dict[str, dict[str, int | list[str]]]]
+
+    def __init__(self, settings, logger, policies, auth):
+        # filter_policies не вызываем: набор запросов собирается из фильтров через add_filter
+        self.settings = settings
+        self.logger = logger
+        self.auth = auth
+        self._init_shared()
+        self.policies = copy(policies)
+        self.policies.rebuilt_policies = []
+        self.policies.small_policies = {}
+        self.policies.mandatory_policies = []
+        # dict вместо set, чтобы сохранить порядок активов между запусками
+        self.asset_ids = {}
+        self.matrix = {}
+
+    def add_filter(self, policies: EventPolicies, asset_ids):
+        """Добавление запросов и активов одного фильтра из assets_filters.json"""
+        known_filters = {
+            policy["full_filter"] for policy in self.policies.rebuilt_policies
+        }
+        for policy in policies.rebuilt_policies:
+            if policy["full_filter"] in known_filters:
+                continue
+            known_filters.add(policy["full_filter"])
+            self.policies.rebuilt_policies.append(
+                {
+                    "name": policy["name"],
+                    "number": policy["number"],
+                    "filter": policy["filter"],
+                    "full_filter": policy["full_filter"],
+                }
+            )
+        for policy_name in policies.small_policies.keys():
+            if policy_name not in self.policies.small_policies:
+                self.policies.small_policies[policy_name] = policies.small_policies[
+                    policy_name
+                ]
+        self.asset_ids.update(dict.fromkeys(asset_ids))
+
+    def collect(self, group_id, out_folder: Path):
+        """Запрос всех уникальных фильтров по объединению активов пачками max_uuids_in_siem_query (adaptive_uuids_max)"""
+        asset_ids = list(self.asset_ids.keys())
+        counter = self.settings.max_uuids_in_siem_query
+        if self.settings.adaptive_uuids:
+            # части пачки подбираются по фильтрам, пачка - их верхняя граница
+            counter = self.settings.adaptive_uuids_max
+        self.logger.info(
+            f"Events matrix: {len(self.policies.rebuilt_policies)} unique queries for {len(asset_ids)} assets"
+        )
+        if not self.settings.resume and out_folder.exists():
+            # частичный clear_mode оставляет папки пачек прошлого запуска
+            shutil.rmtree(out_folder)
+        out_folder.mkdir(exist_ok=True)
+        if self.policies.rebuilt_policies and asset_ids:
+            batches = []
+            for start in range(0, len(asset_ids), counter):
+                batch = asset_ids[start : start + counter]
+                out_dir = out_folder / f"{start}-{start + len(batch)}"
+                out_dir.mkdir(exist_ok=self.settings.resume)
+                batches.append((batch, out_dir))
+            asyncio.run(self.work_batches(group_id, batches))
+        for policy in self.policies.rebuilt_policies:
+            self.matrix[policy["full_filter"]] = policy.get("host_ids", {})
+        with (out_folder.parent / "!events_matrix.json").open(
+            "w", encoding="utf-8"
+        ) as matrix_file:
+            json.dump(self.matrix, matrix_file, ensure_ascii=False, indent=4)
+
+    async def take_events_from_matrix(self, full_filter, asset_ids):
+        """Срез матрицы по активам пачки, формат совпадает с результатом take_events"""
+        host_ids = self.matrix.get(full_filter, {})
+        if not asset_ids:
+            return deepcopy(host_ids)
+        return {
+            asset_id: deepcopy(host_ids[asset_id])
+            for asset_id in asset_ids
+            if asset_id in host_ids
+        }
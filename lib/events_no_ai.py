@@ -9,8 +9,10 @@ from venv import logger
 import requests
 import xlsxwriter
 
+from .asset_store import json_default
 from .get_token import MPXAuthenticator
 from .policies_checker import EventPolicies
+from .retry_policy import RetryPolicy, get_retry_policy
 from .settings_checker import Settings
 from .xlsx_out import MonitorXlsxWriter
 
@@ -24,6 +26,7 @@ class EventsWorker:
     logger: logging.Logger
     policies: EventPolicies
     auth: MPXAuthenticator
+    retry: RetryPolicy
 
     def __init__(
         self,
@@ -38,8 +41,9 @@ class EventsWorker:
     ):
         self.settings = settings
         self.logger = logger
-        self.policies = policies
+        self.policies = policies.view()
         self.auth = auth
+        self.retry = get_retry_policy(self.settings, self.logger)
         self.policies.filter_policies(pol_blacklist, pol_whitelist, pol_spec)
         if assets:
             audit_pol = {
@@ -147,21 +151,25 @@ class EventsWorker:
         all_ok = False
         response = {}
         while try_number < self.settings.reconnect_times:
+            retry_status = None
+            retry_after = None
             try:
                 try_number += 1
-                response_temp = requests.session().post(
-                    url=url,
+                self.retry.wait_sync()
+                response_temp = self.auth.transport.post(
+                    url,
                     json=data,
                     headers=self.auth.headers,
-                    verify=False,
                     cookies=self.auth.cookies,
                     params=param,
                 )
-
+                retry_status = response_temp.status_code
+                retry_after = self.retry.retry_after(response_temp.headers)
                 if response_temp.status_code == 200:
                     response = response_temp.json()
                     self.logger.debug(f"take_events response for {data}: {response}")
                     if not response["errors"]:
+                        self.retry.ok("events")
                         all_ok = True
                         break
                     else:
@@ -170,9 +178,12 @@ class EventsWorker:
                         )
                 elif response_temp.status_code >= 500:
                     self.logger.warning(
-                        f"Response code: {response_temp.status_code}. Try number: {try_number}. Next try after 5 seconds"
+                        f"Response code: {response_temp.status_code}. Try number: {try_number}"
+                    )
+                elif response_temp.status_code == 429:
+                    self.logger.warning(
+                        f"Response code: 429, Retry-After: {retry_after}. Try number: {try_number}"
                     )
-                    time.sleep(5)
                 elif response_temp.status_code == 400:
                     response = response_temp.json()
                     resp_mes = response["message"]
@@ -199,6 +210,10 @@ class EventsWorker:
                 self.logger.warning(
                     f"Connection error, something went horribly wrong, let's try again. Error: {Err}"
                 )
+            if not self.retry.sleep_sync(
+                "events", try_number, filter_file_name, retry_status, retry_after
+            ):
+                break
         if all_ok:
             if response["rows"]:
                 for row in response["rows"]:
@@ -257,7 +272,13 @@ class EventsWorker:
                 self.policies.rebuilt_policies, self.policies.small_policies, asset_dict
             )
         with (out_path / "!asset_dict.json").open("w", encoding="utf-8") as out_assets:
-            json.dump(asset_dict, out_assets, indent=4, ensure_ascii=False)
+            json.dump(
+                asset_dict,
+                out_assets,
+                indent=4,
+                ensure_ascii=False,
+                default=json_default,
+            )
         excel_file.work_with_asset_dict(
             self.policies.small_policies, asset_dict, no_assets
         )
@@ -1,11 +1,9 @@
 import logging
 import re
-import time
 from collections import deque
 from datetime import datetime
 from typing import Any
 
-import backoff
 import requests
 import urllib3
 from pydantic import BaseModel
@@ -14,6 +12,14 @@ try:
     from .settings_checker import Settings
 except:
     from settings_checker import Settings
+try:
+    from .retry_policy import RetryPolicy, get_retry_policy
+except:
+    from retry_policy import RetryPolicy, get_retry_policy
+try:
+    from .transport import Transport
+except:
+    from transport import Transport
 
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -32,6 +38,8 @@ class MPXAuthenticator:
     headers: requests.session().headers
     session: requests.session
     token_info: TokenInfo | None
+    retry: RetryPolicy
+    transport: Transport
 
     def __init__(self, logger):
         self.logger: logging.Logger = logger
@@ -42,6 +50,10 @@ class MPXAuthenticator:
         self.auth_mode = ""
 
     def authenticate(self, settings: Settings):
+        self.retry = get_retry_policy(settings, self.logger)
+        # общий пул соединений для всех модулей, сессия UI-входа копит в нем cookies
+        self.transport = Transport(settings, self.logger)
+        self.session = self.transport.session
         if settings.personal_token:
             self.auth_mode = "pat"
             self.logger.info(f"Use personal_token for host: {settings.mpx_host}")
@@ -139,12 +151,17 @@ class MPXAuthenticator:
                 f"try connect to: {settings.mpx_host}, attempt: {try_number + 1} "
                 f"of {settings.reconnect_times}"
             )
+            status = None
+            retry_after = None
             try:
-                self.session = requests.session()
-                scopes = self.session.get(
-                    url, headers=self.headers, cookies=self.cookies, verify=False
+                self.retry.wait_sync()
+                scopes = self.transport.get(
+                    url, headers=self.headers, cookies=self.cookies
                 )
+                status = scopes.status_code
+                retry_after = self.retry.retry_after(scopes.headers)
                 if scopes.status_code == 200 and scopes.json()[0]["id"]:
+                    self.retry.ok("auth")
                     connected = True
                     break
                 elif scopes.status_code == 401:
@@ -156,30 +173,20 @@ class MPXAuthenticator:
                     )
             except Exception as Err:
                 self.logger.warning(f"Проблемы при проверке токена: {Err}")
-                time.sleep(5)
+                if not self.retry.sleep_sync(
+                    "auth", try_number + 1, str(Err), status, retry_after
+                ):
+                    break
         return connected
 
-    @backoff.on_exception(
-        backoff.expo,
-        Exception,
-        max_tries=3,
-        raise_on_giveup=True,
-        logger="MaxPatrolEventsMonitor:_get_requester",
-    )
     def _get_requester_pat(self, url):
-        response = self.session.get(
-            url, verify=False, headers=self.headers, cookies=self.cookies
+        response = self.retry.send(
+            "auth",
+            lambda: self.transport.get(url, headers=self.headers, cookies=self.cookies),
         )
         response.raise_for_status()
         return response.json()
 
-    @backoff.on_exception(
-        backoff.expo,
-        (ValueError, KeyError),
-        max_tries=1,
-        raise_on_giveup=True,
-        logger="MaxPatrolEventsMonitor:get_token_info",
-    )
     def get_token_info(self, settings: Settings):
         self.logger.info("Check privileges")
         url = f"https://{settings.mpx_host}:3334/api/iam/v1/personal_access_tokens"
@@ -209,7 +216,9 @@ class MPXAuthenticator:
                 f"try connect to: {settings.mpx_host}, attempt: {try_number + 1} "
                 f"of {settings.reconnect_times}"
             )
+            status = None
             try:
+                self.retry.wait_sync()
                 headers = {"Content-Type": "application/x-www-form-urlencoded"}
                 auth_data = {
                     "client_id": "mpx",
@@ -222,8 +231,10 @@ class MPXAuthenticator:
                 }
                 if auth_data["username"].find("@") != -1:
                     auth_data.update({"amr": "ldap"})
-                r = requests.post(url, data=auth_data, headers=headers, verify=False)
+                r = self.transport.post(url, data=auth_data, headers=headers)
+                status = r.status_code
                 access_token = r.json()["access_token"]
+                self.retry.ok("auth")
                 self.headers = {
                     "Authorization": f"Bearer {access_token}",
                     "Content-Type": "application/json",
@@ -232,22 +243,22 @@ class MPXAuthenticator:
                 break
             except Exception as Err:
                 self.logger.warning(f"Проблемы при получении токена: {Err}")
+                if not self.retry.sleep_sync("auth", try_number + 1, str(Err), status):
+                    break
         return connected
 
-    @backoff.on_exception(
-        backoff.expo,
-        Exception,
-        max_tries=3,
-        raise_on_giveup=True,
-        logger="MaxPatrolEventsMonitor:_get_requester",
-    )
     def _requester_ui(
         self, url, body: dict = None, data: dict = None, post_method: bool = False
     ):
         if post_method:
-            response = self.session.post(url, verify=False, json=body, data=data)
+            response = self.retry.send(
+                "auth",
+                lambda: self.transport.post(url, json=body, data=data),
+            )
         else:
-            response = self.session.get(url, verify=False, json=body)
+            response = self.retry.send(
+                "auth", lambda: self.transport.get(url, json=body)
+            )
         if response.status_code == 400:
             self.logger.error("400 Client Error. Check creds.")
             exit(1)
@@ -256,7 +267,6 @@ class MPXAuthenticator:
 
     def _ui_login(self, settings: Settings):
         self.logger.info(f"try take first response to: {settings.mpx_host}")
-        self.session = requests.Session()
         url = f"https://{settings.mpx_host}:3334/ui/login"
         auth_type = 1 if settings.login.find("@") != -1 else 0
         auth_data = {
@@ -267,14 +277,18 @@ class MPXAuthenticator:
         self._requester_ui(url, auth_data, {}, True)
         self.logger.info("Step check creds - successful")
 
-    @backoff.on_exception(
-        backoff.expo,
-        (AttributeError, ConnectionError),
-        max_tries=3,
-        raise_on_giveup=True,
-        logger="MaxPatrolEventsMonitor:_mpx_cookies",
-    )
     def _mpx_cookies(self, url_auth, param_auth, mode):
+        """Cookies шага mode, сбой шага повторяется через общую политику повторов"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._take_mpx_cookies(url_auth, param_auth, mode)
+            except (AttributeError, ConnectionError) as Err:
+                if not self.retry.sleep_sync("auth", attempt, str(Err)):
+                    raise
+
+    def _take_mpx_cookies(self, url_auth, param_auth, mode):
         response = self._requester_ui(url_auth, param_auth)
         if response.ok:
             self.logger.info(
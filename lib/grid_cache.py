@@ -0,0 +1,96 @@
+import logging
+import re
+
+from .run_stats import run_stats
+
+# строки PDQL в кавычках, пробелы внутри них значимы
+_QUOTED = re.compile("(\"(?:[^\"\\\\]|\\\\.)*\"|'(?:[^'\\\\]|\\\\.)*')")
+_SPACES = re.compile("\\s+")
+
+
+def normalize_pdql(pdql):
+    """PDQL без лишних пробелов и переносов вне строк в кавычках"""
+    parts = _QUOTED.split("".join(pdql))
+    for index in range(0, len(parts), 2):
+        parts[index] = _SPACES.sub(" ", parts[index])
+    return "".join(parts).strip()
+
+
+def group_ids(group):
+    """selectedGroupIds запроса assets_grid из group фильтра активов"""
+    if type(group) is str:
+        if group == "-1":
+            return ["00000000-0000-0000-0000-000000000002"]
+        return [group]
+    return group
+
+
+class GridCache:
+    """
+    Общий на запуск кэш сетки активов в памяти: фильтры активов с одинаковыми PDQL (после
+    normalize_pdql) и группами получают один ответ create_pdql_token и одни записи сетки
+    вместо повторного запроса. Запись хранится, пока ее не взяли все ожидаемые фильтры (expect).
+    Между запусками сетку сохраняет query_cache
+    """
+
+    logger: logging.Logger
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.entries = {}
+        self.expected = {}
+        self.hits = 0
+        self.stored = 0
+
+    @staticmethod
+    def key(pdql, group):
+        """Ключ до подстановки dynamic-фильтров: она одинакова для одинаковых PDQL в одном запуске"""
+        return normalize_pdql(pdql), tuple(sorted(group_ids(group)))
+
+    def expect(self, key):
+        """Еще один фильтр запуска возьмет сетку по key"""
+        self.expected[key] = self.expected.get(key, 0) + 1
+
+    def get(self, key):
+        """{"token": ответ create_pdql_token, "records": записи} или None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        self._taken(key)
+        return entry
+
+    def put(self, key, token, records):
+        """Сетка, которую фильтр получил сам. Хранится, только если ее ждут другие фильтры"""
+        self._taken(key)
+        if key not in self.expected:
+            return
+        self.entries[key] = {"token": token, "records": records}
+        self.stored += 1
+
+    def release(self, key):
+        """Фильтр, учтенный в expect, не получил сетку и не возьмет ее"""
+        self._taken(key)
+
+    def _taken(self, key):
+        if key not in self.expected:
+            return
+        self.expected[key] -= 1
+        if self.expected[key] <= 0:
+            self.expected.pop(key)
+            self.entries.pop(key, None)
+
+    def summary(self):
+        return {"hits": self.hits, "stored": self.stored}
+
+
+_cache = None
+
+
+def get_grid_cache(logger: logging.Logger):
+    """Общий на весь запуск кэш сетки активов"""
+    global _cache
+    if _cache is None:
+        _cache = GridCache(logger)
+        run_stats.sections["grid_cache"] = _cache
+    return _cache
@@ -1,7 +1,5 @@
 from datetime import datetime, timedelta, timezone
 
-import requests
-
 try:
     from .settings_checker import Settings
 except:
@@ -10,6 +8,14 @@ try:
     from .get_token import MPXAuthenticator
 except:
     from get_token import MPXAuthenticator
+try:
+    from .adaptive_limiter import AdaptiveLimiter, get_limiter
+except:
+    from adaptive_limiter import AdaptiveLimiter, get_limiter
+try:
+    from .retry_policy import RetryPolicy, get_retry_policy
+except:
+    from retry_policy import RetryPolicy, get_retry_policy
 
 import asyncio
 import logging
@@ -24,13 +30,15 @@ class Inc_Checker:
     settings: Settings
     logger: logging.Logger
     auth: MPXAuthenticator
-    semaphore: asyncio.Semaphore
+    semaphore: AdaptiveLimiter
+    retry: RetryPolicy
 
     def __init__(self, settings, logger, auth):
         self.settings = settings
         self.logger = logger
         self.auth = auth
-        self.semaphore = asyncio.Semaphore(self.settings.max_threads_for_siem_api)
+        self.semaphore = get_limiter(self.settings, self.logger, "incidents")
+        self.retry = get_retry_policy(self.settings, self.logger)
 
     def iso_utc_millis(self, dt):
         iso = dt.isoformat(timespec="milliseconds")
@@ -70,52 +78,68 @@ class Inc_Checker:
         }
 
         url = "https://{}/api/v2/incidents".format(self.settings.mpx_host)
-        resp = requests.session().post(
-            url=url,
-            headers=self.auth.headers,
-            verify=False,
-            json=query,
-            cookies=self.auth.cookies,
+        resp = self.retry.send(
+            "incidents",
+            lambda: self.auth.transport.post(
+                url, headers=self.auth.headers, json=query, cookies=self.auth.cookies
+            ),
         )
         if resp.status_code == 200:
             return resp.json()
         else:
             raise RuntimeError(f"GET content failed: {resp.status_code} – {resp.text}")
 
-    async def check_single_inc(self, inc_guid):
-        async with self.semaphore:
-            url = "https://{}/api/incidentsReadModel/incidents/{}".format(
-                self.settings.mpx_host, inc_guid
-            )
-            async with aiohttp.ClientSession(
-                headers=self.auth.headers, cookies=self.auth.cookies
-            ) as session:
+    async def check_single_inc(self, inc_guid, session: aiohttp.ClientSession):
+        url = "https://{}/api/incidentsReadModel/incidents/{}".format(
+            self.settings.mpx_host, inc_guid
+        )
+        try_number = 0
+        while True:
+            try_number += 1
+            status = None
+            retry_after = None
+            await self.retry.wait()
+            async with self.semaphore:
                 try:
-                    async with session.get(url, verify_ssl=False) as response:
+                    async with session.get(url) as response:
+                        status = response.status
+                        retry_after = self.retry.retry_after(response.headers)
                         if response.status == 200:
+                            self.retry.ok("incidents")
                             resp = await response.json()
                             return resp if resp.get("source") == "user" else None
                         else:
+                            if response.status >= 500 or response.status == 429:
+                                self.semaphore.overload(f"code {response.status}")
                             self.logger.error(
                                 f"GET content failed for {inc_guid}: {response.status} – {await response.text()}"
                             )
-                            return None
+                            if response.status < 500 and response.status != 429:
+                                return None
                 except aiohttp.ClientError as e:
                     self.logger.error(f"AIOHTTP error for {inc_guid}: {e}")
-                    return None
+            if not await self.retry.sleep(
+                "incidents", try_number, inc_guid, status, retry_after
+            ):
+                return None
 
     async def check_all_inc(self, list_of_inc):
         incidents = list_of_inc["incidents"]
         results = []
-        with tqdm(total=len(incidents), desc="Checking Incidents") as pbar:
-            tasks = [
-                asyncio.create_task(self.check_single_inc(inc["id"]))
-                for inc in incidents
-            ]
-            for future in asyncio.as_completed(tasks):  # Process as they complete
-                result = await future
-                if result is not None:
-                    results.append(result)
-                pbar.update(1)
+        # одна сессия на все инциденты поверх общего пула соединений
+        session = self.auth.transport.open_session(self.auth.headers, self.auth.cookies)
+        try:
+            with tqdm(total=len(incidents), desc="Checking Incidents") as pbar:
+                tasks = [
+                    asyncio.create_task(self.check_single_inc(inc["id"], session))
+                    for inc in incidents
+                ]
+                for future in asyncio.as_completed(tasks):  # Process as they complete
+                    result = await future
+                    if result is not None:
+                        results.append(result)
+                    pbar.update(1)
+        finally:
+            await self.auth.transport.close_session(session)
 
         return results
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+from .events import _merge_host_ids, normalize_filter
+from .run_manifest import get_run_manifest
+from .settings_checker import Settings
+
+# отметка покрытия для запросов без ограничения по активам
+ALL_ASSETS = "*"
+
+
+class IncrementalState:
+    """
+    Состояние инкрементального сбора событий в state_folder/incremental.
+    Для каждого запроса (фильтр политики, группа, поле актива) хранятся количества событий по активам
+    в корзинах по incremental_bucket_hours и отметка (watermark) - до какого момента актив уже опрошен.
+    Следующий запуск запрашивает только интервал от отметки до текущего момента, корзины,
+    вышедшие за time_delta_hours, удаляются. Окно отчета округляется вниз до границы корзины.
+    """
+
+    settings: Settings
+    logger: logging.Logger
+    folder: Path
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.folder = self.settings.state_folder / "incremental"
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.bucket_seconds = self.settings.incremental_bucket_hours * 60 * 60
+        # одна граница времени на весь запуск, чтобы у всех пачек была общая отметка. Берется
+        # из журнала запуска: при resume окно и ключи запросов совпадают с прерванным запуском
+        self.time_to = get_run_manifest(settings, logger).time_to
+        self.entries = {}
+        self.changed = set()
+
+    def key(self, full_filter, param, asset_field):
+        key_source = json.dumps(
+            [normalize_filter(full_filter), param, asset_field], sort_keys=True
+        )
+        return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+    def entry(self, key):
+        if key not in self.entries:
+            entry = {}
+            entry_path = self.folder / f"{key}.json"
+            if entry_path.is_file():
+                try:
+                    with entry_path.open("r", encoding="utf-8") as entry_file:
+                        entry = json.load(entry_file)
+                except (OSError, ValueError) as Err:
+                    self.logger.warning(
+                        f"Broken incremental state {entry_path}: {Err}. Full query"
+                    )
+                    entry = {}
+            if entry.get("bucket_hours") != self.settings.incremental_bucket_hours:
+                entry = {
+                    "bucket_hours": self.settings.incremental_bucket_hours,
+                    "watermarks": {},
+                    "buckets": {},
+                }
+            self.entries[key] = entry
+        return self.entries[key]
+
+    def plan(self, key, asset_ids, time_from):
+        """Группы активов с общей отметкой: {начало запроса: [asset_ids]}"""
+        watermarks = self.entry(key)["watermarks"]
+        groups = {}
+        for asset_id in asset_ids or [ALL_ASSETS]:
+            watermark = watermarks.get(asset_id)
+            if not watermark or watermark < time_from or watermark > self.time_to:
+                watermark = time_from
+            groups.setdefault(watermark, []).append(asset_id)
+        return groups
+
+    def pieces(self, time_from, time_to):
+        """Деление интервала по границам корзин, каждая часть попадает ровно в одну корзину"""
+        pieces = []
+        piece_from = time_from
+        while piece_from < time_to:
+            piece_to = min(
+                (piece_from // self.bucket_seconds + 1) * self.bucket_seconds, time_to
+            )
+            pieces.append((piece_from, piece_to))
+            piece_from = piece_to
+        return pieces
+
+    def add(self, key, piece_from, host_ids):
+        bucket = str(piece_from // self.bucket_seconds * self.bucket_seconds)
+        buckets = self.entry(key)["buckets"]
+        buckets[bucket] = _merge_host_ids(buckets.get(bucket, {}), host_ids)
+        self.changed.add(key)
+
+    def commit(self, key, asset_ids):
+        watermarks = self.entry(key)["watermarks"]
+        for asset_id in asset_ids:
+            watermarks[asset_id] = self.time_to
+        self.changed.add(key)
+
+    def host_ids(self, key, asset_ids, time_from):
+        """Сумма корзин окна по активам пачки, формат совпадает с результатом take_events"""
+        entry = self.entry(key)
+        for bucket in list(entry["buckets"].keys()):
+            if int(bucket) + self.bucket_seconds <= time_from:
+                del entry["buckets"][bucket]
+                self.changed.add(key)
+        host_ids = {}
+        for bucket_host_ids in entry["buckets"].values():
+            if asset_ids:
+                bucket_host_ids = {
+                    asset_id: bucket_host_ids[asset_id]
+                    for asset_id in asset_ids
+                    if asset_id in bucket_host_ids
+                }
+            _merge_host_ids(host_ids, bucket_host_ids)
+        return host_ids
+
+    def save(self):
+        for key in self.changed:
+            with (self.folder / f"{key}.json").open("w", encoding="utf-8") as out_file:
+                json.dump(self.entries[key], out_file, ensure_ascii=False)
+        self.logger.info(f"Incremental state saved for {len(self.changed)} queries")
+        self.changed = set()
+
+
+_state = None
+
+
+def get_incremental_state(settings, logger: logging.Logger):
+    """Общее на весь запуск состояние, у всех фильтров одна граница времени time_to"""
+    global _state
+    if _state is None:
+        _state = IncrementalState(settings, logger)
+    return _state
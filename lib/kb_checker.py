@@ -4,6 +4,7 @@ import logging
 import unicodedata
 from collections import defaultdict
 
+import aiohttp
 import xlsxwriter
 from aiohttp import ClientSession
 from tqdm.asyncio import tqdm
@@ -20,6 +21,14 @@ try:
     from .incidents_checker import Inc_Checker
 except:
     from incidents_checker import Inc_Checker
+try:
+    from .adaptive_limiter import AdaptiveLimiter, get_limiter
+except:
+    from adaptive_limiter import AdaptiveLimiter, get_limiter
+try:
+    from .retry_policy import RetryPolicy, get_retry_policy
+except:
+    from retry_policy import RetryPolicy, get_retry_policy
 
 import difflib
 from datetime import datetime
@@ -28,18 +37,36 @@ from datetime import datetime
 class KB_Checker:
     """Класс запроса событий из SIEM"""
 
-    semaphore: asyncio.Semaphore
+    semaphore: AdaptiveLimiter
     settings: Settings
     logger: logging.Logger
     auth: MPXAuthenticator
+    retry: RetryPolicy
 
     def __init__(self, settings, logger, auth):
         self.settings = settings
         self.logger = logger
-        self.semaphore = asyncio.Semaphore(self.settings.max_threads_for_siem_api)
+        self.semaphore = get_limiter(self.settings, self.logger, "kb")
+        self.retry = get_retry_policy(self.settings, self.logger)
         self.auth = auth
         self.auth.headers["Content-Database"] = self.get_ContentDB()
 
+    def _get(self, url):
+        return self.retry.send(
+            "kb",
+            lambda: self.auth.transport.get(
+                url, headers=self.auth.headers, cookies=self.auth.cookies
+            ),
+        )
+
+    def _post(self, url, query):
+        return self.retry.send(
+            "kb",
+            lambda: self.auth.transport.post(
+                url, headers=self.auth.headers, json=query, cookies=self.auth.cookies
+            ),
+        )
+
     def localize_pack(self, pack, loc_dict):
         for item in loc_dict["categories"]:
             if item["id"] == pack:
@@ -122,9 +149,7 @@ class KB_Checker:
         url = "https://{}:8091/api-studio/siem/correlation-rules/{}".format(
             self.settings.mpx_host, ptkb_id
         )
-        response_temp = self.auth.session.get(
-            url=url, headers=self.auth.headers, verify=False, cookies=self.auth.cookies
-        )
+        response_temp = self._get(url)
         if response_temp.status_code == 200:
             response = response_temp.json()
         else:
@@ -183,9 +208,7 @@ class KB_Checker:
         url = "https://{}:8091/api-studio/databases/content-databases".format(
             self.settings.mpx_host
         )
-        response_temp = self.auth.session.get(
-            url=url, headers=self.auth.headers, verify=False, cookies=self.auth.cookies
-        )
+        response_temp = self._get(url)
         get_resp = False
         if response_temp.status_code == 200:
             response_temp.raise_for_status()
@@ -209,9 +232,7 @@ class KB_Checker:
 
     def get_real_names_pipeline(self, curr_conveyors):
         url = "https://{}:8091/api-studio/siem/pipelines".format(self.settings.mpx_host)
-        response_temp = self.auth.session.get(
-            url=url, headers=self.auth.headers, verify=False, cookies=self.auth.cookies
-        )
+        response_temp = self._get(url)
         if response_temp.status_code == 200:
             response = response_temp.json()
         else:
@@ -226,9 +247,7 @@ class KB_Checker:
 
     def get_siems_info(self):
         url = "https://{}/api/siem_manager/v1/siems".format(self.settings.mpx_host)
-        response_temp = self.auth.session.get(
-            url=url, headers=self.auth.headers, verify=False, cookies=self.auth.cookies
-        )
+        response_temp = self._get(url)
         if response_temp.status_code == 200:
             response = response_temp.json()
         else:
@@ -239,12 +258,7 @@ class KB_Checker:
             url_count = "https://{}/api/events/v1/siem_counters/correlation_rules?siem_id={}".format(
                 self.settings.mpx_host, pipeline["id"]
             )
-            response_temp_count = self.auth.session.get(
-                url=url_count,
-                headers=self.auth.headers,
-                verify=False,
-                cookies=self.auth.cookies,
-            )
+            response_temp_count = self._get(url_count)
             if response_temp_count.status_code == 200:
                 response_count = response_temp_count.json()
             else:
@@ -272,9 +286,7 @@ class KB_Checker:
 
     def get_siems_from_core(self):
         url = "https://{}/api/siem_manager/v1/siems".format(self.settings.mpx_host)
-        response_temp = self.auth.session.get(
-            url=url, headers=self.auth.headers, verify=False, cookies=self.auth.cookies
-        )
+        response_temp = self._get(url)
         if response_temp.status_code == 200:
             response = response_temp.json()
         else:
@@ -293,9 +305,7 @@ class KB_Checker:
         url = "https://{}/api/events/v2/table_lists?siem_id={}".format(
             self.settings.mpx_host, siem_id
         )
-        response_temp = self.auth.session.get(
-            url=url, headers=self.auth.headers, verify=False, cookies=self.auth.cookies
-        )
+        response_temp = self._get(url)
         if response_temp.status_code == 200:
             response = response_temp.json()
         else:
@@ -322,13 +332,7 @@ class KB_Checker:
             )
         )
 
-        response_temp = self.auth.session.post(
-            url=url,
-            headers=self.auth.headers,
-            verify=False,
-            json=query,
-            cookies=self.auth.cookies,
-        )
+        response_temp = self._post(url, query)
         if response_temp.status_code == 200:
             return response_temp.json()["totalItems"]
         else:
@@ -353,13 +357,7 @@ class KB_Checker:
             self.settings.mpx_host
         )
 
-        response_temp = self.auth.session.post(
-            url=url,
-            headers=self.auth.headers,
-            verify=False,
-            json=query,
-            cookies=self.auth.cookies,
-        )
+        response_temp = self._post(url, query)
         if response_temp.status_code == 201:
             return response_temp.json()
         else:
@@ -403,32 +401,48 @@ class KB_Checker:
         }
 
     async def _check_one(self, key, value, prog, session: ClientSession):
-        async with self.semaphore:
-            query = {
-                "skip": 0,
-                "take": 50,
-                "filters": {"ContentType": ["User"]},
-                "sort": None,
-            }
-            url = f"https://{self.settings.mpx_host}:8091/api-studio/siem/tabular-lists/{value}/rows"
-            async with session.post(
-                url,
-                json=query,
-                headers=self.auth.headers,
-                cookies=self.auth.cookies,
-                ssl=False,
-            ) as resp:
-                if resp.status == 201:
-                    data = await resp.json()
-                    if data.get("Count", 0) > 0:
-                        prog.update(1)
-                        return {key: value}
+        query = {
+            "skip": 0,
+            "take": 50,
+            "filters": {"ContentType": ["User"]},
+            "sort": None,
+        }
+        url = f"https://{self.settings.mpx_host}:8091/api-studio/siem/tabular-lists/{value}/rows"
+        try_number = 0
+        while True:
+            try_number += 1
+            status = None
+            retry_after = None
+            await self.retry.wait()
+            try:
+                async with self.semaphore:
+                    async with session.post(
+                        url,
+                        json=query,
+                    ) as resp:
+                        status = resp.status
+                        retry_after = self.retry.retry_after(resp.headers)
+                        if resp.status == 201:
+                            self.retry.ok("kb")
+                            data = await resp.json()
+                            if data.get("Count", 0) > 0:
+                                prog.update(1)
+                                return {key: value}
+                            break
+                        elif resp.status >= 500 or resp.status == 429:
+                            self.semaphore.overload(f"code {resp.status}")
+                        else:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as Err:
+                self.logger.warning(f"KB tabular list {key} error: {Err}")
+            if not await self.retry.sleep("kb", try_number, key, status, retry_after):
+                break
         prog.update(1)
         return None
 
     async def get_changed(self, all_tables_list):
-        async_session = ClientSession(
-            cookies=self.auth.cookies, headers=self.auth.headers
+        async_session = self.auth.transport.open_session(
+            self.auth.headers, self.auth.cookies
         )
         prog = tqdm(
             total=len(all_tables_list), desc="Checking tables", leave=True, unit="req"
@@ -440,7 +454,7 @@ class KB_Checker:
 
         results = [r for r in await asyncio.gather(*tasks) if r is not None]
         prog.close()
-        await async_session.close()
+        await self.auth.transport.close_session(async_session)
         return results
 
     def work(self):
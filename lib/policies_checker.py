@@ -2,6 +2,7 @@ import json
 import logging
 import re
 import sys
+from copy import copy
 from json import JSONDecodeError
 from pathlib import Path
 from typing import Dict, List, Union
@@ -83,6 +84,14 @@ class EventPolicies:
         else:
             exit(1)
 
+    def view(self):
+        """
+        Копия для одного EventsWorker: filter_policies заменяет списки политик только в ней,
+        policies_by_file общий. Фильтры активов, которые работают одновременно, не портят
+        политики друг друга
+        """
+        return copy(self)
+
     def check_policies_type(self, pol_blacklist=None, pol_whitelist=None):
         if type(pol_blacklist) is str:
             pol_blacklist = [pol_blacklist]
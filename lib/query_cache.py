@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .asset_store import json_default
+from .run_stats import run_stats
+from .settings_checker import Settings
+
+
+class QueryCache:
+    """
+    Кэш результатов запросов к SIEM и сетке активов в state_folder/query_cache.sqlite.
+    Ключ - хэш текста запроса, групп, набора активов и окна, выровненного по часу, поэтому
+    повторный запуск в течение query_cache_ttl берет результаты из кэша. Размер ограничен
+    query_cache_max_mb, при превышении удаляются давно не использованные записи (LRU).
+    """
+
+    settings: Settings
+    logger: logging.Logger
+    path: Path
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.settings.state_folder.mkdir(parents=True, exist_ok=True)
+        self.path = self.settings.state_folder / "query_cache.sqlite"
+        self.ttl = self.settings.query_cache_ttl
+        self.max_bytes = self.settings.query_cache_max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        # EventsWorkerDL ходит в кэш из потоков пула
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, kind TEXT, created REAL, "
+            "used REAL, size INTEGER, value TEXT)"
+        )
+        self.connection.execute(
+            "DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,)
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(kind, *parts):
+        key_source = json.dumps([kind, *parts], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def align(timestamp):
+        """Выравнивание начала окна по часу, чтобы запуски в течение часа давали одинаковый ключ"""
+        return timestamp // 3600 * 3600
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND created >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute(
+                "UPDATE cache SET used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, kind, value):
+        value = json.dumps(value, ensure_ascii=False, default=json_default)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, now, now, len(value), value),
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        total_size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM cache ORDER BY used"
+        ).fetchall():
+            if total_size <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total_size -= size
+            evicted += 1
+        self.logger.debug(f"Query cache: {evicted} least recently used entries evicted")
+
+    def summary(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_cache = None
+
+
+def get_query_cache(settings, logger: logging.Logger):
+    """Общий на весь запуск кэш или None, если query_cache выключен"""
+    global _cache
+    if not settings.query_cache:
+        return None
+    if _cache is None:
+        _cache = QueryCache(settings, logger)
+        run_stats.sections["query_cache"] = _cache
+    return _cache
@@ -0,0 +1,118 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+from .run_stats import run_stats
+from .settings_checker import Settings
+
+
+class QueryHistory:
+    """
+    История длительности запросов фильтров политик в state_folder/query_history.json.
+    По ней запросы ставятся в очередь от самых долгих к быстрым, а за запуск собирается
+    отчет о стоимости фильтров (самые дорогие попадают в !run_summary.json).
+    """
+
+    settings: Settings
+    logger: logging.Logger
+    path: Path
+    # вес последнего запуска в скользящем среднем
+    smoothing = 0.3
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.settings.state_folder.mkdir(parents=True, exist_ok=True)
+        self.path = self.settings.state_folder / "query_history.json"
+        self.history = {}
+        self.run_costs = {}
+        if self.path.is_file():
+            try:
+                with self.path.open("r", encoding="utf-8") as history_file:
+                    self.history = json.load(history_file)
+            except (OSError, ValueError) as Err:
+                self.logger.warning(f"Broken query history {self.path}: {Err}")
+
+    @staticmethod
+    def key(policy):
+        return f"{policy['name']} #{policy['number']}"
+
+    def expected(self, policy):
+        """Ожидаемая длительность запроса, для новых фильтров - как у самого долгого известного"""
+        policy_history = self.history.get(self.key(policy))
+        if policy_history and policy_history["filter"] == policy["filter"]:
+            return policy_history["avg_seconds"]
+        return max((item["avg_seconds"] for item in self.history.values()), default=0.0)
+
+    def record(self, policy, seconds, ok):
+        key = self.key(policy)
+        policy_history = self.history.get(key)
+        if not policy_history or policy_history["filter"] != policy["filter"]:
+            policy_history = {
+                "filter": policy["filter"],
+                "runs": 0,
+                "avg_seconds": seconds,
+                "max_seconds": 0.0,
+                "errors": 0,
+            }
+            self.history[key] = policy_history
+        policy_history["runs"] += 1
+        policy_history["avg_seconds"] = round(
+            (1 - self.smoothing) * policy_history["avg_seconds"]
+            + self.smoothing * seconds,
+            2,
+        )
+        policy_history["max_seconds"] = round(
+            max(policy_history["max_seconds"], seconds), 2
+        )
+        policy_history["last_seconds"] = round(seconds, 2)
+        policy_history["last_run"] = int(time.time())
+        if not ok:
+            policy_history["errors"] += 1
+        self.run_costs[key] = self.run_costs.get(key, 0.0) + seconds
+
+    def save(self):
+        with self.path.open("w", encoding="utf-8") as history_file:
+            json.dump(self.history, history_file, ensure_ascii=False, indent=4)
+
+    def summary(self):
+        """Самые дорогие фильтры текущего запуска по суммарному времени запросов"""
+        costs = sorted(self.run_costs.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "total_query_seconds": round(sum(self.run_costs.values()), 1),
+            "top_filters": {key: round(seconds, 1) for key, seconds in costs[:10]},
+        }
+
+
+class QueryTimer:
+    """Учет времени запроса внутри ограничителя, без ожидания свободного потока"""
+
+    def __init__(self, spent: dict, key):
+        self.spent = spent
+        self.key = key
+        self.started = 0.0
+
+    async def __aenter__(self):
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.spent[self.key] = (
+            self.spent.get(self.key, 0.0) + time.monotonic() - self.started
+        )
+        return False
+
+
+_history = None
+
+
+def get_query_history(settings, logger: logging.Logger):
+    """Общая на весь запуск история или None, если query_history выключен"""
+    global _history
+    if not settings.query_history:
+        return None
+    if _history is None:
+        _history = QueryHistory(settings, logger)
+        run_stats.sections["query_costs"] = _history
+    return _history
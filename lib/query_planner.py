@@ -0,0 +1,131 @@
+import re
+
+# разделитель актива и значения поля в host_ids общего запроса (UUID актива его не содержит)
+FAN_IN_SEP = "\x1f"
+
+_QUOTED = re.compile(r'("(?:[^"\\]|\\.)*")')
+_AND = re.compile(r"\s+and\s+", re.IGNORECASE)
+_OR = re.compile(r"\bor\b", re.IGNORECASE)
+_EQUALITY = re.compile(r'^([\w.]+)\s*=\s*("(?:[^"\\]|\\.)*"|-?\d+)$')
+_SELECT = re.compile(r"select\(([^)]*)\)")
+_GROUP_KEY = re.compile(r"group\(key: \[([^\]]*)\]")
+
+
+class FanInQuery:
+    """
+    Общий запрос группы фильтров, которые совпадают во всех условиях, кроме равенства по одному полю
+    (например, msgid). Поле добавляется в group(key) и в фильтр как field in [...],
+    строки ответа раздаются обратно по фильтрам группы.
+    """
+
+    # больше значений в одном запросе - больше строк в ответе и чаще деление по limit
+    max_values = 50
+
+    def __init__(self, number, field, prefix, tail, members):
+        self.number = number
+        self.field = field
+        self.prefix = prefix
+        self.tail = tail
+        # [(индекс задачи, политика, значение поля в виде литерала фильтра)]
+        self.members = members
+        self.task = None
+
+    def filter(self):
+        values = ", ".join(value for _, _, value in self.members)
+        return " and ".join([*self.prefix, f"{self.field} in [{values}]"])
+
+    def full_filter(self):
+        tail = _SELECT.sub(
+            lambda match: f"select({match.group(1)}, {self.field})", self.tail, 1
+        )
+        tail = _GROUP_KEY.sub(
+            lambda match: f"group(key: [{match.group(1)}, {self.field}]", tail, 1
+        )
+        return f"filter({self.filter()}){tail}"
+
+    def split(self, host_ids):
+        """Результат общего запроса по фильтрам группы, список в порядке members"""
+        parts = [{} for _ in self.members]
+        positions = {
+            _literal(value).casefold(): position
+            for position, (_, _, value) in enumerate(self.members)
+        }
+        for key, asset_info in host_ids.items():
+            asset, _, value = key.partition(FAN_IN_SEP)
+            position = positions.get(value.casefold())
+            if position is not None:
+                parts[position][asset] = asset_info
+        return parts
+
+
+def fan_in_key(asset, value):
+    return f"{asset}{FAN_IN_SEP}{value}"
+
+
+def plan_fan_in(queries):
+    """
+    Поиск фильтров, различающихся только равенством по одному полю.
+    queries - [(индекс задачи, политика)], возвращает группы из двух и более фильтров,
+    первыми набираются самые большие группы, каждый фильтр попадает не больше чем в одну
+    """
+    candidates = {}
+    for task_index, policy in queries:
+        head = f"filter({policy['filter']})"
+        if not policy["full_filter"].startswith(head):
+            continue
+        tail = policy["full_filter"][len(head) :]
+        if not _SELECT.search(tail) or not _GROUP_KEY.search(tail):
+            continue
+        predicates = _conjuncts(policy["filter"])
+        if predicates is None:
+            continue
+        for position, predicate in enumerate(predicates):
+            match = _EQUALITY.match(predicate)
+            if not match:
+                continue
+            prefix = tuple(sorted(predicates[:position] + predicates[position + 1 :]))
+            candidates.setdefault((match.group(1), prefix, tail), []).append(
+                (task_index, policy, match.group(2))
+            )
+    fan_ins = []
+    planned = set()
+    for key in sorted(candidates, key=lambda key: len(candidates[key]), reverse=True):
+        members = []
+        values = set()
+        for task_index, policy, value in candidates[key]:
+            if task_index in planned or _literal(value).casefold() in values:
+                continue
+            members.append((task_index, policy, value))
+            values.add(_literal(value).casefold())
+        for start in range(0, len(members), FanInQuery.max_values):
+            chunk = members[start : start + FanInQuery.max_values]
+            if len(chunk) < 2:
+                continue
+            field, prefix, tail = key
+            fan_ins.append(FanInQuery(len(fan_ins), field, list(prefix), tail, chunk))
+            planned.update(task_index for task_index, _, _ in chunk)
+    return fan_ins
+
+
+def _conjuncts(event_filter):
+    """Условия фильтра вида 'A and B and C' или None, если в фильтре есть or или скобки"""
+    predicates = [""]
+    for position, part in enumerate(_QUOTED.split(event_filter)):
+        if position % 2:
+            predicates[-1] += part
+            continue
+        if "(" in part or ")" in part or _OR.search(part):
+            return None
+        pieces = _AND.split(part)
+        predicates[-1] += pieces[0]
+        predicates.extend(pieces[1:])
+    predicates = [" ".join(predicate.split()) for predicate in predicates]
+    if not all(predicates):
+        return None
+    return predicates
+
+
+def _literal(value):
+    if value.startswith('"'):
+        return re.sub(r"\\(.)", r"\1", value[1:-1])
+    return value
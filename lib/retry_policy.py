@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from .run_stats import run_stats
+
+# коды ответа, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# коды, которыми ядро сообщает о перегрузке, они (и обрывы соединения) считаются для circuit breaker
+OVERLOAD_STATUSES = {429, 502, 503, 504}
+
+
+class RetryPolicy:
+    """
+    Общая на весь запуск политика повторов запросов к MaxPatrol.
+    Пауза перед попыткой N - случайная в [0, min(retry_max_seconds, retry_base_seconds * 2^(N-1))]
+    (full jitter), но не меньше Retry-After из ответа, поэтому упавшие одновременно запросы
+    не приходят повторно в один момент. На каждую группу API (endpoint) действует бюджет повторов
+    retry_budget на запуск. После circuit_breaker_failures перегрузок подряд все вызывающие
+    (sync и async) ждут circuit_breaker_seconds перед следующим запросом.
+    """
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.base = settings.retry_base_seconds
+        self.cap = max(settings.retry_max_seconds, settings.retry_base_seconds)
+        self.budget = settings.retry_budget
+        self.breaker_failures = settings.circuit_breaker_failures
+        self.breaker_seconds = settings.circuit_breaker_seconds
+        self.endpoints = {}
+        self.failures_in_row = 0
+        self.open_until = 0.0
+        self.circuit_opened = 0
+        # kb_checker и events_dl ходят в API из потоков
+        self.lock = threading.Lock()
+
+    def _endpoint(self, endpoint):
+        return self.endpoints.setdefault(
+            endpoint, {"requests": 0, "retries": 0, "gave_up": 0, "budget_left": None}
+        )
+
+    @staticmethod
+    def retry_after(headers):
+        """Retry-After в секундах (число или HTTP-дата) или None"""
+        if not headers:
+            return None
+        value = headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** max(attempt - 1, 0)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def ok(self, endpoint):
+        """Успешный ответ: сброс счетчика перегрузок подряд"""
+        with self.lock:
+            self._endpoint(endpoint)["requests"] += 1
+            self.failures_in_row = 0
+
+    def retry(self, endpoint, attempt, reason="", status=None, retry_after=None):
+        """
+        Учет неудачной попытки attempt (с 1) и решение о повторе.
+        Возвращает паузу перед повтором в секундах или None, если повторять нельзя:
+        кончились reconnect_times, бюджет endpoint или время запуска max_run_seconds.
+        status None - обрыв соединения или таймаут
+        """
+        with self.lock:
+            stats = self._endpoint(endpoint)
+            stats["requests"] += 1
+            if status is None or status in OVERLOAD_STATUSES:
+                self._overload(retry_after)
+            if attempt >= self.settings.reconnect_times:
+                stats["gave_up"] += 1
+                return None
+            if self.budget:
+                if stats["budget_left"] is None:
+                    stats["budget_left"] = self.budget
+                if stats["budget_left"] <= 0:
+                    stats["gave_up"] += 1
+                    return None
+                stats["budget_left"] -= 1
+                if stats["budget_left"] == 0:
+                    self.logger.warning(
+                        f"Retry budget {self.budget} for {endpoint} is exhausted, "
+                        f"next errors are not retried"
+                    )
+            delay = max(self.delay(attempt, retry_after), self.pause())
+            remaining = run_stats.remaining()
+            if remaining is not None and delay >= remaining:
+                stats["gave_up"] += 1
+                return None
+            stats["retries"] += 1
+        self.logger.debug(
+            f"Retry {endpoint} attempt {attempt + 1} after {delay:.1f} seconds: {reason}"
+        )
+        return delay
+
+    def _overload(self, retry_after=None):
+        self.failures_in_row += 1
+        if not self.breaker_failures or self.failures_in_row < self.breaker_failures:
+            return
+        pause = max(self.breaker_seconds, retry_after or 0)
+        if self.pause() < pause:
+            self.open_until = time.monotonic() + pause
+            self.circuit_opened += 1
+            self.logger.warning(
+                f"Core overloaded: {self.failures_in_row} failures in a row, "
+                f"all API calls paused for {pause:.0f} seconds"
+            )
+        self.failures_in_row = 0
+
+    def pause(self):
+        """Сколько секунд еще открыт circuit breaker"""
+        return max(0.0, self.open_until - time.monotonic())
+
+    async def wait(self):
+        """Ожидание закрытия circuit breaker перед запросом (async)"""
+        while self.pause() > 0:
+            await asyncio.sleep(self.pause())
+
+    def wait_sync(self):
+        """Ожидание закрытия circuit breaker перед запросом"""
+        while self.pause() > 0:
+            time.sleep(self.pause())
+
+    async def sleep(self, endpoint, attempt, reason="", status=None, retry_after=None):
+        """retry и пауза перед повтором (async), False - повторять нельзя"""
+        delay = self.retry(endpoint, attempt, reason, status, retry_after)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    def sleep_sync(self, endpoint, attempt, reason="", status=None, retry_after=None):
+        """retry и пауза перед повтором, False - повторять нельзя"""
+        delay = self.retry(endpoint, attempt, reason, status, retry_after)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    def send(self, endpoint, send_request, connection_errors=(OSError,)):
+        """
+        Синхронный запрос с повторами: send_request() возвращает requests.Response.
+        Повторяются обрывы соединения и ответы из RETRY_STATUSES, последний ответ возвращается
+        как есть, исключение последней попытки пробрасывается
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.wait_sync()
+            try:
+                response = send_request()
+            except connection_errors as Err:
+                if not self.sleep_sync(endpoint, attempt, str(Err)):
+                    raise
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                self.ok(endpoint)
+                return response
+            if not self.sleep_sync(
+                endpoint,
+                attempt,
+                f"code {response.status_code}",
+                response.status_code,
+                self.retry_after(response.headers),
+            ):
+                return response
+
+    def summary(self):
+        return {
+            "circuit_opened": self.circuit_opened,
+            "endpoints": {
+                endpoint: {
+                    "requests": stats["requests"],
+                    "retries": stats["retries"],
+                    "gave_up": stats["gave_up"],
+                }
+                for endpoint, stats in self.endpoints.items()
+            },
+        }
+
+
+_policy = None
+
+
+def get_retry_policy(settings, logger: logging.Logger):
+    """Общая на весь запуск политика повторов"""
+    global _policy
+    if _policy is None:
+        _policy = RetryPolicy(settings, logger)
+        run_stats.sections["retries"] = _policy
+    return _policy
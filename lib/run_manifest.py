@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+
+from .events import normalize_filter
+from .settings_checker import Settings
+
+
+class RunManifest:
+    """
+    Журнал выполненных запросов запуска в out_folder/!queries_done.jsonl.
+    Первая строка - окно запуска (time_to, time_delta_hours), далее по строке на каждый завершенный запрос
+    с путем к его JSON с host_ids. При resume окно берется из журнала, а запросы с тем же фильтром,
+    пачкой активов и окном не повторяются, их результат читается из файла.
+    """
+
+    settings: Settings
+    logger: logging.Logger
+    path: Path
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.path = self.settings.out_folder / "!queries_done.jsonl"
+        self.time_to = int(time.time())
+        self.done = {}
+        if self.settings.resume and self.path.is_file():
+            self._load()
+        else:
+            self._write_line(
+                {
+                    "time_to": self.time_to,
+                    "time_delta_hours": self.settings.time_delta_hours,
+                },
+                "w",
+            )
+
+    def _load(self):
+        with self.path.open("r", encoding="utf-8") as manifest_file:
+            lines = manifest_file.readlines()
+        header = json.loads(lines[0])
+        if header["time_delta_hours"] != self.settings.time_delta_hours:
+            self.logger.warning(
+                "time_delta_hours changed since the interrupted run, resume from scratch"
+            )
+            self._write_line(
+                {
+                    "time_to": self.time_to,
+                    "time_delta_hours": self.settings.time_delta_hours,
+                },
+                "w",
+            )
+            return
+        self.time_to = header["time_to"]
+        for line in lines[1:]:
+            try:
+                query = json.loads(line)
+            except ValueError:
+                # последняя строка могла не дописаться при обрыве
+                continue
+            self.done[query["key"]] = query["file"]
+        self.logger.info(
+            f"Resume run started at {self.time_to}: {len(self.done)} queries already done"
+        )
+
+    def _write_line(self, value, mode="a"):
+        with self.path.open(mode, encoding="utf-8") as manifest_file:
+            manifest_file.write(json.dumps(value, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def key(event_filter, param, time_from):
+        key_source = json.dumps(
+            [normalize_filter(event_filter), param, time_from], sort_keys=True
+        )
+        return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+    def take(self, key):
+        """host_ids уже выполненного запроса или None"""
+        if key not in self.done:
+            return None
+        result_path = Path(self.done[key])
+        try:
+            with result_path.open("r", encoding="utf-8") as result_file:
+                return json.load(result_file)["host_ids"]
+        except (OSError, ValueError, KeyError) as Err:
+            self.logger.warning(f"Can't resume from {result_path}: {Err}. Query again")
+            return None
+
+    def add(self, key, result_path: Path):
+        self.done[key] = str(result_path)
+        self._write_line({"key": key, "file": str(result_path)})
+
+
+_manifest = None
+
+
+def get_run_manifest(settings, logger: logging.Logger):
+    """Общий на весь запуск журнал запросов"""
+    global _manifest
+    if _manifest is None:
+        _manifest = RunManifest(settings, logger)
+    return _manifest
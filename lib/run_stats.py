@@ -0,0 +1,99 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+
+class RunStats:
+    """Статистика одного запуска скрипта для итоговой сводки (лог и out_folder/!run_summary.json)"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.limiters = {}
+        # прочие участники сводки с методом summary(): кэши и т.п.
+        self.sections = {}
+        # дробление запросов, уперевшихся в limit(100000): {фильтр: количество делений}
+        self.truncation = {"splits": {}, "truncated": {}}
+        # результаты existence_probe: {(фильтр, группа, начало окна): есть ли события}
+        self.existence = {}
+        self.deadline = None
+        self.deadline_reached = False
+        # фильтры активов, не начатые до max_run_seconds: отчеты без активов
+        self.not_measured_filters = []
+
+    def set_deadline(self, max_run_seconds):
+        """Граница запуска max_run_seconds от старта скрипта, 0 - без ограничения"""
+        if max_run_seconds:
+            self.deadline = self.started + max_run_seconds
+
+    def remaining(self):
+        """Сколько секунд осталось до границы запуска или None, если граница не задана"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def expired(self):
+        if self.remaining() == 0:
+            self.deadline_reached = True
+        return self.deadline_reached
+
+    def summary(self):
+        return {
+            "duration_seconds": round(time.time() - self.started, 1),
+            "deadline_reached": self.deadline_reached,
+            "not_measured_filters": self.not_measured_filters,
+            "limit_splits": self.truncation["splits"],
+            "limit_truncated": list(self.truncation["truncated"].keys()),
+            "existence_probe": {
+                "filters": len(self.existence),
+                "empty": list(self.existence.values()).count(False),
+            },
+            "limiters": {
+                name: limiter.summary() for name, limiter in self.limiters.items()
+            },
+            **{name: section.summary() for name, section in self.sections.items()},
+        }
+
+    def log_summary(self, logger: logging.Logger, out_folder: Path):
+        summary = self.summary()
+        logger.info(f"Run finished in {summary['duration_seconds']} seconds")
+        if self.deadline_reached:
+            logger.warning(
+                "Run deadline max_run_seconds reached, reports are partial: "
+                "unqueried filters are marked as not measured"
+            )
+        if self.not_measured_filters:
+            logger.warning(
+                f"Asset filters not measured before the deadline: {self.not_measured_filters}"
+            )
+        for name, limiter_summary in summary["limiters"].items():
+            logger.info(
+                f"API limiter {name}: limit {limiter_summary['limit']} "
+                f"(min {limiter_summary['min_limit_seen']}, max {limiter_summary['max_limit_seen']}), "
+                f"requests {limiter_summary['requests']}, errors {limiter_summary['errors']}, "
+                f"p95 {limiter_summary['p95_seconds']} seconds"
+            )
+        if self.truncation["splits"]:
+            logger.info(
+                f"Queries split on limit(100000): {sum(self.truncation['splits'].values())} splits "
+                f"in {len(self.truncation['splits'])} filters"
+            )
+        if self.truncation["truncated"]:
+            logger.error(
+                f"Still truncated on limit(100000): {list(self.truncation['truncated'].keys())}"
+            )
+        if self.existence:
+            logger.info(
+                f"Existence probe: {summary['existence_probe']['empty']} of "
+                f"{summary['existence_probe']['filters']} filters have no events"
+            )
+        for name in self.sections.keys():
+            logger.info(f"{name}: {summary[name]}")
+        if out_folder.is_dir():
+            with (out_folder / "!run_summary.json").open(
+                "w", encoding="utf-8"
+            ) as summary_file:
+                json.dump(summary, summary_file, ensure_ascii=False, indent=4)
+
+
+run_stats = RunStats()
@@ -57,11 +57,40 @@ class Settings(BaseSettings, **base_params):
     reconnect_times: int = Field(
         default=5,
         description="Количество попыток переподключения при ошибках "
-        "(интервал 5 сек)",
+        "(пауза между попытками растет экспоненциально от retry_base_seconds)",
         ge=1,
         le=2166,
         validation_alias=AliasChoices("r", "reconnect_times"),
     )
+    retry_base_seconds: int = Field(
+        default=5,
+        description="Базовая пауза перед повтором запроса в секундах. Пауза перед попыткой N выбирается "
+        "случайно от 0 до retry_base_seconds * 2^(N-1) (не больше retry_max_seconds), "
+        "Retry-After из ответа ядра соблюдается",
+        ge=1,
+    )
+    retry_max_seconds: int = Field(
+        default=120,
+        description="Максимальная пауза перед повтором запроса в секундах",
+        ge=1,
+    )
+    retry_budget: int = Field(
+        default=0,
+        description="Бюджет повторов на запуск для каждой группы API (events, assets_grid, kb, "
+        "incidents, auth). После исчерпания ошибки не повторяются. 0 - без ограничения",
+        ge=0,
+    )
+    circuit_breaker_failures: int = Field(
+        default=10,
+        description="Сколько перегрузок ядра подряд (429, 502-504, обрыв соединения, таймаут) "
+        "приостанавливают все запросы к API на circuit_breaker_seconds. 0 - не приостанавливать",
+        ge=0,
+    )
+    circuit_breaker_seconds: int = Field(
+        default=30,
+        description="Пауза всех запросов к API после перегрузки ядра в секундах",
+        ge=1,
+    )
     max_uuids_in_siem_query: int = Field(
         default=1000,
         description="Количество event_src.asset в фильтрах по событиям. "
@@ -70,6 +99,38 @@ class Settings(BaseSettings, **base_params):
         le=9999,
         validation_alias=AliasChoices("u", "max_uuids", "max_uuids_in_siem_query"),
     )
+    adaptive_uuids: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("adaptive_uuids", "adaptive_batch"),
+        description="Размер пачки активов подбирается для каждого фильтра: уменьшается вдвое при ошибке, "
+        "большом или долгом ответе и растет вдвое после легкого. Стартует с max_uuids_in_siem_query, "
+        "подобранные размеры хранятся в state_folder",
+    )
+    adaptive_uuids_min: int = Field(
+        default=100,
+        description="Только при adaptive_uuids. Минимальный размер пачки активов",
+        ge=10,
+        le=9999,
+    )
+    adaptive_uuids_max: int = Field(
+        default=5000,
+        description="Только при adaptive_uuids. Максимальный размер пачки активов",
+        ge=10,
+        le=9999,
+    )
+    adaptive_uuids_latency: int = Field(
+        default=60,
+        description="Только при adaptive_uuids. Время ответа в секундах, дольше которого пачка фильтра "
+        "уменьшается. 0 - не учитывать время ответа",
+        ge=0,
+    )
+    asset_page_threads: int = Field(
+        default=4,
+        description="Сколько страниц сетки активов (по 10000 записей) запрашивать параллельно после первой "
+        "полной страницы. 1 - по одной странице, как раньше",
+        ge=1,
+        le=32,
+    )
     max_threads_for_siem_api: int = Field(
         default=11,
         validation_alias=AliasChoices("t", "max_threads_for_siem_api", "max_threads"),
@@ -77,6 +138,157 @@ class Settings(BaseSettings, **base_params):
         ge=1,
         le=100,
     )
+    adaptive_threads: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("adaptive_threads", "aimd"),
+        description="Адаптивное (AIMD) количество потоков к API: стартует с max_threads_for_siem_api, "
+        "растет на 1, пока p95 времени ответа и доля ошибок в норме, и уменьшается вдвое на 5xx, "
+        "errors в ответе и таймаутах. Текущий лимит пишется в лог и в out_folder/!run_summary.json",
+    )
+    adaptive_max_threads: int = Field(
+        default=50,
+        description="Только при adaptive_threads. Верхняя граница количества потоков к API",
+        ge=1,
+        le=200,
+    )
+    adaptive_latency_p95: int = Field(
+        default=120,
+        description="Только при adaptive_threads. Целевое p95 времени ответа API в секундах, "
+        "выше него количество потоков не растет. 0 - не учитывать время ответа",
+        ge=0,
+    )
+    connection_pool_size: int = Field(
+        default=0,
+        description="Размер общего пула keep-alive соединений к MaxPatrol на весь запуск, одинаковый "
+        "для синхронных и асинхронных запросов. 0 - по количеству потоков к API",
+        ge=0,
+    )
+    connection_keepalive: int = Field(
+        default=60,
+        description="Сколько секунд держать простаивающее соединение из пула открытым",
+        ge=0,
+    )
+    http_connect_timeout: int = Field(
+        default=30,
+        description="Таймаут установки соединения с MaxPatrol в секундах",
+        ge=1,
+    )
+    http_read_timeout: int = Field(
+        default=600,
+        description="Таймаут ответа на запрос к API в секундах (кроме запросов событий, у которых "
+        "свой бюджет time_shard_timeout). 0 - без ограничения",
+        ge=0,
+    )
+    time_shards: int = Field(
+        default=1,
+        validation_alias=AliasChoices("time_shards", "shards"),
+        description="Количество частей, на которые делится окно запроса событий при ошибке, 5xx или "
+        "превышении time_shard_timeout. Части запрашиваются параллельно (в рамках max_threads_for_siem_api) "
+        "и складываются, отчет покрывает весь период time_delta_hours. "
+        "1 - старое поведение: при ошибке глубина запроса урезается вдвое",
+        ge=1,
+        le=168,
+    )
+    time_shard_max_hours: int = Field(
+        default=0,
+        description="Только при time_shards > 1. Максимальная длина окна одного запроса в часах, "
+        "более длинные окна сразу делятся на части. 0 - без ограничения",
+        ge=0,
+    )
+    time_shard_timeout: int = Field(
+        default=0,
+        description="Только при time_shards > 1. Бюджет времени ответа на один запрос в секундах, "
+        "после которого окно делится на части. 0 - без ограничения",
+        ge=0,
+    )
+    resume: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("resume", "continue"),
+        description="Продолжить прерванный запуск: out_folder не очищается, окно запроса берется из "
+        "out_folder/!queries_done.jsonl, выполненные запросы не повторяются, отчеты строятся как обычно",
+    )
+    max_run_seconds: int = Field(
+        default=0,
+        validation_alias=AliasChoices("max_run_seconds", "deadline"),
+        description="Ограничение времени запуска в секундах. По достижении незавершенные запросы отменяются, "
+        "отчеты строятся по уже собранным данным, а невыполненные фильтры помечаются как not measured. "
+        "0 - без ограничения",
+        ge=0,
+    )
+    state_folder: Path = Field(
+        default=Path("state"),
+        description="Папка для состояния между запусками (инкрементальный сбор и т.п.). "
+        "Не очищается вместе с out_folder",
+    )
+    incremental: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("incremental", "inc"),
+        description="Инкрементальный сбор событий: количества событий по активам хранятся в state_folder "
+        "по корзинам incremental_bucket_hours, следующий запуск запрашивает только время с прошлого "
+        "запуска. Окно отчета округляется вниз до границы корзины",
+    )
+    incremental_bucket_hours: int = Field(
+        default=24,
+        description="Только при incremental. Размер корзины в часах, при смене размера состояние "
+        "собирается заново",
+        ge=1,
+        le=168,
+    )
+    query_cache: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("query_cache", "cache"),
+        description="Кэш результатов запросов к SIEM и сетке активов в state_folder/query_cache.sqlite. "
+        "Окно запроса выравнивается по часу, поэтому повторный запуск в течение query_cache_ttl "
+        "(например, после правки отчета или одного фильтра) не ходит в SIEM",
+    )
+    query_cache_ttl: int = Field(
+        default=3600,
+        description="Только при query_cache. Время жизни записи кэша в секундах",
+        ge=1,
+    )
+    query_cache_max_mb: int = Field(
+        default=512,
+        description="Только при query_cache. Максимальный размер кэша в МБ, при превышении "
+        "удаляются давно не использованные записи",
+        ge=1,
+    )
+    query_history: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("query_history", "priority"),
+        description="История длительности запросов фильтров в state_folder/query_history.json. "
+        "Запросы запускаются от самых долгих к быстрым (mandatory_policies и specific_politics всегда первыми), "
+        "самые дорогие фильтры запуска пишутся в out_folder/!run_summary.json",
+    )
+    existence_probe: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("existence_probe", "probe"),
+        description="Перед запросами по пачкам активов каждый фильтр один раз запрашивается без ограничения "
+        "по активам с limit(1). Фильтры без событий во всем окне по пачкам не запрашиваются",
+    )
+    query_fan_in: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("query_fan_in", "fan_in"),
+        description="Фильтры, различающиеся только равенством по одному полю (например, msgid), "
+        "запрашиваются одним запросом: поле добавляется в group(key), строки ответа раздаются по фильтрам",
+    )
+    parallel_filters: int = Field(
+        default=1,
+        ge=1,
+        le=32,
+        description="Только для режима Assets_filters. Сколько фильтров из asset_filters_file "
+        "обрабатывается одновременно. Фильтр с dynamic-ссылкой ждет активы фильтра, на который ссылается, "
+        "запросы к SIEM всех фильтров ограничены общим max_threads_for_siem_api",
+    )
+    asset_pipeline: bool = Field(
+        default=False,
+        description="Пачки активов уходят в запросы событий по мере скачивания страниц сетки активов, "
+        "без ожидания всей сетки. Отчет строится после завершения обоих этапов",
+    )
+    xlsx_streaming: bool = Field(
+        default=False,
+        description="Excel отчет пишется в режиме constant_memory: ячейки копятся во временной базе на диске "
+        "и переносятся в листы по строкам при закрытии книги. Для отчетов на сотни тысяч активов",
+    )
     out_folder: Path = Field(
         default=Path("out"),
         validation_alias=AliasChoices("o", "out_folder", "out_dir"),
@@ -170,6 +382,14 @@ class Settings(BaseSettings, **base_params):
         validation_alias=AliasChoices("privileges", "check_privileges"),
         description="Будет ли выполнена проверка привилегий после первичной аутентификации.",
     )
+    events_matrix: bool = Field(
+        default=False,
+        validation_alias=AliasChoices("events_matrix", "matrix"),
+        description="Только для режима Assets_filters. Каждый уникальный фильтр политик запрашивается "
+        "один раз за запуск по объединению активов всех фильтров из asset_filters_file. "
+        "Результат сохраняется в матрицу актив × фильтр (out_folder/!events_matrix.json), "
+        "отчеты фильтров собираются из нее без повторных запросов в SIEM",
+    )
     dl_mode: bool = False
     dl_table: str = ""
     datalake_chunk_size: int = 10000
@@ -206,7 +426,12 @@ class Settings(BaseSettings, **base_params):
             exit(1)
         logging.basicConfig(level=self.logging_level)
         logger = logging.getLogger("MaxPatrolEventsMonitor")
-        if self.mode == "Assets_filters" and self.clear_mode != "full":
+        if self.resume:
+            logger.info(
+                f"Resume mode: keep {self.out_folder.absolute()} and run only missing queries"
+            )
+            self.out_folder.mkdir(parents=True, exist_ok=True)
+        elif self.mode == "Assets_filters" and self.clear_mode != "full":
             if not self.out_folder.exists():
                 self.out_folder.mkdir()
             elif self.clear_mode == "not_clear":
@@ -286,6 +511,63 @@ class Settings(BaseSettings, **base_params):
                     f"Not all dl_attrs wrote in .config.env. Absent dl_attr: {dl_attrs}. dl_mode disable."
                 )
                 self.dl_mode = False
+        if self.events_matrix:
+            if self.mode != "Assets_filters":
+                logger.error(
+                    "events_matrix using only in 'Assets_filters' mode. events_matrix disable."
+                )
+                self.events_matrix = False
+            elif self.dl_mode or old_python:
+                logger.error(
+                    "events_matrix not supported with dl_mode or old Python. events_matrix disable."
+                )
+                self.events_matrix = False
+        if self.time_shards > 1 and (self.dl_mode or old_python):
+            logger.error(
+                "time_shards not supported with dl_mode or old Python. time_shards disable."
+            )
+            self.time_shards = 1
+        if self.incremental and (self.dl_mode or old_python):
+            logger.error(
+                "incremental not supported with dl_mode or old Python. incremental disable."
+            )
+            self.incremental = False
+        if self.adaptive_uuids:
+            if self.dl_mode or old_python or self.incremental:
+                logger.error(
+                    "adaptive_uuids not supported with dl_mode, incremental or old Python. "
+                    "adaptive_uuids disable."
+                )
+                self.adaptive_uuids = False
+            elif self.adaptive_uuids_min > self.adaptive_uuids_max:
+                logger.error(
+                    f"adaptive_uuids_min {self.adaptive_uuids_min} more than adaptive_uuids_max "
+                    f"{self.adaptive_uuids_max}. Use adaptive_uuids_max for both."
+                )
+                self.adaptive_uuids_min = self.adaptive_uuids_max
+        if self.existence_probe and (self.dl_mode or old_python or self.incremental):
+            logger.error(
+                "existence_probe not supported with dl_mode, incremental or old Python. existence_probe disable."
+            )
+            self.existence_probe = False
+        if self.query_fan_in and (self.dl_mode or old_python or self.incremental):
+            logger.error(
+                "query_fan_in not supported with dl_mode, incremental or old Python. query_fan_in disable."
+            )
+            self.query_fan_in = False
+        if self.parallel_filters > 1 and (
+            self.dl_mode or old_python or self.events_matrix
+        ):
+            logger.error(
+                "parallel_filters not supported with dl_mode, events_matrix or old Python. "
+                "parallel_filters disable."
+            )
+            self.parallel_filters = 1
+        if self.asset_pipeline and (self.dl_mode or old_python):
+            logger.error(
+                "asset_pipeline not supported with dl_mode or old Python. asset_pipeline disable."
+            )
+            self.asset_pipeline = False
 
 
 def check_group_id(group_id, where, logger: Optional[logging.Logger] = None):
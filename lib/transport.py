@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import ssl
+
+import requests
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from requests.adapters import HTTPAdapter
+
+
+class _PoolAdapter(HTTPAdapter):
+    """HTTPAdapter с общим SSL-контекстом транспорта"""
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+class Transport:
+    """
+    Общий на весь запуск HTTP-транспорт к MaxPatrol, принадлежит MPXAuthenticator.
+    Синхронные запросы идут через один requests.Session, асинхронные - через пул TCPConnector
+    текущего event loop. У обоих одинаковый размер пула keep-alive соединений, один SSL-контекст
+    и таймауты http_connect_timeout/http_read_timeout, поэтому TLS-рукопожатие к ядру делается
+    один раз на соединение, а не на каждый запрос.
+    """
+
+    session: requests.Session
+
+    def __init__(self, settings, logger: logging.Logger):
+        self.settings = settings
+        self.logger = logger
+        self.pool_size = self.settings.connection_pool_size
+        if not self.pool_size:
+            self.pool_size = self.settings.max_threads_for_siem_api
+            if self.settings.adaptive_threads:
+                self.pool_size = max(self.pool_size, self.settings.adaptive_max_threads)
+        # проверка сертификата ядра выключена во всем скрипте (verify=False)
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.timeout = (
+            self.settings.http_connect_timeout,
+            self.settings.http_read_timeout or None,
+        )
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            _PoolAdapter(
+                self.ssl_context, pool_connections=4, pool_maxsize=self.pool_size
+            ),
+        )
+        # {event loop: [пул соединений, количество открытых сессий]}
+        self._connectors = {}
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("verify", False)
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def open_session(self, headers=None, cookies=None):
+        """
+        Асинхронная сессия поверх общего пула соединений текущего event loop.
+        Сессию нужно закрыть через close_session, пул закрывается вместе с последней сессией loop
+        """
+        loop = asyncio.get_running_loop()
+        for other_loop in [other for other in self._connectors if other.is_closed()]:
+            # asyncio.run уже закрыл loop вместе с его соединениями
+            self._connectors.pop(other_loop)
+        if loop not in self._connectors:
+            self._connectors[loop] = [
+                TCPConnector(
+                    limit=self.pool_size,
+                    keepalive_timeout=self.settings.connection_keepalive,
+                    ssl=self.ssl_context,
+                ),
+                0,
+            ]
+        self._connectors[loop][1] += 1
+        return ClientSession(
+            connector=self._connectors[loop][0],
+            connector_owner=False,
+            headers=headers,
+            cookies=cookies,
+            timeout=ClientTimeout(
+                total=self.settings.http_read_timeout or None,
+                sock_connect=self.settings.http_connect_timeout,
+            ),
+        )
+
+    async def close_session(self, session: ClientSession):
+        await session.close()
+        loop = asyncio.get_running_loop()
+        if loop not in self._connectors:
+            return
+        self._connectors[loop][1] -= 1
+        if self._connectors[loop][1] <= 0:
+            connector, _ = self._connectors.pop(loop)
+            await connector.close()
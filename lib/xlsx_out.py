@@ -1,7 +1,11 @@
 import json
 import logging
+import os
+import pickle
 import re
+import sqlite3
 import sys
+import tempfile
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional
@@ -13,6 +17,10 @@ if sys.version.find("3.7.") == 0:
     from typing import Any
 
 
+# значение ячейки фильтра, запрос которого не выполнен до max_run_seconds
+NOT_MEASURED = "not measured"
+
+
 class MonitorXlsxWriter:
     class MainFormats:
         white: xlsxwriter.workbook.Format
@@ -65,15 +73,26 @@ class MonitorXlsxWriter:
         delta_hours: int,
         need_up_file: bool,
         logger: logging.Logger,
+        streaming: bool = False,
     ):
-        """Активация класса"""
+        """
+        Активация класса. streaming - xlsx_streaming: книга constant_memory, ячейки до
+        finish копятся в _ReportSpool на диске
+        """
         self.logger = logger
         self.main_out_path = main_out_path
         self._set_workbook_path(main_out_path, mpx, need_up_file)
-        self.workbook = xlsxwriter.Workbook(self.workbook_path)
+        self.spool = None
+        if streaming:
+            self.workbook = xlsxwriter.Workbook(
+                self.workbook_path, {"constant_memory": True}
+            )
+            self.spool = _ReportSpool()
+        else:
+            self.workbook = xlsxwriter.Workbook(self.workbook_path)
         self.worksheets = {
-            "simple": self.workbook.add_worksheet("simple"),
-            "FULL": self.workbook.add_worksheet("FULL"),
+            "simple": self._add_worksheet("simple"),
+            "FULL": self._add_worksheet("FULL"),
         }
         self._add_formats()
         self.delta_hours = delta_hours
@@ -126,6 +145,28 @@ class MonitorXlsxWriter:
         self.kb_check = {}
         self.worksheets_line_starter = {}
 
+    def _add_worksheet(self, name):
+        sheet = self.workbook.add_worksheet(name)
+        if self.spool is not None:
+            return self.spool.add_sheet(sheet)
+        return sheet
+
+    def finish(self):
+        """Перенос буфера xlsx_streaming в листы. Вызывается один раз перед workbook.close()"""
+        if self.spool is None:
+            return
+        spool, self.spool = self.spool, None
+        self.logger.info(
+            f"write {spool.cells + len(spool.pending)} spooled report calls"
+        )
+        spool.replay()
+
+    def drop_spool(self):
+        """Удаление буфера xlsx_streaming отчета, который не дошел до finish"""
+        if self.spool is not None:
+            spool, self.spool = self.spool, None
+            spool.close()
+
     def _set_workbook_path(self, main_out_path: Path, mpx: str, need_up_file: bool):
         current_time = datetime.now().strftime("%Y-%m-%d")
         if need_up_file:
@@ -321,7 +362,7 @@ class MonitorXlsxWriter:
         self.worksheets_line_number["simple"] += 9
 
     def prepare_pol_sheets(self, policy_name, policy, out_path):
-        self.worksheets.update({policy_name: self.workbook.add_worksheet(policy_name)})
+        self.worksheets.update({policy_name: self._add_worksheet(policy_name)})
         self.worksheets[policy_name].write(0, 0, policy_name, self.formats.cyan)  # A1
         self.worksheets[policy_name].write(1, 0, "Фильтр")  # A2
         self.worksheets_line_number.update({policy_name: 1})
@@ -427,6 +468,18 @@ class MonitorXlsxWriter:
         self.kb_view[policy_name]["row"] += 1
         self.prepare_stat_for_kb(policy_name, policy, out_path)
 
+    def mark_limit_splits(self, policy_name, filter_index, splits, truncated):
+        """Пометка у фильтра на листе политики, что ответ упирался в limit(100000) и дробился"""
+        if truncated:
+            note, color = "limit(100000): результат обрезан", self.formats.red
+        else:
+            note, color = (
+                f"limit(100000): разбит, делений {splits}",
+                self.formats.orange,
+            )
+        # строки фильтров начинаются с A3 (см. prepare_pol_sheets)
+        self.worksheets[policy_name].write(2 + filter_index, 5, note, color)
+
     def prepare_stat_for_kb(self, policy_name, policy, out_path: Path):
         self.kb_check[policy_name] = {}
         if self.kb_installed:
@@ -646,7 +699,12 @@ class MonitorXlsxWriter:
         no_assets,
         out_path: Path,
         mandatory_policies=None,
+        not_measured=None,
     ):
+        """
+        not_measured - фильтры, запросы которых не успели выполниться до max_run_seconds:
+        {политика: {номер фильтра: активы}}. Вместо 0 в них пишется NOT_MEASURED
+        """
         col_sizer = []
         event_quality_array = []
         index_row = self.worksheets_line_number["FULL"]
@@ -773,6 +831,7 @@ class MonitorXlsxWriter:
             pol_out_list = []
             full_policies = []
             part_policies = []
+            asset_not_measured = False
             for policy in small_policies.keys():
                 if (
                     "policies" in asset_dict[asset].keys()
@@ -804,6 +863,12 @@ class MonitorXlsxWriter:
                                 # TODO вот тут проверка что мы вышли за трешхолд и надо красить фиолетовым
                                 color = self.formats.green
                                 value = full_info[index_filter_str]
+                            elif _is_not_measured(
+                                not_measured, policy, index_filter_str, asset
+                            ):
+                                color = self.formats.yellow
+                                value = NOT_MEASURED
+                                asset_not_measured = True
                             else:
                                 color = self.formats.red
                                 empty_fields.append("0")
@@ -825,7 +890,15 @@ class MonitorXlsxWriter:
                     else:
                         part_policies.append(policy)
                 else:
-                    pol_out_list.extend(["", ""])
+                    policy_not_measured = [
+                        _is_not_measured(not_measured, policy, str(index_filter), asset)
+                        for index_filter in range(len(small_policies[policy]))
+                    ]
+                    if any(policy_not_measured):
+                        asset_not_measured = True
+                        pol_out_list.extend([NOT_MEASURED, ""])
+                    else:
+                        pol_out_list.extend(["", ""])
                     if mandatory_policies and policy in mandatory_policies:
                         self.worksheets_line_number[policy] += 1
                         if not e_host_info and "asset_info" in asset_dict[asset]:
@@ -848,19 +921,20 @@ class MonitorXlsxWriter:
                             [asset, e_host_info],
                             self.formats.white,
                         )
-                        empty_fields = []
-                        for _ in small_policies[policy]:
-                            empty_fields.append(0)
-                        self.worksheets[policy].write_row(
-                            self.worksheets_line_number[policy],
-                            self.start_col_second + 2,
-                            empty_fields,
-                            self.formats.red,
-                        )
                         for index_filter, filter_query in enumerate(
                             small_policies[policy]
                         ):
-                            policies_statistic[policy][filter_query] = False
+                            if policy_not_measured[index_filter]:
+                                value, color = NOT_MEASURED, self.formats.yellow
+                            else:
+                                value, color = 0, self.formats.red
+                                policies_statistic[policy][filter_query] = False
+                            self.worksheets[policy].write(
+                                self.worksheets_line_number[policy],
+                                self.start_col_second + 2 + index_filter,
+                                value,
+                                color,
+                            )
             if extra_info:
                 for extra_index in range(len(extra_info) + 1):
                     self.worksheets["FULL"].write_row(
@@ -897,6 +971,11 @@ class MonitorXlsxWriter:
                 self.worksheets["simple"].write(
                     index_row_no_extra, 0, simple_status, self.formats.green
                 )
+            elif asset_not_measured:
+                # часть запросов не выполнена до max_run_seconds, отсутствие событий не доказано
+                self.worksheets["simple"].write(
+                    index_row_no_extra, 0, NOT_MEASURED, self.formats.yellow
+                )
             else:
                 self.worksheets["simple"].write(
                     index_row_no_extra, 0, simple_status, self.formats.red
@@ -1059,6 +1138,13 @@ def _asset_info_to_list(asset_info, col_sizer):
     return attrs_list, col_sizer, index_col, extra_info, simple_attrs
 
 
+def _is_not_measured(not_measured, policy, filter_index, asset):
+    if not not_measured or filter_index not in not_measured.get(policy, {}):
+        return False
+    assets = not_measured[policy][filter_index]
+    return asset in assets or "*" in assets
+
+
 def _status_master(full_simple_attrs, small_attrs, mandatory_policies=None):
     simple_pol_st_os = False
     simple_audit_st = False
@@ -1126,3 +1212,157 @@ def _status_master(full_simple_attrs, small_attrs, mandatory_policies=None):
         if not simple_pol_st_os:
             list_to_return.append("os events")
     return ", ".join(list_to_return), empty_policies
+
+
+class _FormatRef:
+    """Формат ячейки в буфере _ReportSpool: сами Format привязаны к книге и не сериализуются"""
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _ReportSpool:
+    """
+    Буфер ячеек отчета для xlsx_streaming. Лист constant_memory принимает ячейки только по
+    возрастанию строк, а отчет пишет статистику, пакеты экспертизы и таблицы политик не по
+    порядку. Вызовы записи сохраняются во временную базу SQLite на диске и в replay переносятся
+    в листы по (лист, строка, порядок вызова). В памяти только пачка вставки и форматы
+    """
+
+    insert_batch = 10000
+
+    def __init__(self):
+        fd, name = tempfile.mkstemp(prefix="report_", suffix=".sqlite")
+        os.close(fd)
+        self.path = Path(name)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute(
+            "CREATE TABLE cells (seq INTEGER PRIMARY KEY, sheet INTEGER, row INTEGER, "
+            "method TEXT, args BLOB)"
+        )
+        self.pending = []
+        self.formats = []
+        self.format_index = {}
+        self.sheets = []
+        self.cells = 0
+
+    def add_sheet(self, sheet: xlsxwriter.workbook.Worksheet):
+        self.sheets.append(sheet)
+        return _SpooledWorksheet(self, len(self.sheets) - 1, sheet)
+
+    def add(self, sheet_id, row, method, args):
+        args = tuple(self._format_ref(arg) for arg in args)
+        self.pending.append(
+            (sheet_id, row, method, pickle.dumps(args, pickle.HIGHEST_PROTOCOL))
+        )
+        if len(self.pending) >= self.insert_batch:
+            self._insert()
+
+    def _format_ref(self, cell_format):
+        """Format заменяется ссылкой на список форматов, остальные аргументы - как есть"""
+        if not isinstance(cell_format, xlsxwriter.workbook.Format):
+            return cell_format
+        index = self.format_index.get(id(cell_format))
+        if index is None:
+            index = len(self.formats)
+            self.format_index[id(cell_format)] = index
+            self.formats.append(cell_format)
+        return _FormatRef(index)
+
+    def _insert(self):
+        self.connection.executemany(
+            "INSERT INTO cells (sheet, row, method, args) VALUES (?, ?, ?, ?)",
+            self.pending,
+        )
+        self.cells += len(self.pending)
+        self.pending = []
+
+    def replay(self):
+        """Перенос ячеек в листы по возрастанию строк, после него буфер удаляется"""
+        try:
+            self._insert()
+            self.connection.execute(
+                "CREATE INDEX cells_order ON cells (sheet, row, seq)"
+            )
+            for sheet_id, method, args in self.connection.execute(
+                "SELECT sheet, method, args FROM cells ORDER BY sheet, row, seq"
+            ):
+                args = [
+                    self.formats[arg.index] if isinstance(arg, _FormatRef) else arg
+                    for arg in pickle.loads(args)
+                ]
+                getattr(self.sheets[sheet_id], method)(*args)
+        finally:
+            self.close()
+
+    def close(self):
+        self.connection.close()
+        if self.path.exists():
+            self.path.unlink()
+
+
+class _SpooledWorksheet:
+    """
+    Лист отчета в режиме xlsx_streaming: запись ячеек уходит в _ReportSpool, остальные
+    методы (set_column, autofilter, hide) вызываются у листа сразу
+    """
+
+    def __init__(self, spool: _ReportSpool, sheet_id, sheet):
+        self.spool = spool
+        self.sheet_id = sheet_id
+        self.sheet = sheet
+
+    def write(self, row, col, *args):
+        self.spool.add(self.sheet_id, row, "write", (row, col) + args)
+
+    def write_blank(self, row, col, *args):
+        self.spool.add(self.sheet_id, row, "write_blank", (row, col) + args)
+
+    def write_formula(self, row, col, *args):
+        self.spool.add(self.sheet_id, row, "write_formula", (row, col) + args)
+
+    def write_row(self, row, col, data, cell_format=None):
+        self.spool.add(
+            self.sheet_id, row, "write_row", (row, col, list(data), cell_format)
+        )
+
+    def write_column(self, row, col, data, cell_format=None):
+        for offset, value in enumerate(data):
+            self.write(row + offset, col, value, cell_format)
+
+    def set_row(self, row, *args):
+        self.spool.add(self.sheet_id, row, "set_row", (row,) + args)
+
+    def merge_range(
+        self, first_row, first_col, last_row, last_col, data, cell_format=None
+    ):
+        if first_row == last_row and first_col == last_col:
+            # xlsxwriter не объединяет одну ячейку и ничего не пишет
+            return self.sheet.merge_range(
+                first_row, first_col, last_row, last_col, data, cell_format
+            )
+        first_row, last_row = sorted((first_row, last_row))
+        first_col, last_col = sorted((first_col, last_col))
+        # merge_range листа без формата: он проверяет и регистрирует объединение и пишет
+        # только первую ячейку, пустые ячейки без формата xlsxwriter пропускает. Иначе
+        # constant_memory выгрузил бы строки объединения раньше их остальных ячеек.
+        # Ячейки с форматом пишутся дальше по своим строкам
+        self.spool.add(
+            self.sheet_id,
+            first_row,
+            "merge_range",
+            (first_row, first_col, last_row, last_col, data),
+        )
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                if row == first_row and col == first_col:
+                    self.write(row, col, data, cell_format)
+                else:
+                    self.write_blank(row, col, None, cell_format)
+
+    def __getattr__(self, name):
+        return getattr(self.sheet, name)
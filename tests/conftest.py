@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from lib import (
+    batch_sizer,
+    grid_cache,
+    incremental,
+    query_cache,
+    query_history,
+    retry_policy,
+    run_manifest,
+    run_stats,
+)
+from lib.settings_checker import Settings
+
+# модули с общими на запуск объектами get_*()
+_SINGLETONS = [
+    (batch_sizer, "_sizer"),
+    (grid_cache, "_cache"),
+    (incremental, "_state"),
+    (query_cache, "_cache"),
+    (query_history, "_history"),
+    (retry_policy, "_policy"),
+    (run_manifest, "_manifest"),
+]
+
+
+@pytest.fixture(autouse=True)
+def fresh_run(monkeypatch):
+    """Каждый тест - отдельный запуск: своя статистика и свои get_*() объекты"""
+    # модули импортируют сам объект run_stats, поэтому он сбрасывается на месте
+    run_stats.run_stats.__init__()
+    for module, name in _SINGLETONS:
+        monkeypatch.setattr(module, name, None)
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("tests")
+
+
+@pytest.fixture
+def make_settings(tmp_path):
+    """Параметры запуска по умолчанию из Settings без разбора CLI и подготовки папок"""
+
+    def make(**overrides):
+        values = {
+            name: field.get_default(call_default_factory=True)
+            for name, field in Settings.model_fields.items()
+        }
+        values["mpx_host"] = "mpx.test"
+        values["out_folder"] = tmp_path / "out"
+        values["state_folder"] = tmp_path / "state"
+        values.update(overrides)
+        # папку выводов создает Settings.valid_group_and_folder_prepare
+        values["out_folder"].mkdir(parents=True, exist_ok=True)
+        return SimpleNamespace(**values)
+
+    return make
+
+
+class FakeTransport:
+    """Transport без соединений: считает открытые и закрытые сессии, отдает session"""
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.session = object()
+
+    def open_session(self, headers, cookies):
+        self.opened += 1
+        return self.session
+
+    async def close_session(self, session):
+        self.closed += 1
+
+
+class FakeResponse:
+    """Ответ aiohttp, delay - задержка ответа в секундах"""
+
+    def __init__(self, status, body=None, headers=None, delay=0):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.delay = delay
+
+    async def json(self, content_type="application/json"):
+        return self.body
+
+    async def __aenter__(self):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeSession:
+    """Сессия aiohttp, ответ на запрос выдает respond(method, url, kwargs)"""
+
+    def __init__(self, respond):
+        self.respond = respond
+
+    def get(self, url, **kwargs):
+        return self.respond("GET", url, kwargs)
+
+    def post(self, url=None, **kwargs):
+        return self.respond("POST", url, kwargs)
+
+
+@pytest.fixture
+def fake_auth():
+    return SimpleNamespace(transport=FakeTransport(), headers={}, cookies={})
+
+
+class FakePolicies(SimpleNamespace):
+    """EventPolicies с готовыми rebuilt_policies без разбора event_policies.json"""
+
+    def view(self):
+        return self
+
+    def filter_policies(self, *args):
+        pass
+
+
+@pytest.fixture
+def make_policies():
+    """make_policies(("политика", номер, full_filter), ...)"""
+
+    def make(*filters, mandatory=()):
+        return FakePolicies(
+            rebuilt_policies=[
+                {
+                    "name": name,
+                    "number": number,
+                    "filter": full_filter,
+                    "full_filter": full_filter,
+                }
+                for name, number, full_filter in filters
+            ],
+            small_policies={name: {} for name, _, _ in filters},
+            mandatory_policies=list(mandatory),
+        )
+
+    return make
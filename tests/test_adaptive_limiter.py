@@ -0,0 +1,110 @@
+import asyncio
+
+from lib.adaptive_limiter import AdaptiveLimiter
+
+
+def run_tasks(limiter, count, release, order, peak):
+    async def task(number):
+        async with limiter:
+            order.append(number)
+            peak.append(limiter.in_flight)
+            await release.wait()
+
+    return [asyncio.create_task(task(number)) for number in range(count)]
+
+
+def test_waiters_get_slots_in_queue_order(logger):
+    async def scenario():
+        limiter = AdaptiveLimiter("test", 1, logger)
+        release = asyncio.Event()
+        order, peak = [], []
+        tasks = run_tasks(limiter, 4, release, order, peak)
+        await asyncio.sleep(0)
+        assert order == [0]
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, peak, limiter
+
+    order, peak, limiter = asyncio.run(scenario())
+    assert order == [0, 1, 2, 3]
+    assert max(peak) == 1
+    assert limiter.in_flight == 0
+
+
+def test_raised_limit_wakes_only_free_slots(logger):
+    async def scenario():
+        limiter = AdaptiveLimiter("test", 1, logger, adaptive=True, max_limit=10)
+        release = asyncio.Event()
+        order, peak = [], []
+        tasks = run_tasks(limiter, 6, release, order, peak)
+        await asyncio.sleep(0)
+        limiter._set_limit(3, "test")
+        # повторное пробуждение до запуска разбуженных задач не отдает лишних слотов
+        limiter._wake()
+        assert limiter.in_flight == 3
+        assert len(limiter._waiters) == 3
+        await asyncio.sleep(0)
+        assert order == [0, 1, 2]
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, peak
+
+    order, peak = asyncio.run(scenario())
+    assert order == [0, 1, 2, 3, 4, 5]
+    assert max(peak) == 3
+
+
+def test_cancelled_woken_waiter_passes_slot_on(logger):
+    async def scenario():
+        limiter = AdaptiveLimiter("test", 1, logger)
+        release = asyncio.Event()
+        order, peak = [], []
+        tasks = run_tasks(limiter, 3, release, order, peak)
+        await asyncio.sleep(0)
+        release.set()
+        # задача 1 разбужена, но отменена до того, как заняла слот
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return order, limiter
+
+    order, limiter = asyncio.run(scenario())
+    assert order == [0, 2]
+    assert limiter.in_flight == 0
+
+
+def test_overload_halves_and_success_round_increases(logger):
+    async def scenario():
+        limiter = AdaptiveLimiter("test", 4, logger, adaptive=True, max_limit=8)
+        for _ in range(4):
+            async with limiter:
+                pass
+        assert limiter.limit == 5
+
+        async def failing():
+            async with limiter:
+                limiter.overload("code 503")
+
+        await failing()
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert limiter.limit == 2
+    assert limiter.min_limit_seen == 2
+    assert limiter.max_limit_seen == 5
+    assert limiter.errors == 1
+
+
+def test_not_adaptive_keeps_limit(logger):
+    async def scenario():
+        limiter = AdaptiveLimiter("test", 2, logger)
+        async with limiter:
+            limiter.overload("code 503")
+        for _ in range(10):
+            async with limiter:
+                pass
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert limiter.limit == 2
+    assert limiter.requests == 11
@@ -0,0 +1,127 @@
+import asyncio
+
+from conftest import FakeResponse, FakeSession
+
+from lib.asset import AssetWorker, _AssetPages
+
+PDQL = "filter(host.fqdn != null) | select(@host as asset_id, host.fqdn)"
+TOKEN = {
+    "token": "t",
+    "fields": [
+        {"name": "asset_id", "type": "uuid"},
+        {"name": "host.fqdn", "type": "string"},
+    ],
+}
+
+
+def asset_worker(make_settings, logger, auth=None, **overrides):
+    return AssetWorker(
+        make_settings(**overrides),
+        auth,
+        logger,
+        None,
+        "f",
+        {"PDQL": PDQL, "group": "-1", "default_politics_blacklist": []},
+    )
+
+
+def page(first, count):
+    return [{"asset_id": f"id{n}"} for n in range(first, first + count)]
+
+
+def test_pages_emitted_in_offset_order():
+    emitted = []
+    pages = _AssetPages(page(0, 2), 2, emitted.append)
+    assert not pages.done()
+    for number in (1, 2, 3):
+        assert pages.need_more(0, 3)
+        assert pages.take_next() == number
+    assert not pages.need_more(3, 3)
+    pages.add(3, page(6, 1))
+    pages.add(2, page(4, 2))
+    assert emitted == [page(0, 2)]
+    pages.add(1, page(2, 2))
+    assert emitted == [page(0, 2), page(2, 2), page(4, 2), page(6, 1)]
+    assert pages.done()
+    # за концом данных страницы не запрашиваются
+    assert not pages.need_more(0, 3)
+    assert [row["asset_id"] for row in pages.records()] == [f"id{n}" for n in range(7)]
+
+
+def test_pages_after_short_page_are_dropped():
+    pages = _AssetPages(page(0, 2), 2)
+    for _ in range(3):
+        pages.take_next()
+    pages.add(3, [])
+    pages.add(1, page(2, 1))
+    # страница за концом данных, пришедшая позже короткой
+    pages.add(2, page(3, 2))
+    assert pages.done()
+    assert len(pages.records()) == 3
+
+
+def test_lost_page_fails_all_records():
+    pages = _AssetPages(page(0, 2), 2)
+    pages.take_next()
+    pages.add(1, None)
+    assert not pages.need_more(0, 3)
+    assert pages.records() is None
+
+
+def test_token_request_retries_and_saves_response(make_settings, logger, tmp_path):
+    worker = asset_worker(
+        make_settings, logger, retry_base_seconds=0, retry_max_seconds=0
+    )
+    requests = []
+    responses = [FakeResponse(503), FakeResponse(200, TOKEN)]
+
+    def respond(method, url, kwargs):
+        requests.append((method, kwargs["json"]))
+        return responses.pop(0)
+
+    response, fields, asset_id_field, _ = asyncio.run(
+        worker.create_pdql_token_async(FakeSession(respond), tmp_path)
+    )
+    assert response == TOKEN
+    assert (fields, asset_id_field) == (["asset_id", "host.fqdn"], "asset_id")
+    assert requests[1] == (
+        "POST",
+        {
+            "pdql": PDQL,
+            "selectedGroupIds": ["00000000-0000-0000-0000-000000000002"],
+            "includeNestedGroups": True,
+            "utcOffset": "+03:00",
+        },
+    )
+    assert (tmp_path / "create_pdql_token_2.json").is_file()
+
+
+def test_bad_pdql_gives_empty_token(make_settings, logger, tmp_path):
+    worker = asset_worker(make_settings, logger)
+    session = FakeSession(lambda *args: FakeResponse(400, {"message": "bad"}))
+    assert asyncio.run(worker.create_pdql_token_async(session, tmp_path)) == (
+        {},
+        [],
+        "",
+        {},
+    )
+
+
+def test_work_takes_token_and_pages_in_one_session(
+    make_settings, logger, fake_auth, tmp_path
+):
+    worker = asset_worker(make_settings, logger, fake_auth)
+
+    def respond(method, url, kwargs):
+        if method == "POST":
+            return FakeResponse(200, TOKEN)
+        records = [{"asset_id": "id1", "host.fqdn": "one"}, {"asset_id": None}]
+        return FakeResponse(200, {"records": records})
+
+    fake_auth.transport.session = FakeSession(respond)
+    asset_dict, fields, no_assets = worker.work(tmp_path)
+    assert list(asset_dict) == ["id1"]
+    assert fields == ["asset_id", "host.fqdn"]
+    assert no_assets == [{"asset_id": None}]
+    assert fake_auth.transport.opened == fake_auth.transport.closed == 1
+    assert (tmp_path / "take_assets_0.json").is_file()
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+from conftest import FakeResponse, FakeSession
+
+from lib.asset import AssetWorker
+
+PDQL = "filter(host.fqdn != null) | select(@host as asset_id)"
+
+
+def asset_worker(make_settings, logger, auth=None, **overrides):
+    return AssetWorker(
+        make_settings(**overrides),
+        auth,
+        logger,
+        None,
+        "f",
+        {"PDQL": PDQL, "group": "-1", "default_politics_blacklist": []},
+    )
+
+
+def grid(total, fail_offset=None):
+    """Ответы /data по смещению для сетки из total записей, запросы в полете считаются"""
+    calls = {"offsets": [], "in_flight": 0, "max_in_flight": 0}
+
+    def respond(method, url, kwargs):
+        offset, limit = kwargs["params"]["offset"], kwargs["params"]["limit"]
+        calls["offsets"].append(offset)
+        if offset == fail_offset:
+            return FakeResponse(503, {"error": "busy"})
+        records = [
+            {"asset_id": f"id{n}"} for n in range(offset, min(total, offset + limit))
+        ]
+        return Tracked(calls, 200, {"records": records}, delay=0.01 * (offset % 3))
+
+    return calls, FakeSession(respond)
+
+
+class Tracked(FakeResponse):
+    def __init__(self, calls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = calls
+
+    async def __aenter__(self):
+        self.calls["in_flight"] += 1
+        self.calls["max_in_flight"] = max(
+            self.calls["max_in_flight"], self.calls["in_flight"]
+        )
+        try:
+            return await super().__aenter__()
+        finally:
+            self.calls["in_flight"] -= 1
+
+
+def test_pages_taken_concurrently_in_offset_order(make_settings, logger, tmp_path):
+    worker = asset_worker(make_settings, logger, asset_page_threads=3)
+    calls, session = grid(23)
+    seen = []
+    records = asyncio.run(
+        worker.take_asset_pages_async(session, "t", tmp_path, 5, seen.append)
+    )
+    assert [record["asset_id"] for record in records] == [f"id{n}" for n in range(23)]
+    assert [len(page) for page in seen] == [5, 5, 5, 5, 3]
+    assert calls["max_in_flight"] == 3
+    # после короткой страницы новые смещения не запрашиваются
+    assert max(calls["offsets"]) <= 5 * 7
+    page = json.loads((tmp_path / "take_assets_4.json").read_text("utf-8"))
+    assert len(page["records"]) == 3
+
+
+def test_one_thread_takes_pages_one_by_one(make_settings, logger, tmp_path):
+    worker = asset_worker(make_settings, logger, asset_page_threads=1)
+    calls, session = grid(10)
+    records = asyncio.run(worker.take_asset_pages_async(session, "t", tmp_path, 5))
+    assert len(records) == 10
+    assert calls["offsets"] == [0, 5, 10]
+    assert calls["max_in_flight"] == 1
+
+
+def test_lost_page_fails_filter(make_settings, logger, tmp_path, monkeypatch):
+    worker = asset_worker(make_settings, logger, asset_page_threads=2)
+
+    async def no_retry(*args):
+        return False
+
+    monkeypatch.setattr(worker.retry, "sleep", no_retry)
+    calls, session = grid(100, fail_offset=10)
+    assert asyncio.run(worker.take_asset_pages_async(session, "t", tmp_path, 5)) is None
+    # после потерянной страницы следующие смещения не запрашиваются
+    assert max(calls["offsets"]) < 10 + 5 * 2
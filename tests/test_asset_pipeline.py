@@ -0,0 +1,88 @@
+import asyncio
+
+from conftest import FakeResponse, FakeSession
+
+from lib.asset import AssetWorker
+
+PDQL = "filter(host.fqdn != null) | select(@host as asset_id)"
+TOKEN = {"token": "t", "fields": [{"name": "asset_id", "type": "uuid"}]}
+
+
+def pipeline_worker(make_settings, logger, fake_auth, total, **overrides):
+    """AssetWorker, у которого сетка из total активов отдается страницами по 10000"""
+    settings = make_settings(asset_pipeline=True, asset_page_threads=1, **overrides)
+    worker = AssetWorker(
+        settings,
+        fake_auth,
+        logger,
+        None,
+        "f",
+        {"PDQL": PDQL, "group": "-1", "default_politics_blacklist": []},
+    )
+    pages = []
+
+    def respond(method, url, kwargs):
+        if method == "POST":
+            return FakeResponse(200, TOKEN)
+        offset, limit = kwargs["params"]["offset"], kwargs["params"]["limit"]
+        pages.append(offset)
+        records = [
+            {"asset_id": f"id{n}"} for n in range(offset, min(total, offset + limit))
+        ]
+        if offset:
+            # повтор актива из первой страницы
+            records.append({"asset_id": "id0"})
+        return FakeResponse(200, {"records": records}, delay=0.01)
+
+    fake_auth.transport.session = FakeSession(respond)
+    return worker, pages
+
+
+class StreamWorker:
+    """EventsWorker.work_stream: пачки и число скачанных к ним страниц"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.batches = []
+
+    async def work_stream(self, group_id, batches):
+        async for asset_ids, out_dir in batches:
+            self.batches.append((len(asset_ids), out_dir.name, len(self.pages)))
+
+
+def test_batches_start_before_last_page(make_settings, logger, fake_auth):
+    worker, pages = pipeline_worker(
+        make_settings, logger, fake_auth, 25000, max_uuids_in_siem_query=8000
+    )
+    out_folder = worker.settings.out_folder / "f"
+    out_folder.mkdir()
+    ev = StreamWorker(pages)
+    (asset_dict, fields, no_assets), events_taken = asyncio.run(
+        worker._pipeline(ev, out_folder)
+    )
+    assert events_taken
+    assert len(asset_dict) == 25000
+    assert fields == ["asset_id"]
+    assert ev.batches[0][:2] == (8000, "0-8000")
+    # первая пачка ушла в запросы событий до последней страницы
+    assert ev.batches[0][2] < 3
+    assert [batch[:2] for batch in ev.batches[1:]] == [
+        (8000, "8000-16000"),
+        (8000, "16000-24000"),
+        (1000, "24000-25000"),
+    ]
+    assert all((out_folder / name).is_dir() for _, name, _ in ev.batches)
+    assert fake_auth.transport.opened == fake_auth.transport.closed == 1
+
+
+def test_small_grid_is_one_batch_in_filter_folder(make_settings, logger, fake_auth):
+    worker, pages = pipeline_worker(
+        make_settings, logger, fake_auth, 30, max_uuids_in_siem_query=8000
+    )
+    out_folder = worker.settings.out_folder / "f"
+    out_folder.mkdir()
+    ev = StreamWorker(pages)
+    (asset_dict, _, _), events_taken = asyncio.run(worker._pipeline(ev, out_folder))
+    assert events_taken
+    assert len(asset_dict) == 30
+    assert ev.batches == [(30, "f", 1)]
@@ -0,0 +1,46 @@
+import json
+
+from lib.asset_store import ANSWER_AGAIN, AssetRow, AssetStore, json_default
+
+RECORDS = [
+    {"asset_id": "id1", "host.fqdn": "one.local", "ports": [22, 80]},
+    {"asset_id": "id2", "host.fqdn": "two.local", "ports": [80, 22]},
+    {"asset_id": "id1", "host.ip": "10.0.0.1", "ports": [22, 80]},
+    {"asset_id": None, "host.fqdn": "one.local", "count": 1, "flag": True},
+]
+
+
+def test_rows_read_back_as_records():
+    store = AssetStore(RECORDS)
+    assert len(store) == 4
+    assert [row.to_dict() for row in store] == RECORDS
+    assert store[-1]["count"] == 1 and store[-1]["flag"] is True
+    # поле, которого нет в записи, отсутствует и в строке
+    assert "host.ip" not in store[0]
+    assert store[2].get("host.fqdn") is None
+    assert list(store[2]) == ["asset_id", "ports", "host.ip"]
+
+
+def test_equal_values_stored_once():
+    store = AssetStore(RECORDS)
+    # 1 и True различаются, одинаковые списки хранятся один раз
+    assert store.summary() == {"rows": 4, "columns": 6, "unique_values": 10}
+    assert store[0]["ports"] is store[2]["ports"]
+    store.extend([{"asset_id": "id2"}])
+    assert store.summary()["unique_values"] == 10
+
+
+def test_answered_again_leaves_shared_row_unchanged():
+    store = AssetStore(RECORDS)
+    row = store[0]
+    again = row.answered_again(RECORDS[2])
+    assert again[ANSWER_AGAIN] == [RECORDS[2]]
+    assert ANSWER_AGAIN in again.keys()
+    assert ANSWER_AGAIN not in row.keys()
+    assert isinstance(again, AssetRow) and again["asset_id"] == "id1"
+
+
+def test_json_default_dumps_rows_and_store():
+    store = AssetStore(RECORDS[:2])
+    dumped = json.dumps({"store": store, "row": store[1]}, default=json_default)
+    assert json.loads(dumped) == {"store": RECORDS[:2], "row": RECORDS[1]}
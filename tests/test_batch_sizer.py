@@ -0,0 +1,100 @@
+import asyncio
+
+from lib.batch_sizer import BatchSizer
+from lib.events import ROWS_LIMIT, EventsWorker
+
+POLICY = {"name": "A", "number": 0}
+
+
+def make_sizer(make_settings, logger, **overrides):
+    values = {
+        "adaptive_uuids": True,
+        "max_uuids_in_siem_query": 100,
+        "adaptive_uuids_min": 10,
+        "adaptive_uuids_max": 400,
+        "adaptive_uuids_latency": 60,
+    }
+    values.update(overrides)
+    return BatchSizer(make_settings(**values), logger)
+
+
+def test_size_starts_from_max_uuids_within_bounds(make_settings, logger):
+    assert make_sizer(make_settings, logger).size("k") == 100
+    assert make_sizer(make_settings, logger, max_uuids_in_siem_query=5).size("k") == 10
+    assert (
+        make_sizer(make_settings, logger, max_uuids_in_siem_query=1000).size("k") == 400
+    )
+
+
+def test_heavy_answers_halve_light_full_batches_double(make_settings, logger):
+    sizer = make_sizer(make_settings, logger)
+    sizer.feedback("k", POLICY, 100, True, 10, 1.0)
+    assert sizer.size("k") == 200
+    # неполная пачка ничего не говорит о большем размере
+    sizer.feedback("k", POLICY, 50, True, 10, 1.0)
+    assert sizer.size("k") == 200
+    sizer.feedback("k", POLICY, 200, True, ROWS_LIMIT // 2, 1.0)
+    assert sizer.size("k") == 100
+    sizer.feedback("k", POLICY, 100, True, 10, 61.0)
+    assert sizer.size("k") == 50
+    sizer.feedback("k", POLICY, 30, False, 0, 1.0)
+    assert sizer.size("k") == 15
+    sizer.feedback("k", POLICY, 15, False, 0, 1.0)
+    assert sizer.size("k") == 10
+    # средний ответ размер не меняет
+    sizer.feedback("k", POLICY, 10, True, ROWS_LIMIT // 4, 1.0)
+    assert sizer.size("k") == 10
+    assert sizer.summary() == {
+        "filters": 1,
+        "changes": 5,
+        "min_size": 10,
+        "max_size": 10,
+    }
+
+
+def test_sizes_survive_restart(make_settings, logger):
+    sizer = make_sizer(make_settings, logger)
+    key = BatchSizer.key("filter(a)  | limit(1)")
+    sizer.feedback(key, POLICY, 100, True, 10, 1.0)
+    sizer.save()
+    again = make_sizer(make_settings, logger)
+    assert again.size(BatchSizer.key("filter(a) | limit(1)")) == 200
+
+
+def test_take_sized_queries_assets_in_parts(
+    make_settings, logger, make_policies, tmp_path
+):
+    settings = make_settings(
+        adaptive_uuids=True,
+        max_uuids_in_siem_query=2,
+        adaptive_uuids_min=1,
+        adaptive_uuids_max=8,
+    )
+    worker = EventsWorker(settings, logger, make_policies(("A", 0, "q")), None)
+    parts = []
+
+    async def take_complete(
+        param, event_filter, time_from, time_to, file_path, policy, part_assets, *args
+    ):
+        parts.append(part_assets)
+        return True, {
+            asset: {"count": 1, "event_src.host": ["h"]} for asset in part_assets
+        }
+
+    worker._take_complete = take_complete
+    assets = [str(number) for number in range(9)]
+    all_ok, host_ids = asyncio.run(
+        worker._take_sized(
+            {},
+            0,
+            10,
+            tmp_path / "A.txt",
+            worker.policies.rebuilt_policies[0],
+            assets,
+            "event_src",
+        )
+    )
+    assert all_ok
+    assert list(host_ids) == assets
+    # после каждого легкого ответа пачка растет вдвое
+    assert [len(part) for part in parts] == [2, 4, 3]
@@ -0,0 +1,101 @@
+import asyncio
+import zipfile
+
+from event_checker import MaxPatrolEventsMonitor
+from lib.asset import NOT_MEASURED_FILE, AssetWorker
+from lib.events import EventsWorker
+from lib.run_stats import RunStats, run_stats
+from lib.xlsx_out import NOT_MEASURED
+
+
+def test_remaining_and_expired(monkeypatch):
+    stats = RunStats()
+    assert stats.remaining() is None
+    assert not stats.expired()
+    stats.set_deadline(10)
+    monkeypatch.setattr("lib.run_stats.time.time", lambda: stats.started + 4)
+    assert stats.remaining() == 6
+    assert not stats.expired()
+    monkeypatch.setattr("lib.run_stats.time.time", lambda: stats.started + 11)
+    assert stats.remaining() == 0
+    assert stats.expired()
+    assert stats.summary()["deadline_reached"]
+
+
+def test_queries_past_deadline_are_not_measured(
+    make_settings, logger, make_policies, fake_auth, tmp_path
+):
+    policies = make_policies(("fast", 0, "q1"), ("slow", 0, "q2"), ("dup", 0, "q2"))
+    worker = EventsWorker(make_settings(), logger, policies, fake_auth)
+
+    async def take_events(group_id, time_from, event_filter, out_folder, policy, *args):
+        if policy["name"] == "slow":
+            await asyncio.sleep(10)
+        return {"x": {"count": 1, "event_src.host": ["h"]}}
+
+    worker.take_events = take_events
+    run_stats.set_deadline(0.2)
+    result = asyncio.run(worker.work_batches("-1", [(["x"], tmp_path)]))
+    assert run_stats.deadline_reached
+    fast, slow, dup = result.rebuilt_policies
+    assert list(fast["host_ids"]) == ["x"]
+    assert "not_measured" not in fast
+    # отмененный запрос общий у фильтров с одинаковым запросом
+    for policy in (slow, dup):
+        assert policy["host_ids"] == {}
+        assert policy["not_measured"] == ["x"]
+
+
+def test_cancelled_batch_without_assets_marks_all(
+    make_settings, logger, make_policies, tmp_path
+):
+    policies = make_policies(("a", 0, "q1"), ("b", 0, "q2"))
+    worker = EventsWorker(make_settings(), logger, policies, None)
+
+    async def gather():
+        done = asyncio.ensure_future(asyncio.sleep(0, {"y": {"count": 1}}))
+        never = asyncio.ensure_future(asyncio.sleep(10))
+        run_stats.set_deadline(0.05)
+        return await worker._gather_until_deadline([done, never])
+
+    results = asyncio.run(gather())
+    assert results == [{"y": {"count": 1}}, None]
+    worker._apply_batch_results(results, [0, 1], None, tmp_path)
+    assert policies.rebuilt_policies[1]["not_measured"] == ["*"]
+    assert policies.rebuilt_policies[0]["host_ids"] == {"y": {"count": 1}}
+
+
+def test_filter_not_started_gets_not_measured_report(
+    make_settings, logger, make_policies, tmp_path
+):
+    settings = make_settings()
+    out_folder = settings.out_folder / "late"
+    out_folder.mkdir()
+    worker = AssetWorker(
+        settings,
+        None,
+        logger,
+        make_policies(("a", 0, "q1")),
+        "late",
+        {"PDQL": "filter(x)", "group": "-1", "comment": "nightly"},
+    )
+    worker.expect_grid()
+    worker.not_measured_take_info(out_folder, True)
+    (report,) = settings.out_folder.glob("*-late-*.xlsx")
+    with zipfile.ZipFile(report) as book:
+        strings = book.read("xl/sharedStrings.xml").decode("utf-8")
+    assert f"{NOT_MEASURED}: run deadline max_run_seconds reached" in strings
+    assert "nightly" in strings
+    assert (out_folder / NOT_MEASURED_FILE).is_file()
+    assert worker.grid_cache.expected == {}
+    assert run_stats.summary()["not_measured_filters"] == ["late"]
+
+
+def test_not_measured_report_collected_again_on_resume(make_settings):
+    monitor = MaxPatrolEventsMonitor.__new__(MaxPatrolEventsMonitor)
+    monitor.settings = make_settings()
+    (monitor.settings.out_folder / "late").mkdir()
+    (monitor.settings.out_folder / "2026-01-01-late-mpx.xlsx").touch()
+    assert monitor.filter_has_report("late")
+    (monitor.settings.out_folder / "late" / NOT_MEASURED_FILE).touch()
+    assert not monitor.filter_has_report("late")
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from lib import asset
+from lib.asset import _classify_host, _read_taken_records, work_with_dynamic
+
+HOSTS_FILTER = {
+    "filter_name": "nginx_backends",
+    "prefix": "<ProxyPass>.lstrip('htps').lstrip(':/').split(':')[0]",
+    "need_dict": True,
+    "dict_keys": ["hostnames", "FQDNs", "IPs"],
+    "filter": "host.hostname in <ProxyPass>['hostnames'] or "
+    "host.fqdn in <ProxyPass>['FQDNs'] or addr in <ProxyPass>['IPs']",
+}
+
+
+@pytest.fixture(autouse=True)
+def no_kept_records(monkeypatch):
+    monkeypatch.setattr(asset, "_kept_records", {})
+
+
+def classify(*values):
+    found = {"hostnames": {}, "FQDNs": {}, "IPs": {}}
+    for value in values:
+        _classify_host(value, found)
+    return {key: list(values) for key, values in found.items()}
+
+
+def test_classify_host_keeps_baseline_rules():
+    assert classify(
+        "10.0.0.1",
+        "127.0.0.1",
+        "127.0.0.2",
+        "999.1.1.1",
+        "010.0.0.1",
+        "web.corp.local",
+        "web",
+        "localhost",
+        "10.0.0.1",
+    ) == {
+        # как и раньше, снимается только 127.0.0.1, диапазон чисел не проверяется
+        "IPs": ["10.0.0.1", "127.0.0.2", "999.1.1.1", "010.0.0.1"],
+        "FQDNs": ["web.corp.local"],
+        "hostnames": ["web"],
+    }
+
+
+def save_pages(folder, *pages):
+    folder.mkdir(parents=True)
+    (folder / "!take_assets.json").write_text("{}", "utf-8")
+    for number, records in enumerate(pages):
+        page_path = folder / f"take_assets_{number}.json"
+        page_path.write_text(json.dumps({"records": records}), "utf-8")
+
+
+def test_records_of_previous_run_read_from_pages_in_order(logger, tmp_path):
+    folder = tmp_path / "source"
+    pages = [[{"n": n}] for n in range(12)]
+    save_pages(folder, *pages)
+    assert _read_taken_records(folder, "source", logger) == [
+        {"n": n} for n in range(12)
+    ]
+    assert _read_taken_records(tmp_path / "missing", "missing", logger) is None
+
+
+def test_records_of_this_run_taken_from_memory(logger, tmp_path):
+    folder = tmp_path / "source"
+    save_pages(folder, [{"n": "page"}])
+    asset._kept_records[folder] = [{"n": "memory"}]
+    assert _read_taken_records(folder, "source", logger) == [{"n": "memory"}]
+
+
+def test_work_with_dynamic_builds_host_filter(logger, tmp_path):
+    save_pages(
+        tmp_path / "nginx_backends",
+        [
+            {"ProxyPass": "http://web.corp.local:8080"},
+            {"ProxyPass": "https://10.1.1.1:443"},
+            {"ProxyPass": "http://127.0.0.1:80"},
+        ],
+        [{"ProxyPass": "http://web.corp.local:8081"}],
+    )
+    static_filter, main_values = work_with_dynamic(
+        HOSTS_FILTER, tmp_path / "dependent", logger
+    )
+    assert static_filter == (
+        "host.hostname in ['web'] or host.fqdn in ['web.corp.local'] or "
+        "addr in [10.1.1.1]"
+    )
+    assert main_values == {
+        "host.hostname": ["web"],
+        "host.fqdn": ["web.corp.local"],
+        "addr": ["10.1.1.1"],
+    }
+
+
+def test_work_with_dynamic_without_source_assets(logger, tmp_path):
+    save_pages(tmp_path / "nginx_backends", [])
+    assert work_with_dynamic(HOSTS_FILTER, tmp_path / "dependent", logger) == ("", {})
+    assert work_with_dynamic(
+        dict(HOSTS_FILTER, filter_name="missing"), tmp_path / "dependent", logger
+    ) == ("", {})
@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from lib.events import EventsWorker
+
+
+def test_batches_share_one_session_and_apply_in_order(
+    make_settings, logger, make_policies, fake_auth, tmp_path
+):
+    transport = fake_auth.transport
+    worker = EventsWorker(
+        make_settings(),
+        logger,
+        make_policies(("A", 0, "q1"), ("B", 0, "q2")),
+        fake_auth,
+    )
+    started = []
+
+    async def take_events(group_id, time_from, event_filter, out_folder, policy, *args):
+        started.append((out_folder.name, "start"))
+        await asyncio.sleep(0.01 if out_folder.name == "b1" else 0)
+        started.append((out_folder.name, "end"))
+        asset = "x" if out_folder.name == "b1" else "y"
+        return {asset: {"count": 1, "event_src.host": [policy["name"]]}}
+
+    worker.take_events = take_events
+    batches = []
+    for name, asset_ids in (("b1", ["x"]), ("b2", ["y"])):
+        (tmp_path / name).mkdir()
+        batches.append((asset_ids, tmp_path / name))
+    policies = asyncio.run(worker.work_batches("-1", batches))
+    assert transport.opened == transport.closed == 1
+    # запросы второй пачки не ждут окончания первой
+    assert started.index(("b2", "start")) < started.index(("b1", "end"))
+    assert [set(policy["host_ids"]) for policy in policies.rebuilt_policies] == [
+        {"x", "y"},
+        {"x", "y"},
+    ]
+    first = json.loads((tmp_path / "b1" / "!out_all.json").read_text("utf-8"))
+    assert [set(policy["host_ids"]) for policy in first] == [{"x"}, {"x"}]
+
+
+def test_no_policies_opens_no_session(
+    make_settings, logger, make_policies, fake_auth, tmp_path
+):
+    worker = EventsWorker(make_settings(), logger, make_policies(), fake_auth)
+    assert asyncio.run(worker.work_batches("-1", [(["x"], tmp_path)])) == ([], {})
+    assert fake_auth.transport.opened == 0
@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+from lib.events import EventsWorker, normalize_filter
+
+
+def fake_take_events(calls):
+    async def take_events(group_id, time_from, event_filter, out_folder, policy, *args):
+        calls.append(event_filter)
+        return {"a1": {"count": 1, "event_src.host": ["host1"]}}
+
+    return take_events
+
+
+def test_normalize_filter_collapses_whitespace():
+    assert normalize_filter(" filter(id = 1)\n  |  limit(10) ") == (
+        "filter(id = 1) | limit(10)"
+    )
+
+
+def test_identical_queries_run_once(make_settings, logger, make_policies, tmp_path):
+    policies = make_policies(
+        ("A", 0, "filter(id = 1) | limit(100000)"),
+        ("B", 0, "filter(id = 1)  |\n limit(100000)"),
+        ("B", 1, "filter(id = 2) | limit(100000)"),
+    )
+    worker = EventsWorker(make_settings(), logger, policies, None)
+    calls = []
+    worker.take_events = fake_take_events(calls)
+
+    async def schedule():
+        group_tasks, query_indexes = worker._schedule_batch("-1", ["a1"], tmp_path)
+        return await asyncio.gather(*group_tasks), query_indexes
+
+    unique_results, query_indexes = asyncio.run(schedule())
+    assert len(calls) == 2
+    assert query_indexes == [0, 0, 1]
+    assert len(unique_results) == 2
+
+
+def test_shared_result_is_copied_for_each_policy(
+    make_settings, logger, make_policies, tmp_path
+):
+    policies = make_policies(("A", 0, "q"), ("B", 0, "q"))
+    worker = EventsWorker(make_settings(), logger, policies, None)
+    shared = {"a1": {"count": 1, "event_src.host": ["host1"]}}
+    worker._apply_batch_results([shared], [0, 0], ["a1"], tmp_path)
+    first, second = worker.policies.rebuilt_policies
+    assert first["host_ids"] == second["host_ids"] == shared
+    second["host_ids"]["a1"]["count"] = 7
+    assert first["host_ids"]["a1"]["count"] == 1
+    saved = json.loads((tmp_path / "!out_all.json").read_text(encoding="utf-8"))
+    assert [policy["host_ids"]["a1"]["count"] for policy in saved] == [1, 1]
@@ -0,0 +1,80 @@
+import asyncio
+
+from lib.events import EventsWorker
+from lib.events_matrix import EventsMatrix
+
+
+def test_matrix_has_shared_worker_attributes(make_settings, logger, make_policies):
+    settings = make_settings()
+    worker = EventsWorker(settings, logger, make_policies(), None)
+    matrix = EventsMatrix(settings, logger, make_policies(), None)
+    assert set(vars(worker)) <= set(vars(matrix))
+    assert matrix.retry is worker.retry
+    assert matrix.semaphore is worker.semaphore
+
+
+def test_add_filter_dedupes_queries_and_keeps_asset_order(
+    make_settings, logger, make_policies
+):
+    matrix = EventsMatrix(make_settings(), logger, make_policies(), None)
+    matrix.add_filter(make_policies(("A", 0, "q1"), ("A", 1, "q2")), ["a2", "a1"])
+    matrix.add_filter(make_policies(("B", 0, "q1"), ("B", 1, "q3")), ["a1", "a3"])
+    assert [p["full_filter"] for p in matrix.policies.rebuilt_policies] == [
+        "q1",
+        "q2",
+        "q3",
+    ]
+    assert list(matrix.asset_ids) == ["a2", "a1", "a3"]
+    assert set(matrix.policies.small_policies) == {"A", "B"}
+
+
+def test_take_events_from_matrix_slices_by_assets(make_settings, logger, make_policies):
+    matrix = EventsMatrix(make_settings(), logger, make_policies(), None)
+    matrix.matrix = {"q1": {"a1": {"count": 1}, "a2": {"count": 2}}}
+    sliced = asyncio.run(matrix.take_events_from_matrix("q1", ["a2", "a3"]))
+    assert sliced == {"a2": {"count": 2}}
+    sliced["a2"]["count"] = 5
+    assert matrix.matrix["q1"]["a2"]["count"] == 2
+    assert asyncio.run(matrix.take_events_from_matrix("q9", [])) == {}
+
+
+def test_collect_rerun_clears_old_batch_folders(
+    make_settings, logger, tmp_path, make_policies
+):
+    settings = make_settings(max_uuids_in_siem_query=2)
+    matrix_folder = tmp_path / "out" / "!events_matrix"
+    (matrix_folder / "0-2").mkdir(parents=True)
+    (matrix_folder / "0-2" / "stale.json").write_text("{}")
+    matrix = EventsMatrix(settings, logger, make_policies(), None)
+    matrix.add_filter(make_policies(("A", 0, "q1")), ["a1", "a2", "a3"])
+    batches = []
+
+    async def work_batches(group_id, taken):
+        batches.extend(taken)
+
+    matrix.work_batches = work_batches
+    matrix.collect("-1", matrix_folder)
+    assert [(ids, folder.name) for ids, folder in batches] == [
+        (["a1", "a2"], "0-2"),
+        (["a3"], "2-3"),
+    ]
+    assert not (matrix_folder / "0-2" / "stale.json").exists()
+    assert (tmp_path / "out" / "!events_matrix.json").is_file()
+
+
+def test_collect_resume_keeps_batch_folders(
+    make_settings, logger, tmp_path, make_policies
+):
+    settings = make_settings(resume=True)
+    matrix_folder = tmp_path / "out" / "!events_matrix"
+    (matrix_folder / "0-1").mkdir(parents=True)
+    (matrix_folder / "0-1" / "done.json").write_text("{}")
+    matrix = EventsMatrix(settings, logger, make_policies(), None)
+    matrix.add_filter(make_policies(("A", 0, "q1")), ["a1"])
+
+    async def work_batches(group_id, taken):
+        pass
+
+    matrix.work_batches = work_batches
+    matrix.collect("-1", matrix_folder)
+    assert (matrix_folder / "0-1" / "done.json").is_file()
@@ -0,0 +1,56 @@
+import asyncio
+
+from lib.events import EventsWorker, _existence_key
+from lib.run_stats import run_stats
+
+
+def test_existence_key_ignores_whitespace():
+    assert _existence_key("a  and\n b", "-1", 5) == _existence_key("a and b", "-1", 5)
+    assert _existence_key("a", "-1", 5) != _existence_key("a", ["g"], 5)
+
+
+def test_filters_without_events_skip_asset_batches(
+    make_settings, logger, make_policies, fake_auth, tmp_path
+):
+    policies = make_policies(
+        ("found", 0, "q1 | limit(100000)"),
+        ("empty", 0, "q2 | limit(100000)"),
+        ("failed", 0, "q3 | limit(100000)"),
+    )
+    worker = EventsWorker(
+        make_settings(existence_probe=True), logger, policies, fake_auth
+    )
+    probes = []
+    queried = []
+
+    async def take_window(param, event_filter, time_from, time_to, file_path, shard):
+        probes.append(event_filter)
+        if event_filter.startswith("q2"):
+            return True, {}
+        if event_filter.startswith("q3"):
+            return False, {}
+        return True, {"a": {"count": 1, "event_src.host": ["h"]}}
+
+    async def take_events(group_id, time_from, event_filter, out_folder, policy, *args):
+        queried.append((out_folder.name, policy["name"]))
+        return {args[0][0]: {"count": 1, "event_src.host": ["h"]}}
+
+    worker._take_window = take_window
+    worker.take_events = take_events
+    batches = []
+    for name in ("b1", "b2"):
+        (tmp_path / name).mkdir()
+        batches.append(([name], tmp_path / name))
+    result = asyncio.run(worker.work_batches("-1", batches))
+    # проверка одна на запуск и запрашивает одну строку
+    assert sorted(probes) == ["q1 | limit(1)", "q2 | limit(1)", "q3 | limit(1)"]
+    assert list(run_stats.existence.values()).count(False) == 1
+    assert sorted(queried) == [
+        ("b1", "failed"),
+        ("b1", "found"),
+        ("b2", "failed"),
+        ("b2", "found"),
+    ]
+    empty = result.rebuilt_policies[1]
+    assert empty["host_ids"] == {}
+    assert "not_measured" not in empty
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+from lib.events import EventsWorker, ResultTruncated
+from lib.query_planner import fan_in_key, plan_fan_in
+from lib.run_stats import run_stats
+
+TAIL = (
+    " | select(time, event_src.asset, event_src.host)"
+    " | group(key: [event_src.asset, event_src.host], agg: COUNT(*) as Cnt)"
+    " | limit(100000)"
+)
+
+
+def policy(name, event_filter, number=0):
+    return {
+        "name": name,
+        "number": number,
+        "filter": event_filter,
+        "full_filter": f"filter({event_filter}){TAIL}",
+    }
+
+
+def test_plan_merges_filters_differing_in_one_equality():
+    queries = list(
+        enumerate(
+            [
+                policy("a", 'event_src.title = "unix" and msgid = "1"'),
+                policy("b", 'msgid = "2" and event_src.title = "unix"'),
+                policy("c", 'event_src.title = "unix" and msgid = "3"'),
+                policy("or", 'event_src.title = "unix" or msgid = "4"'),
+                policy("alone", 'event_src.title = "windows" and msgid = "5"'),
+            ]
+        )
+    )
+    (fan_in,) = plan_fan_in(queries)
+    assert [task_index for task_index, _, _ in fan_in.members] == [0, 1, 2]
+    assert fan_in.filter() == 'event_src.title = "unix" and msgid in ["1", "2", "3"]'
+    assert fan_in.full_filter() == (
+        'filter(event_src.title = "unix" and msgid in ["1", "2", "3"])'
+        " | select(time, event_src.asset, event_src.host, msgid)"
+        " | group(key: [event_src.asset, event_src.host, msgid], agg: COUNT(*) as Cnt)"
+        " | limit(100000)"
+    )
+
+
+def test_plan_skips_duplicate_values_and_single_filters():
+    queries = list(
+        enumerate(
+            [
+                policy("a", 'msgid = "1" and x = 1'),
+                policy("b", 'msgid = "1" and x = 1', 1),
+                policy("c", "msgid = 2 and y = 1"),
+            ]
+        )
+    )
+    assert plan_fan_in(queries) == []
+
+
+def test_split_returns_parts_in_member_order():
+    (fan_in,) = plan_fan_in(
+        list(enumerate([policy("a", 'msgid = "A1"'), policy("b", 'msgid = "b2"')]))
+    )
+    host_ids = {
+        fan_in_key("x", "a1"): {"count": 1, "event_src.host": ["h"]},
+        fan_in_key("y", "B2"): {"count": 2, "event_src.host": ["h"]},
+        fan_in_key("z", "other"): {"count": 3, "event_src.host": ["h"]},
+    }
+    assert fan_in.split(host_ids) == [
+        {"x": {"count": 1, "event_src.host": ["h"]}},
+        {"y": {"count": 2, "event_src.host": ["h"]}},
+    ]
+
+
+def test_fan_in_duration_recorded_per_member(
+    make_settings, logger, make_policies, tmp_path
+):
+    members = [policy("a", 'msgid = "1"'), policy("b", 'msgid = "2"', 3)]
+    policies = make_policies(
+        *[(item["name"], item["number"], item["full_filter"]) for item in members]
+    )
+    policies.rebuilt_policies = members
+    worker = EventsWorker(make_settings(query_history=True), logger, policies, None)
+    (fan_in,) = plan_fan_in(list(enumerate(members)))
+
+    async def take_cached(param, event_filter, time_from, file_path, *args):
+        worker.query_seconds[file_path] = 6.0
+        return True, {
+            fan_in_key("x", "1"): {"count": 1, "event_src.host": ["h"]},
+            fan_in_key("y", "2"): {"count": 1, "event_src.host": ["h"]},
+        }
+
+    worker._take_cached = take_cached
+    parts = asyncio.run(worker.take_fan_in("-1", 100, fan_in, tmp_path, None))
+    assert [list(part) for part in parts] == [["x"], ["y"]]
+    history = worker.query_history.history
+    assert sorted(history) == ["a #0", "b #3"]
+    assert [history[key]["last_seconds"] for key in sorted(history)] == [3.0, 3.0]
+    assert worker.query_history.summary()["total_query_seconds"] == 6.0
+    assert (tmp_path / "a_0.json").is_file() and (tmp_path / "b_3.json").is_file()
+
+
+def test_truncated_fan_in_marks_each_member(
+    make_settings, logger, make_policies, tmp_path
+):
+    members = [policy("a", 'msgid = "1"'), policy("b", 'msgid = "2"', 3)]
+    policies = make_policies(
+        *[(item["name"], item["number"], item["full_filter"]) for item in members]
+    )
+    policies.rebuilt_policies = members
+    worker = EventsWorker(make_settings(), logger, policies, None)
+    (fan_in,) = plan_fan_in(list(enumerate(members)))
+
+    async def take_window(param, event_filter, time_from, time_to, file_path, shard):
+        raise ResultTruncated([{"groups": ["x", "h", "1"], "values": [1]}])
+
+    worker._take_window = take_window
+    time_from = int(time.time()) - 60
+    parts = asyncio.run(worker.take_fan_in("-1", time_from, fan_in, tmp_path, None))
+    assert [list(part) for part in parts] == [["x"], []]
+    # пометки ложатся на листы фильтров группы, а не на общий запрос
+    assert worker.limit_splits == {
+        ("a", "0"): {"splits": 0, "truncated": True},
+        ("b", "3"): {"splits": 0, "truncated": True},
+    }
+    assert run_stats.truncation["truncated"] == {"a #0": True, "b #3": True}
@@ -0,0 +1,119 @@
+from conftest import FakeResponse, FakeSession
+
+from lib.asset import AssetWorker, _read_taken_records
+from lib.grid_cache import GridCache, normalize_pdql
+
+PDQL = "filter(host.fqdn != null) | select(@host as asset_id, host.fqdn)"
+TOKEN = {
+    "token": "t",
+    "fields": [
+        {"name": "asset_id", "type": "uuid"},
+        {"name": "host.fqdn", "type": "string"},
+    ],
+}
+RECORDS = [
+    {"asset_id": "id1", "host.fqdn": "one.local"},
+    {"asset_id": "id2", "host.fqdn": "two.local"},
+]
+
+
+def test_normalize_pdql_keeps_quoted_spaces():
+    assert (
+        normalize_pdql(['filter(host.fqdn  =\n "a  b")', "  |  select(@host)  "])
+        == 'filter(host.fqdn = "a  b") | select(@host)'
+    )
+    assert GridCache.key("a  |b", "-1") == GridCache.key(
+        "a |b", ["00000000-0000-0000-0000-000000000002"]
+    )
+    assert GridCache.key("a", ["g2", "g1"]) == GridCache.key("a", ["g1", "g2"])
+
+
+def test_entry_kept_until_every_expected_filter_took_it(logger):
+    cache = GridCache(logger)
+    for _ in range(3):
+        cache.expect("k")
+    assert cache.get("k") is None
+    cache.put("k", TOKEN, RECORDS)
+    assert cache.get("k")["records"] is RECORDS
+    assert cache.get("k")["token"] is TOKEN
+    assert cache.entries == {} and cache.expected == {}
+    assert cache.summary() == {"hits": 2, "stored": 1}
+    # сетку без других ожидающих фильтров хранить незачем
+    cache.put("other", TOKEN, RECORDS)
+    assert cache.entries == {}
+
+
+def test_release_after_failed_fetch(logger):
+    cache = GridCache(logger)
+    cache.expect("k")
+    cache.expect("k")
+    cache.release("k")
+    cache.put("k", TOKEN, RECORDS)
+    assert cache.entries == {} and cache.expected == {}
+
+
+def grid_workers(make_settings, logger, fake_auth, count):
+    settings = make_settings(retry_base_seconds=0, retry_max_seconds=0)
+    workers = []
+    for number in range(count):
+        worker = AssetWorker(
+            settings,
+            fake_auth,
+            logger,
+            None,
+            f"f{number}",
+            {"PDQL": PDQL, "group": "-1", "default_politics_blacklist": []},
+        )
+        worker.expect_grid()
+        folder = settings.out_folder / f"f{number}"
+        folder.mkdir()
+        workers.append((worker, folder))
+    return workers
+
+
+def test_reused_grid_writes_pages_for_dependent_filters(
+    make_settings, logger, fake_auth
+):
+    requests = []
+
+    def respond(method, url, kwargs):
+        requests.append(method)
+        if method == "POST":
+            return FakeResponse(200, TOKEN)
+        return FakeResponse(200, {"records": RECORDS})
+
+    fake_auth.transport.session = FakeSession(respond)
+    (first, first_folder), (second, second_folder) = grid_workers(
+        make_settings, logger, fake_auth, 2
+    )
+    first.work(first_folder)
+    asset_dict, _, _ = second.work(second_folder)
+    assert requests == ["POST", "GET"]
+    assert list(asset_dict) == ["id1", "id2"]
+    assert (second_folder / "create_pdql_token_0.json").is_file()
+    assert _read_taken_records(second_folder, "f1", logger) == RECORDS
+    assert first.grid_cache.entries == {}
+
+
+def test_failed_fetch_releases_grid_entry(make_settings, logger, fake_auth):
+    pages = []
+
+    def respond(method, url, kwargs):
+        if method == "POST":
+            return FakeResponse(200, TOKEN)
+        pages.append(kwargs["params"]["offset"])
+        if len(pages) == 1:
+            return FakeResponse(503)
+        return FakeResponse(200, {"records": RECORDS})
+
+    fake_auth.transport.session = FakeSession(respond)
+    (first, first_folder), (second, second_folder) = grid_workers(
+        make_settings, logger, fake_auth, 2
+    )
+    first.settings.reconnect_times = 1
+    assert first.work(first_folder) == ({}, ["asset_id", "host.fqdn"], [])
+    assert first.grid_cache.expected == {first.grid_key: 1}
+    first.settings.reconnect_times = 3
+    asset_dict, _, _ = second.work(second_folder)
+    assert list(asset_dict) == ["id1", "id2"]
+    assert first.grid_cache.expected == {} and first.grid_cache.entries == {}
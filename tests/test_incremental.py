@@ -0,0 +1,111 @@
+import asyncio
+
+from lib.events import EventsWorker, _group_param
+from lib.incremental import ALL_ASSETS, IncrementalState
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def make_state(make_settings, logger, time_to=10 * DAY, bucket_hours=24):
+    settings = make_settings(incremental=True, incremental_bucket_hours=bucket_hours)
+    state = IncrementalState(settings, logger)
+    state.time_to = time_to
+    return state
+
+
+def test_plan_groups_assets_by_watermark(make_settings, logger):
+    state = make_state(make_settings, logger)
+    key = state.key("q", {"groupId": "-1"}, "event_src")
+    state.entry(key)["watermarks"] = {
+        "fresh": 9 * DAY,
+        "stale": DAY,
+        "future": 11 * DAY,
+    }
+    time_from = 3 * DAY
+    assert state.plan(key, ["new", "fresh", "stale", "future"], time_from) == {
+        time_from: ["new", "stale", "future"],
+        9 * DAY: ["fresh"],
+    }
+    assert state.plan(key, [], time_from) == {time_from: [ALL_ASSETS]}
+
+
+def test_pieces_follow_bucket_boundaries(make_settings, logger):
+    state = make_state(make_settings, logger)
+    assert state.pieces(DAY + HOUR, 3 * DAY) == [
+        (DAY + HOUR, 2 * DAY),
+        (2 * DAY, 3 * DAY),
+    ]
+    assert state.pieces(DAY, DAY) == []
+
+
+def test_host_ids_sums_window_buckets_and_drops_old(make_settings, logger):
+    state = make_state(make_settings, logger)
+    key = state.key("q", {}, "event_src")
+    state.add(key, DAY, {"a1": {"count": 1, "event_src.host": ["h1"]}})
+    state.add(key, 5 * DAY, {"a1": {"count": 2, "event_src.host": ["h2"]}})
+    state.add(key, 6 * DAY + HOUR, {"a2": {"count": 4, "event_src.host": ["h3"]}})
+    assert state.host_ids(key, ["a1"], 3 * DAY) == {
+        "a1": {"count": 2, "event_src.host": ["h2"]}
+    }
+    assert str(DAY) not in state.entry(key)["buckets"]
+    assert set(state.host_ids(key, [], 3 * DAY)) == {"a1", "a2"}
+
+
+def test_state_survives_restart_until_bucket_size_changes(make_settings, logger):
+    state = make_state(make_settings, logger)
+    key = state.key("q", {}, "event_src")
+    state.add(key, 5 * DAY, {"a1": {"count": 2, "event_src.host": ["h"]}})
+    state.commit(key, ["a1"])
+    state.save()
+    again = make_state(make_settings, logger)
+    assert again.entry(key)["watermarks"] == {"a1": 10 * DAY}
+    assert again.host_ids(key, ["a1"], 3 * DAY)["a1"]["count"] == 2
+    resized = make_state(make_settings, logger, bucket_hours=12)
+    assert resized.entry(key)["watermarks"] == {}
+
+
+def incremental_worker(make_settings, logger, make_policies, piece_ok):
+    settings = make_settings(incremental=True, incremental_bucket_hours=24)
+    worker = EventsWorker(settings, logger, make_policies(("A", 0, "q")), None)
+    state = worker.incremental
+    state.time_to = 10 * DAY
+    key = state.key("q", _group_param("-1"), "event_src")
+    state.add(key, 8 * DAY, {"a1": {"count": 3, "event_src.host": ["h"]}})
+    state.commit(key, ["a1"])
+    state.time_to = 11 * DAY
+
+    async def take_complete(param, event_filter, piece_from, piece_to, *args):
+        return piece_ok, {"a1": {"count": 1, "event_src.host": ["h"]}}
+
+    worker._take_complete = take_complete
+    return worker, state, key
+
+
+def test_failed_bucket_reports_previous_state_but_not_done(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, state, key = incremental_worker(make_settings, logger, make_policies, False)
+    policy = worker.policies.rebuilt_policies[0]
+    host_ids = asyncio.run(
+        worker.take_events("-1", 3 * DAY, "q", tmp_path, policy, ["a1"])
+    )
+    assert host_ids == {"a1": {"count": 3, "event_src.host": ["h"]}}
+    assert state.entry(key)["watermarks"]["a1"] == 10 * DAY
+    resume_key = worker.run_manifest.key("q", _group_param("-1"), 3 * DAY)
+    assert worker.run_manifest.take(resume_key) is None
+    assert not list(tmp_path.glob("A_0*.json"))
+
+
+def test_successful_bucket_moves_watermark_and_is_done(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, state, key = incremental_worker(make_settings, logger, make_policies, True)
+    policy = worker.policies.rebuilt_policies[0]
+    host_ids = asyncio.run(
+        worker.take_events("-1", 3 * DAY, "q", tmp_path, policy, ["a1"])
+    )
+    assert host_ids["a1"]["count"] == 4
+    assert state.entry(key)["watermarks"]["a1"] == 11 * DAY
+    resume_key = worker.run_manifest.key("q", _group_param("-1"), 3 * DAY)
+    assert worker.run_manifest.take(resume_key) == host_ids
@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+from event_checker import MaxPatrolEventsMonitor
+from lib.asset import dynamic_filter_names
+
+
+def test_dynamic_filter_names():
+    pdql = (
+        'filter(<dynamic!{"filter_name": "nginx", "filter": "a in <x>"}dynamic!>)'
+        " | select(@host)"
+        '<dynamic!{\n"filter_name": "haproxy"\n}dynamic!> <dynamic!{broken}dynamic!>'
+        '<dynamic!{"filter": "no name"}dynamic!>'
+    )
+    assert dynamic_filter_names(pdql) == ["nginx", "haproxy"]
+    assert dynamic_filter_names("filter(host.fqdn != null)") == []
+
+
+class FakeFilter:
+    """AssetWorker с журналом начала и конца работы"""
+
+    def __init__(self, journal, name, pdql="", grid_key=None, fail=False):
+        self.journal = journal
+        self.filter_name = name
+        self.pdql = pdql
+        self.grid_key = grid_key or name
+        self.fail = fail
+
+    async def assets_take_info_async(self, out_folder, need_up_file, assets_taken):
+        self.journal.append(("start", self.filter_name))
+        await asyncio.sleep(0.01)
+        if self.fail:
+            self.journal.append(("failed", self.filter_name))
+            raise RuntimeError("grid lost")
+        assets_taken.set()
+        self.journal.append(("assets", self.filter_name))
+        await asyncio.sleep(0.01)
+        self.journal.append(("end", self.filter_name))
+
+
+def run_parallel(filters, parallel_filters, logger, tmp_path):
+    monitor = MaxPatrolEventsMonitor.__new__(MaxPatrolEventsMonitor)
+    monitor.settings = SimpleNamespace(parallel_filters=parallel_filters)
+    monitor.logger = logger
+    asyncio.run(
+        monitor.asset_filters_parallel(
+            [(aw.filter_name, aw, tmp_path / aw.filter_name) for aw in filters]
+        )
+    )
+
+
+def test_filters_wait_only_for_their_dependencies(logger, tmp_path):
+    journal = []
+    filters = [
+        FakeFilter(journal, "source"),
+        FakeFilter(journal, "dynamic", '<dynamic!{"filter_name": "source"}dynamic!>'),
+        FakeFilter(journal, "same_grid", grid_key="source"),
+        FakeFilter(journal, "free"),
+    ]
+    run_parallel(filters, 4, logger, tmp_path)
+    position = {event: index for index, event in enumerate(journal)}
+    assert position[("start", "free")] < position[("assets", "source")]
+    for name in ("dynamic", "same_grid"):
+        assert position[("assets", "source")] < position[("start", name)]
+        assert ("end", name) in position
+
+
+def test_parallel_filters_limit_and_failed_dependency(logger, tmp_path):
+    journal = []
+    filters = [
+        FakeFilter(journal, "source", fail=True),
+        FakeFilter(journal, "dynamic", '<dynamic!{"filter_name": "source"}dynamic!>'),
+        FakeFilter(journal, "a"),
+        FakeFilter(journal, "b"),
+    ]
+    run_parallel(filters, 2, logger, tmp_path)
+    running = 0
+    most = 0
+    for event, _ in journal:
+        if event == "start":
+            running += 1
+        elif event in ("end", "failed"):
+            running -= 1
+        most = max(most, running)
+    assert most <= 2
+    # упавший фильтр не блокирует зависимые от него
+    assert ("end", "dynamic") in journal
+    assert ("failed", "source") in journal
@@ -0,0 +1,77 @@
+from lib import query_cache
+from lib.asset import AssetWorker, _read_taken_records
+from lib.grid_cache import group_ids, normalize_pdql
+from lib.query_cache import QueryCache
+
+PDQL = "filter(host.fqdn != null) | select(@host as asset_id, host.fqdn)"
+TOKEN = {
+    "token": "t1",
+    "fields": [
+        {"name": "asset_id", "type": "uuid"},
+        {"name": "host.fqdn", "type": "string"},
+    ],
+}
+
+
+def test_key_depends_on_parts_not_dict_order():
+    assert QueryCache.key("events", {"a": 1, "b": 2}) == QueryCache.key(
+        "events", {"b": 2, "a": 1}
+    )
+    assert QueryCache.key("events", "q") != QueryCache.key("assets_grid", "q")
+    assert QueryCache.align(7 * 3600 + 59) == QueryCache.align(7 * 3600 + 3599)
+    assert QueryCache.align(7 * 3600 - 1) == 6 * 3600
+
+
+def test_entries_expire_after_ttl(make_settings, logger, monkeypatch):
+    cache = QueryCache(make_settings(query_cache_ttl=60), logger)
+    now = 1000000.0
+    monkeypatch.setattr(query_cache.time, "time", lambda: now)
+    cache.put("k", "events", {"x": 1})
+    now += 59
+    assert cache.get("k") == {"x": 1}
+    now += 2
+    assert cache.get("k") is None
+    assert cache.summary() == {"hits": 1, "misses": 1}
+
+
+def test_least_recently_used_entries_evicted(make_settings, logger, monkeypatch):
+    cache = QueryCache(make_settings(query_cache_max_mb=1), logger)
+    now = 1000000.0
+    monkeypatch.setattr(query_cache.time, "time", lambda: now)
+    big = "x" * 400 * 1024
+    for key in ("a", "b"):
+        now += 1
+        cache.put(key, "events", big)
+    now += 1
+    assert cache.get("a") == big
+    now += 1
+    cache.put("c", "events", big)
+    assert cache.get("b") is None
+    assert cache.get("a") == big
+    assert cache.get("c") == big
+
+
+def test_cached_grid_writes_asset_pages(make_settings, logger, fake_auth):
+    settings = make_settings(query_cache=True)
+    records = [
+        {"asset_id": "id1", "host.fqdn": "one.local"},
+        {"asset_id": "id2", "host.fqdn": "two.local"},
+    ]
+    cache = query_cache.get_query_cache(settings, logger)
+    key = cache.key("assets_grid", normalize_pdql(PDQL), sorted(group_ids("-1")))
+    cache.put(key, "assets_grid", {"token": TOKEN, "records": records})
+    worker = AssetWorker(
+        settings,
+        fake_auth,
+        logger,
+        None,
+        "source",
+        {"PDQL": PDQL, "group": "-1", "default_politics_blacklist": []},
+    )
+    out_folder = settings.out_folder / "source"
+    out_folder.mkdir()
+    asset_dict, fields, _ = worker.work(out_folder)
+    assert list(asset_dict) == ["id1", "id2"]
+    assert fields == ["asset_id", "host.fqdn"]
+    # dynamic-фильтр следующего запуска читает записи из страниц
+    assert _read_taken_records(out_folder, "source", logger) == records
@@ -0,0 +1,73 @@
+from lib.events import EventsWorker
+from lib.query_history import QueryHistory
+
+
+def policy(name, full_filter="q", number=0):
+    return {"name": name, "number": number, "filter": full_filter}
+
+
+def test_record_smooths_and_survives_restart(make_settings, logger):
+    settings = make_settings(query_history=True)
+    history = QueryHistory(settings, logger)
+    history.record(policy("A"), 10.0, True)
+    history.record(policy("A"), 20.0, False)
+    entry = history.history["A #0"]
+    assert entry["avg_seconds"] == 13.0
+    assert entry["max_seconds"] == 20.0
+    assert (entry["runs"], entry["errors"]) == (2, 1)
+    assert history.summary() == {
+        "total_query_seconds": 30.0,
+        "top_filters": {"A #0": 30.0},
+    }
+    history.save()
+    again = QueryHistory(settings, logger)
+    assert again.expected(policy("A")) == 13.0
+    assert again.run_costs == {}
+
+
+def test_changed_filter_starts_new_history(make_settings, logger):
+    history = QueryHistory(make_settings(query_history=True), logger)
+    history.record(policy("A", "old"), 50.0, True)
+    history.record(policy("B"), 5.0, True)
+    # новый или измененный фильтр считается самым долгим из известных
+    assert history.expected(policy("A", "new")) == 50.0
+    assert history.expected(policy("C")) == 50.0
+    history.record(policy("A", "new"), 1.0, True)
+    assert history.history["A #0"]["runs"] == 1
+    assert history.expected(policy("A", "new")) == 1.0
+
+
+def test_broken_history_file_is_ignored(make_settings, logger):
+    settings = make_settings(query_history=True)
+    settings.state_folder.mkdir(parents=True)
+    (settings.state_folder / "query_history.json").write_text("{", "utf-8")
+    assert QueryHistory(settings, logger).history == {}
+
+
+def test_query_order_mandatory_then_longest(make_settings, logger, make_policies):
+    policies = make_policies(
+        ("fast", 0, "q1"),
+        ("slow", 0, "q2"),
+        ("must", 0, "q3"),
+        ("new", 0, "q4"),
+        mandatory=["must"],
+    )
+    worker = EventsWorker(make_settings(query_history=True), logger, policies, None)
+    for name, full_filter, seconds in (("fast", "q1", 1.0), ("slow", "q2", 9.0)):
+        worker.query_history.record(policy(name, full_filter), seconds, True)
+    worker.query_history.record(policy("must", "q3"), 0.1, True)
+    order = worker._query_order(policies.rebuilt_policies)
+    assert [policies.rebuilt_policies[index]["name"] for index in order] == [
+        "must",
+        "slow",
+        "new",
+        "fast",
+    ]
+
+
+def test_query_order_without_history_keeps_mandatory_first(
+    make_settings, logger, make_policies
+):
+    policies = make_policies(("a", 0, "q1"), ("b", 0, "q2"), mandatory=["b"])
+    worker = EventsWorker(make_settings(query_history=False), logger, policies, None)
+    assert worker._query_order(policies.rebuilt_policies) == [1, 0]
@@ -0,0 +1,158 @@
+import asyncio
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+
+from lib import retry_policy
+from lib.events_matrix import EventsMatrix
+from lib.get_token import MPXAuthenticator
+from lib.retry_policy import RetryPolicy
+from lib.run_stats import run_stats
+
+from conftest import FakeResponse, FakeSession
+
+
+def make_policy(make_settings, logger, **overrides):
+    values = {
+        "reconnect_times": 5,
+        "retry_base_seconds": 2,
+        "retry_max_seconds": 10,
+        "retry_budget": 0,
+        "circuit_breaker_failures": 0,
+        "circuit_breaker_seconds": 30,
+    }
+    values.update(overrides)
+    return RetryPolicy(make_settings(**values), logger)
+
+
+def test_delay_is_full_jitter_capped_and_after_retry_after(
+    make_settings, logger, monkeypatch
+):
+    policy = make_policy(make_settings, logger)
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: high)
+    assert [policy.delay(attempt) for attempt in (1, 2, 3, 4)] == [2, 4, 8, 10]
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: low)
+    assert policy.delay(3) == 0
+    assert policy.delay(3, retry_after=7.0) == 7.0
+
+
+def test_retry_after_seconds_and_http_date():
+    assert RetryPolicy.retry_after({"Retry-After": "12"}) == 12.0
+    assert RetryPolicy.retry_after({"Retry-After": "-3"}) == 0.0
+    now = RetryPolicy.retry_after({"Retry-After": formatdate(usegmt=True)})
+    assert 0.0 <= now <= 1.0
+    assert RetryPolicy.retry_after({"Retry-After": "soon"}) is None
+    assert RetryPolicy.retry_after(None) is None
+
+
+def test_gives_up_after_reconnect_times_and_budget(make_settings, logger):
+    policy = make_policy(make_settings, logger, reconnect_times=3, retry_budget=3)
+    assert policy.retry("events", 1, status=500) is not None
+    assert policy.retry("events", 2, status=500) is not None
+    assert policy.retry("events", 3, status=500) is None
+    assert policy.retry("events", 1, status=500) is not None
+    # бюджет на endpoint за запуск кончился
+    assert policy.retry("events", 1, status=500) is None
+    assert policy.retry("assets_grid", 1, status=500) is not None
+    assert policy.summary()["endpoints"]["events"] == {
+        "requests": 5,
+        "retries": 3,
+        "gave_up": 2,
+    }
+
+
+def test_no_retry_past_run_deadline(make_settings, logger):
+    policy = make_policy(make_settings, logger, retry_base_seconds=100)
+    run_stats.set_deadline(50)
+    policy.delay = lambda attempt, retry_after=None: 60.0
+    assert policy.retry("events", 1) is None
+    policy.delay = lambda attempt, retry_after=None: 10.0
+    assert policy.retry("events", 1) == 10.0
+
+
+def test_circuit_breaker_opens_after_overloads_in_row(make_settings, logger):
+    policy = make_policy(make_settings, logger, circuit_breaker_failures=3)
+    policy.retry("events", 1, status=503)
+    policy.ok("events")
+    policy.retry("events", 1, status=503)
+    # 500 - ошибка запроса, а не перегрузка ядра
+    policy.retry("events", 1, status=500)
+    policy.retry("events", 1)
+    assert policy.pause() == 0
+    policy.retry("assets_grid", 1, status=429, retry_after=45)
+    assert 44 < policy.pause() <= 45
+    assert policy.circuit_opened == 1
+    # пока breaker открыт, пауза перед повтором не меньше оставшегося времени
+    assert policy.retry("events", 1, status=500) >= 44
+
+
+def test_send_retries_statuses_and_returns_last_response(
+    make_settings, logger, monkeypatch
+):
+    policy = make_policy(make_settings, logger, reconnect_times=3)
+    monkeypatch.setattr(retry_policy.time, "sleep", lambda seconds: None)
+    responses = iter(
+        [
+            OSError("reset"),
+            SimpleNamespace(status_code=503, headers={}),
+            SimpleNamespace(status_code=200, headers={}),
+        ]
+    )
+
+    def send_request():
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert policy.send("kb", send_request).status_code == 200
+    assert policy.summary()["endpoints"]["kb"]["retries"] == 2
+    failing = make_policy(make_settings, logger, reconnect_times=2)
+    monkeypatch.setattr(failing, "sleep_sync", lambda *args: args[1] < 2)
+    always_busy = SimpleNamespace(status_code=503, headers={})
+    assert failing.send("kb", lambda: always_busy) is always_busy
+
+
+def test_matrix_queries_retry_through_shared_policy(
+    make_settings, logger, make_policies, tmp_path
+):
+    settings = make_settings(retry_base_seconds=0, retry_max_seconds=0)
+    matrix = EventsMatrix(settings, logger, make_policies(), None)
+    responses = [
+        FakeResponse(429, headers={"Retry-After": "0"}),
+        FakeResponse(
+            200, {"errors": [], "rows": [{"groups": ["a1", "h"], "values": [3]}]}
+        ),
+    ]
+    matrix.async_session = FakeSession(lambda *args: responses.pop(0))
+    all_ok, host_ids = asyncio.run(
+        matrix._take_window({}, "q", 0, 3600, tmp_path / "q.txt")
+    )
+    assert all_ok
+    assert host_ids == {"a1": {"count": 3, "event_src.host": ["h"]}}
+    assert matrix.retry.summary()["endpoints"]["events"]["retries"] == 1
+
+
+def test_auth_cookie_step_retries_within_policy(make_settings, logger, monkeypatch):
+    auth = MPXAuthenticator.__new__(MPXAuthenticator)
+    auth.logger = logger
+    auth.retry = make_policy(
+        make_settings, logger, retry_base_seconds=0, retry_budget=2
+    )
+    steps = []
+
+    def take_mpx_cookies(url_auth, param_auth, mode):
+        steps.append(mode)
+        raise AttributeError("No form_action")
+
+    monkeypatch.setattr(auth, "_take_mpx_cookies", take_mpx_cookies)
+    with pytest.raises(AttributeError):
+        auth._mpx_cookies("https://mpx.test/account/login", {}, "MPX")
+    # повторы шага входят в бюджет auth и видны в сводке
+    assert steps == ["MPX"] * 3
+    assert auth.retry.summary()["endpoints"]["auth"] == {
+        "requests": 3,
+        "retries": 2,
+        "gave_up": 1,
+    }
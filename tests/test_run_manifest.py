@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+from lib import incremental, run_manifest
+from lib.events import EventsWorker
+from lib.run_manifest import RunManifest
+
+
+def done_result(tmp_path, name, host_ids):
+    result_path = tmp_path / name
+    result_path.write_text(json.dumps({"host_ids": host_ids}), "utf-8")
+    return result_path
+
+
+def test_resume_loads_window_and_done_queries(make_settings, logger, tmp_path):
+    manifest = RunManifest(make_settings(), logger)
+    key = manifest.key("filter(a)", {"groupId": "-1"}, 100)
+    manifest.add(key, done_result(tmp_path, "a.json", {"x": {"count": 1}}))
+    with manifest.path.open("a", encoding="utf-8") as manifest_file:
+        # строка, не дописанная при обрыве
+        manifest_file.write('{"key": "broken", "fi')
+    resumed = RunManifest(make_settings(resume=True), logger)
+    assert resumed.time_to == manifest.time_to
+    assert list(resumed.done) == [key]
+    assert resumed.take(key) == {"x": {"count": 1}}
+    assert resumed.take("other") is None
+
+
+def test_key_ignores_filter_whitespace():
+    assert RunManifest.key("a  =\n 1", {}, 5) == RunManifest.key("a = 1", {}, 5)
+    assert RunManifest.key("a = 1", {}, 5) != RunManifest.key("a = 1", {}, 6)
+
+
+def test_changed_window_or_no_resume_starts_over(make_settings, logger, tmp_path):
+    manifest = RunManifest(make_settings(time_delta_hours=24), logger)
+    manifest.time_to -= 1000
+    manifest._write_line({"time_to": manifest.time_to, "time_delta_hours": 24}, "w")
+    manifest.add("k", done_result(tmp_path, "k.json", {}))
+    changed = RunManifest(make_settings(resume=True, time_delta_hours=12), logger)
+    assert changed.done == {}
+    assert changed.time_to != manifest.time_to
+    fresh = RunManifest(make_settings(resume=False, time_delta_hours=12), logger)
+    assert fresh.done == {}
+    assert len(fresh.path.read_text("utf-8").splitlines()) == 1
+
+
+def test_missing_result_file_is_queried_again(make_settings, logger, tmp_path):
+    manifest = RunManifest(make_settings(), logger)
+    manifest.add("k", tmp_path / "lost.json")
+    assert manifest.take("k") is None
+
+
+def test_take_events_resumes_done_query(
+    make_settings, logger, make_policies, tmp_path, monkeypatch
+):
+    queries = []
+
+    async def take_cached(self, param, event_filter, *args):
+        queries.append(event_filter)
+        return True, {"x": {"count": 2, "event_src.host": ["h"]}}
+
+    monkeypatch.setattr(EventsWorker, "_take_cached", take_cached)
+    policies = make_policies(("A", 0, "q"))
+    policy = policies.rebuilt_policies[0]
+    for resume in (False, True):
+        monkeypatch.setattr(run_manifest, "_manifest", None)
+        worker = EventsWorker(make_settings(resume=resume), logger, policies, None)
+        host_ids = asyncio.run(
+            worker.take_events("-1", 100, "q", tmp_path, policy, ["x"])
+        )
+        assert host_ids == {"x": {"count": 2, "event_src.host": ["h"]}}
+    assert queries == ["q"]
+
+
+def test_resume_keeps_incremental_window(
+    make_settings, logger, make_policies, monkeypatch
+):
+    first = EventsWorker(
+        make_settings(incremental=True, time_delta_hours=24),
+        logger,
+        make_policies(),
+        None,
+    )
+    window = first._time_window()
+    first.run_manifest.time_to -= 1000
+    first.run_manifest._write_line(
+        {"time_to": first.run_manifest.time_to, "time_delta_hours": 24}, "w"
+    )
+    # следующий запуск с resume: новые журнал и состояние incremental
+    monkeypatch.setattr(run_manifest, "_manifest", None)
+    monkeypatch.setattr(incremental, "_state", None)
+    resumed = EventsWorker(
+        make_settings(incremental=True, resume=True, time_delta_hours=24),
+        logger,
+        make_policies(),
+        None,
+    )
+    assert resumed.incremental.time_to == first.run_manifest.time_to
+    assert resumed._time_window() == (window[0] - 1000, window[1] - 1000)
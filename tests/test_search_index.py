@@ -0,0 +1,75 @@
+from lib.asset import _search_key, _SearchIndex, all_search_to_no_asset
+
+
+def test_search_key_normalizes_case_dot_and_short_name():
+    assert _search_key("host.fqdn", " Web.Corp.Local. ") == "web.corp.local"
+    assert _search_key("host.hostname", "WEB.corp.local") == "web"
+    assert _search_key("host.hostname", "10.0.0.1") == "10.0.0.1"
+    assert _search_key("host.fqdn", None) is None
+
+
+def test_match_drops_one_occurrence_per_asset():
+    search = _SearchIndex({"host.fqdn": ["a.local", "b.local", "A.local"]})
+    search.match({"host.fqdn": "a.local"})
+    # из одинаковых снимается первое, остальные остаются в исходном порядке
+    assert search.not_found() == {"host.fqdn": ["b.local", "A.local"]}
+    search.match({"host.fqdn": "a.local."})
+    search.match({"host.fqdn": ["not", "hashable"]})
+    assert search.not_found() == {"host.fqdn": ["b.local"]}
+    search.match({"host.fqdn": "B.LOCAL"})
+    assert not search and search.not_found() == {"host.fqdn": []}
+
+
+def test_not_found_keeps_input_shape():
+    search = _SearchIndex(
+        {"host.fqdn": [None, ""], "addr": [], "host.ip": ["10.0.0.1"]}
+    )
+    search.match({"host.fqdn": "", "host.ip": "10.0.0.1"})
+    assert search.not_found() == {"host.fqdn": [None], "addr": [], "host.ip": []}
+
+
+def test_found_fqdn_drops_one_short_name():
+    search = _SearchIndex(
+        {"host.hostname": ["web", "db", "web"], "host.fqdn": ["web.corp.local"]}
+    )
+    search.match({"host.fqdn": "WEB.corp.local", "host.hostname": "other"})
+    assert search.not_found() == {"host.hostname": ["db", "web"], "host.fqdn": []}
+
+
+def test_no_asset_rows_keep_repeated_values():
+    rows = all_search_to_no_asset(
+        {"host.fqdn": ["x.local", "x.local"], "addr": ["10.0.0.1"]}, {"n": 1}, []
+    )
+    assert rows == [
+        {"n": 1, "host.fqdn": "x.local"},
+        {"n": 1, "host.fqdn": "x.local"},
+        {"n": 1, "addr": "10.0.0.1"},
+    ]
+
+
+def test_short_name_paired_once_and_skipped_after_fqdn():
+    rows = all_search_to_no_asset(
+        {
+            "host.fqdn": ["web.corp.local", "db.corp.local", "web.corp.local"],
+            "host.hostname": ["web", "app", "db", "web", "web"],
+        },
+        {},
+        [],
+    )
+    assert rows == [
+        {"host.fqdn": "web.corp.local", "host.hostname": "web"},
+        {"host.fqdn": "db.corp.local", "host.hostname": "db"},
+        {"host.fqdn": "web.corp.local", "host.hostname": "web"},
+        {"host.hostname": "app"},
+        {"host.hostname": "web"},
+    ]
+
+
+def test_short_name_before_fqdn_appears_in_both_rows():
+    rows = all_search_to_no_asset(
+        {"host.hostname": ["web"], "host.fqdn": ["web.corp.local"]}, {}, []
+    )
+    assert rows == [
+        {"host.hostname": "web"},
+        {"host.fqdn": "web.corp.local", "host.hostname": "web"},
+    ]
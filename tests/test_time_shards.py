@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from lib.events import (
+    EventsWorker,
+    ResultTruncated,
+    _merge_host_ids,
+    _shards_for_window,
+    _split_window,
+)
+
+HOUR = 60 * 60
+
+
+def test_split_window_is_contiguous_and_covers_window():
+    shards = _split_window(0, 10 * HOUR + 5, 3)
+    assert len(shards) == 3
+    assert shards[0][0] == 0
+    assert shards[-1][1] == 10 * HOUR + 5
+    for (_, previous_to), (next_from, _) in zip(shards, shards[1:]):
+        assert previous_to == next_from
+
+
+def test_shards_for_window_rounds_up():
+    assert _shards_for_window(0, 48 * HOUR, 0) == 1
+    assert _shards_for_window(0, 48 * HOUR, 24) == 2
+    assert _shards_for_window(0, 49 * HOUR, 24) == 3
+
+
+def test_merge_host_ids_sums_counts_and_unions_hosts():
+    host_ids = {"a1": {"count": 2, "event_src.host": ["h1"]}}
+    _merge_host_ids(
+        host_ids,
+        {
+            "a1": {"count": 3, "event_src.host": ["h1", "h2"]},
+            "a2": {"count": 1, "event_src.host": ["h3"]},
+        },
+    )
+    assert host_ids == {
+        "a1": {"count": 5, "event_src.host": ["h1", "h2"]},
+        "a2": {"count": 1, "event_src.host": ["h3"]},
+    }
+
+
+def sharded_worker(make_settings, logger, make_policies, shard_result):
+    settings = make_settings(time_shards=4, time_shard_max_hours=24)
+    worker = EventsWorker(settings, logger, make_policies(), None)
+    shards = []
+    take_window = worker._take_window
+
+    async def fake_take_window(
+        param, event_filter, time_from, time_to, path, shard=False
+    ):
+        if not shard:
+            return await take_window(param, event_filter, time_from, time_to, path)
+        shards.append((time_from, time_to))
+        return shard_result(len(shards))
+
+    worker._take_window = fake_take_window
+    return worker, shards
+
+
+def test_long_window_is_queried_in_shards(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, shards = sharded_worker(
+        make_settings,
+        logger,
+        make_policies,
+        lambda index: (True, {"a1": {"count": index, "event_src.host": ["h"]}}),
+    )
+    all_ok, host_ids = asyncio.run(
+        worker._take_window({}, "q", 0, 72 * HOUR, tmp_path / "q.txt")
+    )
+    assert shards == _split_window(0, 72 * HOUR, 3)
+    assert all_ok
+    assert host_ids == {"a1": {"count": 1 + 2 + 3, "event_src.host": ["h"]}}
+
+
+def test_failed_shard_keeps_other_shards(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, _ = sharded_worker(
+        make_settings,
+        logger,
+        make_policies,
+        lambda index: (
+            (False, {})
+            if index == 2
+            else (True, {"a1": {"count": 1, "event_src.host": ["h"]}})
+        ),
+    )
+    all_ok, host_ids = asyncio.run(
+        worker._take_window({}, "q", 0, 48 * HOUR, tmp_path / "q.txt")
+    )
+    assert all_ok
+    assert host_ids["a1"]["count"] == 1
+
+
+def test_truncated_shard_is_raised_for_split(
+    make_settings, logger, make_policies, tmp_path
+):
+    def shard_result(index):
+        if index == 1:
+            raise ResultTruncated([{"groups": ["a1", "h"], "values": [1]}])
+        return True, {}
+
+    worker, _ = sharded_worker(make_settings, logger, make_policies, shard_result)
+    with pytest.raises(ResultTruncated):
+        asyncio.run(worker._take_window({}, "q", 0, 48 * HOUR, tmp_path / "q.txt"))
@@ -0,0 +1,65 @@
+import asyncio
+
+from lib.transport import Transport
+
+
+def test_pool_size_follows_query_threads(make_settings, logger):
+    settings = make_settings(
+        connection_pool_size=0,
+        max_threads_for_siem_api=5,
+        adaptive_threads=False,
+        adaptive_max_threads=20,
+    )
+    assert Transport(settings, logger).pool_size == 5
+    settings.adaptive_threads = True
+    assert Transport(settings, logger).pool_size == 20
+    settings.connection_pool_size = 3
+    assert Transport(settings, logger).pool_size == 3
+
+
+def test_sync_requests_use_shared_session_defaults(make_settings, logger, monkeypatch):
+    transport = Transport(
+        make_settings(http_connect_timeout=7, http_read_timeout=0), logger
+    )
+    sent = []
+    monkeypatch.setattr(
+        transport.session,
+        "request",
+        lambda *args, **kwargs: sent.append((args, kwargs)),
+    )
+    transport.post("https://mpx.test/api", json={})
+    transport.get("https://mpx.test/api", timeout=1)
+    assert sent == [
+        (
+            ("POST", "https://mpx.test/api"),
+            {"json": {}, "verify": False, "timeout": (7, None)},
+        ),
+        (("GET", "https://mpx.test/api"), {"timeout": 1, "verify": False}),
+    ]
+
+
+def test_sessions_of_one_loop_share_connector(make_settings, logger):
+    transport = Transport(make_settings(), logger)
+
+    async def sessions():
+        first = transport.open_session({"Authorization": "Bearer t"})
+        second = transport.open_session()
+        ((connector, opened),) = transport._connectors.values()
+        assert opened == 2
+        assert first.connector is second.connector is connector
+        await transport.close_session(first)
+        assert not connector.closed
+        await transport.close_session(second)
+        assert connector.closed
+        assert transport._connectors == {}
+        return transport.open_session()
+
+    asyncio.run(sessions())
+
+    async def next_run():
+        session = transport.open_session()
+        # пул закрытого loop с незакрытой сессией не переходит в следующий asyncio.run
+        assert len(transport._connectors) == 1
+        await transport.close_session(session)
+
+    asyncio.run(next_run())
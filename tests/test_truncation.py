@@ -0,0 +1,106 @@
+import asyncio
+import re
+
+from lib.events import EventsWorker, ResultTruncated
+from lib.run_stats import run_stats
+
+HOUR = 60 * 60
+
+
+def rows(*assets):
+    return [{"groups": [asset, "h"], "values": [1]} for asset in assets]
+
+
+def truncating_worker(make_settings, logger, make_policies, truncated):
+    """_take_window отвечает ResultTruncated, пока truncated(активы, начало, конец)"""
+    worker = EventsWorker(make_settings(), logger, make_policies(("A", 0, "q")), None)
+    windows = []
+
+    async def take_window(param, event_filter, time_from, time_to, file_path, shard):
+        found = re.match("filter\\(event_src.asset in \\[(.*?)]", event_filter)
+        assets = found.group(1).split(",") if found else []
+        windows.append((assets, time_from, time_to, shard))
+        if truncated(assets, time_from, time_to):
+            raise ResultTruncated(rows(*assets))
+        return True, {asset: {"count": 1, "event_src.host": ["h"]} for asset in assets}
+
+    worker._take_window = take_window
+    return worker, windows
+
+
+def take_complete(worker, event_filter, time_from, time_to, asset_ids, tmp_path):
+    return asyncio.run(
+        worker._take_complete(
+            {},
+            event_filter,
+            time_from,
+            time_to,
+            tmp_path / "A.txt",
+            worker.policies.rebuilt_policies[0],
+            asset_ids,
+            "event_src",
+        )
+    )
+
+
+def test_assets_split_in_halves_until_under_limit(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, windows = truncating_worker(
+        make_settings, logger, make_policies, lambda assets, *_: len(assets) > 1
+    )
+    all_ok, host_ids = take_complete(
+        worker,
+        "filter(event_src.asset in [a,b,c] and q)",
+        0,
+        HOUR,
+        ["a", "b", "c"],
+        tmp_path,
+    )
+    assert all_ok
+    assert set(host_ids) == {"a", "b", "c"}
+    assert sorted(tuple(assets) for assets, *_ in windows if len(assets) == 1) == [
+        ("a",),
+        ("b",),
+        ("c",),
+    ]
+    assert worker.limit_splits == {("A", "0"): {"splits": 2, "truncated": False}}
+    assert run_stats.truncation["splits"] == {"A #0": 2}
+
+
+def test_single_asset_splits_window_in_halves(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, windows = truncating_worker(
+        make_settings,
+        logger,
+        make_policies,
+        lambda assets, time_from, time_to: time_to - time_from > 2 * HOUR,
+    )
+    all_ok, host_ids = take_complete(
+        worker, "filter(event_src.asset in [a] and q)", 0, 8 * HOUR, ["a"], tmp_path
+    )
+    assert all_ok
+    # части окна складываются обратно
+    assert host_ids == {"a": {"count": 4, "event_src.host": ["h"]}}
+    parts = sorted((time_from, time_to) for _, time_from, time_to, shard in windows[3:])
+    assert parts == [
+        (0, 2 * HOUR),
+        (2 * HOUR, 4 * HOUR),
+        (4 * HOUR, 6 * HOUR),
+        (6 * HOUR, 8 * HOUR),
+    ]
+    # части окна запрашиваются с явной границей, без повторного деления на time_shards
+    assert all(shard for _, _, _, shard in windows[1:])
+
+
+def test_unsplittable_window_is_marked_truncated(
+    make_settings, logger, make_policies, tmp_path
+):
+    worker, _ = truncating_worker(make_settings, logger, make_policies, lambda *_: True)
+    all_ok, host_ids = take_complete(worker, "q", 0, HOUR, None, tmp_path)
+    # без активов данных для строк нет, но запрос считается выполненным
+    assert all_ok
+    assert host_ids == {}
+    assert worker.limit_splits[("A", "0")] == {"splits": 0, "truncated": True}
+    assert run_stats.truncation["truncated"] == {"A #0": True}
@@ -0,0 +1,173 @@
+import zipfile
+from datetime import datetime
+from xml.etree import ElementTree
+
+import pytest
+from xlsxwriter.format import Format
+
+from lib import xlsx_out
+from lib.xlsx_out import MonitorXlsxWriter, _FormatRef, _ReportSpool
+
+NS = {"x": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 1, 2, 3, 4, 5)
+
+
+@pytest.fixture(autouse=True)
+def fixed_now(monkeypatch):
+    monkeypatch.setattr(xlsx_out, "datetime", FixedDatetime)
+
+
+class RecordingSheet:
+    """Лист xlsxwriter с журналом вызовов записи"""
+
+    def __init__(self, journal, name):
+        self.journal = journal
+        self.name = name
+        self.merge = []
+
+    def __getattr__(self, method):
+        return lambda *args: self.journal.append((self.name, method) + args)
+
+
+def test_replay_orders_by_sheet_row_and_call(monkeypatch):
+    monkeypatch.setattr(_ReportSpool, "insert_batch", 2)
+    spool = _ReportSpool()
+    journal = []
+    first = spool.add_sheet(RecordingSheet(journal, "first"))
+    second = spool.add_sheet(RecordingSheet(journal, "second"))
+    cell_format = Format({"bold": True})
+    second.write(0, 0, "second")
+    first.write(5, 0, "late", cell_format)
+    first.write(1, 1, "b")
+    first.write(1, 0, "a")
+    first.set_row(5, 20)
+    first.write_column(2, 3, ["c", "d"])
+    # пачки по insert_batch уже в базе, последняя - в памяти
+    assert spool.cells == 6 and len(spool.pending) == 1
+    path = spool.path
+    spool.replay()
+    assert journal == [
+        ("first", "write", 1, 1, "b"),
+        ("first", "write", 1, 0, "a"),
+        ("first", "write", 2, 3, "c", None),
+        ("first", "write", 3, 3, "d", None),
+        ("first", "write", 5, 0, "late", cell_format),
+        ("first", "set_row", 5, 20),
+        ("second", "write", 0, 0, "second"),
+    ]
+    # формат возвращается тем же объектом книги, буфер удален
+    assert journal[4][-1] is cell_format
+    assert not path.exists()
+
+
+def test_merge_registered_at_first_row_before_its_cells():
+    spool = _ReportSpool()
+    journal = []
+    spooled = spool.add_sheet(RecordingSheet(journal, "sheet"))
+    spooled.merge_range(2, 1, 1, 0, "merged", "fmt")
+    spooled.write(0, 0, "top")
+    spool.replay()
+    assert journal == [
+        ("sheet", "write", 0, 0, "top"),
+        # без формата merge_range листа не пишет пустые ячейки следующих строк
+        ("sheet", "merge_range", 1, 0, 2, 1, "merged"),
+        ("sheet", "write", 1, 0, "merged", "fmt"),
+        ("sheet", "write_blank", 1, 1, None, "fmt"),
+        ("sheet", "write_blank", 2, 0, None, "fmt"),
+        ("sheet", "write_blank", 2, 1, None, "fmt"),
+    ]
+
+
+def test_spool_file_removed_when_replay_fails():
+    spool = _ReportSpool()
+    spooled = spool.add_sheet(RecordingSheet([], "sheet"))
+    spooled.write(0, 0, "cell")
+    spool.sheets[0] = None
+    with pytest.raises(AttributeError):
+        spool.replay()
+    assert not spool.path.exists()
+
+
+def test_drop_spool_of_unfinished_report(logger, tmp_path):
+    writer = MonitorXlsxWriter(tmp_path, "mpx", 24, False, logger, True)
+    writer.worksheets["simple"].write(0, 0, "cell")
+    path = writer.spool.path
+    writer.drop_spool()
+    writer.drop_spool()
+    assert writer.spool is None and not path.exists()
+    writer.workbook.close()
+
+
+def test_format_ref_kept_per_format():
+    spool = _ReportSpool()
+    white, red = Format(), Format()
+    refs = [spool._format_ref(cell_format) for cell_format in (white, red, white)]
+    assert all(isinstance(ref, _FormatRef) for ref in refs)
+    assert [ref.index for ref in refs] == [0, 1, 0]
+    assert spool.formats == [white, red]
+    assert spool._format_ref("text") == "text"
+    spool.close()
+
+
+def read_sheets(path):
+    """Значения, стили, высоты строк и объединения листов книги"""
+    sheets = {}
+    with zipfile.ZipFile(path) as book:
+        strings = []
+        if "xl/sharedStrings.xml" in book.namelist():
+            root = ElementTree.fromstring(book.read("xl/sharedStrings.xml"))
+            strings = ["".join(si.itertext()) for si in root.findall("x:si", NS)]
+        workbook = ElementTree.fromstring(book.read("xl/workbook.xml"))
+        names = [sheet.get("name") for sheet in workbook.iter(f"{{{NS['x']}}}sheet")]
+        for number, name in enumerate(names, 1):
+            root = ElementTree.fromstring(book.read(f"xl/worksheets/sheet{number}.xml"))
+            cells = {}
+            for row in root.iter(f"{{{NS['x']}}}row"):
+                cells[row.get("r")] = row.get("ht")
+                for cell in row.findall("x:c", NS):
+                    if cell.get("t") == "s":
+                        value = strings[int(cell.find("x:v", NS).text)]
+                    elif cell.get("t") == "inlineStr":
+                        value = "".join(cell.find("x:is", NS).itertext())
+                    else:
+                        value = cell.findtext("x:v", None, NS)
+                    cells[cell.get("r")] = (value, cell.get("s"))
+            merges = [
+                merge.get("ref") for merge in root.iter(f"{{{NS['x']}}}mergeCell")
+            ]
+            sheets[name] = (cells, merges)
+    return sheets
+
+
+def build_report(folder, logger, streaming):
+    folder.mkdir()
+    writer = MonitorXlsxWriter(folder, "mpx", 24, False, logger, streaming)
+    writer.add_start_info(
+        {"Windows": {}, "Linux": {}}, ["host.fqdn", "host.ip"], ["comment", "two"]
+    )
+    simple = writer.worksheets["simple"]
+    simple.write(20, 0, "after", writer.formats.red)
+    simple.write(16, 0, "before", writer.formats.green)
+    simple.merge_range(17, 1, 19, 2, "merged", writer.formats.yellow)
+    # строки многострочного объединения дописываются после него
+    simple.write(18, 0, "inside", writer.formats.white)
+    simple.write(19, 3, "beside", writer.formats.white)
+    simple.write_formula(19, 0, "=1+1", writer.formats.white, 2)
+    writer.finish()
+    writer.workbook.close()
+    return writer.workbook_path
+
+
+def test_streaming_report_equals_in_memory_report(logger, tmp_path):
+    in_memory = read_sheets(build_report(tmp_path / "memory", logger, False))
+    streamed = read_sheets(build_report(tmp_path / "stream", logger, True))
+    assert streamed == in_memory
+    cells, merges = streamed["simple"]
+    assert cells["A17"] == ("before", cells["A17"][1])
+    assert "B18:C20" in merges and "G2:I2" in merges
+    assert cells["A19"][0] == "inside" and cells["D20"][0] == "beside"